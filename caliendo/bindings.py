@@ -0,0 +1,247 @@
+import sys
+import inspect
+import types
+import weakref
+from mock import _get_target
+
+# Kept out of caliendo.patch, since dill pickles that module's globals along with the hooks defined there.
+MODULES_ = {} # Module -> (copy of its __dict__ when indexed, [(name, object)] for objects with a __name__, set of modules those objects belong to)
+BINDINGS_ = {} # Object -> set of (module, name) it's bound to at module level, for the hashable objects in MODULES_
+REPLACEMENTS_ = weakref.WeakKeyDictionary() # Replacement method -> the method it's patched in place of
+TARGETS_ = {} # Import path -> (module or class the target is an attribute of, attribute name)
+NAMES_ = {} # Name -> set of indexed modules binding it at module level, to anything
+SYS_MODULES_ = {} # sys.modules as it was when the index was last brought up to date with it
+REACHABLE_ = {} # Module -> ({module: entry in MODULES_} for itself and the modules reached that sys.modules doesn't hold, set of modules reachable from it)
+
+def resolve_target(import_path):
+    """
+    Resolves an import path to the module or class holding the target and the target's name. Paths are resolved once, and again only if the module or class holding the target has been replaced since, in sys.modules or by the module or class holding it, as reloading a module does.
+
+    :param str import_path: The absolute import path to the target
+
+    :rtype: tuple
+    :returns: (module or class, attribute name)
+    """
+    target = TARGETS_.get(import_path)
+    if target is not None and is_current_owner(import_path, target[0]):
+        return target
+    getter, attribute = _get_target(import_path)
+    target = (getter(), attribute)
+    TARGETS_[import_path] = target
+    return target
+
+def is_current_owner(import_path, owner):
+    """
+    Tests whether the module or class an import path was resolved to is still the one the path leads to.
+
+    :param str import_path: The absolute import path to the target
+    :param mixed owner: The module or class it was resolved to
+
+    :rtype bool:
+    """
+    if isinstance(owner, types.ModuleType):
+        return sys.modules.get(owner.__name__) is owner
+    parent, name = resolve_target(import_path.rsplit('.', 1)[0])
+    return getattr(parent, name, None) is owner
+
+def unindex_module(module):
+    """
+    Removes a module's bindings from the index.
+
+    :param types.ModuleType module: The module to remove
+
+    """
+    snapshot, names, dependencies = MODULES_.pop(module)
+    for name, object in names:
+        try:
+            BINDINGS_[object].discard((module, name))
+        except (KeyError, TypeError):
+            pass
+    for name in snapshot:
+        NAMES_[name].discard(module)
+
+def is_current(module):
+    """
+    Tests whether a module binds the same objects with a __name__ to the same names as when it was indexed. Names bound to other values, like counters and settings, are free to change.
+
+    :param types.ModuleType module: An indexed module
+
+    :rtype bool:
+    """
+    snapshot = MODULES_[module][0]
+    current = module.__dict__
+    for name, object in current.iteritems():
+        previous = snapshot.get(name)
+        if previous is not object and (hasattr(previous, '__name__') or hasattr(object, '__name__')):
+            return False
+    for name, previous in snapshot.iteritems():
+        if name not in current and hasattr(previous, '__name__'):
+            return False
+    return True
+
+def index_module(module):
+    """
+    Indexes the objects with a __name__ a module binds at module level, and the modules they belong to. A module that's already indexed is left as it is.
+
+    :param types.ModuleType module: The module to index
+
+    :rtype: set
+    :returns: The modules the module depends on
+    """
+    if module in MODULES_:
+        return MODULES_[module][2]
+
+    names = []
+    dependencies = set([])
+    for name, object in module.__dict__.items():
+        NAMES_.setdefault(name, set([])).add(module)
+        if not hasattr(object, '__name__'):
+            continue
+        if type(object) is types.FunctionType and object in REPLACEMENTS_: # Index what's there when it isn't patched
+            object = REPLACEMENTS_[object]
+        names.append((name, object))
+        try:
+            BINDINGS_.setdefault(object, set([])).add((module, name))
+        except Exception: # Unhashable, or compares badly. It's found by scanning the names instead.
+            pass
+        dependency = inspect.getmodule(object)
+        if isinstance(dependency, types.ModuleType):
+            dependencies.add(dependency)
+
+    MODULES_[module] = (dict(module.__dict__), names, dependencies)
+    return dependencies
+
+def reindex_module(module):
+    """
+    Indexes a module, again if any name has been bound to or unbound from an object with a __name__ since it was last indexed.
+
+    :param types.ModuleType module: The module to index
+
+    :rtype: set
+    :returns: The modules the module depends on
+    """
+    if module in MODULES_ and not is_current(module):
+        unindex_module(module)
+    return index_module(module)
+
+def is_registered(module):
+    """
+    Tests whether a module is the one sys.modules holds under its name.
+
+    :param types.ModuleType module: Any module
+
+    :rtype bool:
+    """
+    name = getattr(module, '__name__', None)
+    return isinstance(name, basestring) and sys.modules.get(name) is module
+
+def refresh():
+    """
+    Brings the index up to date with sys.modules. Only the modules added to or replaced in sys.modules since it was last brought up to date, and the packages holding them, are indexed again. Otherwise the modules sys.modules holds are taken to bind what they did when they were indexed.
+
+    """
+    if sys.modules == SYS_MODULES_:
+        return
+    for name, module in sys.modules.items():
+        if SYS_MODULES_.get(name) is module or not isinstance(module, types.ModuleType):
+            continue
+        if module in MODULES_:
+            reindex_module(module)
+        package = sys.modules.get(name.rpartition('.')[0])
+        if package in MODULES_:
+            reindex_module(package)
+    SYS_MODULES_.clear()
+    SYS_MODULES_.update(sys.modules)
+    REACHABLE_.clear()
+
+def add_replacement(replacement, original):
+    """
+    Records that a method is patched in place of another, so modules indexed while it's in place are indexed as binding the original.
+
+    :param function replacement: The method patched in
+    :param function original: The method it replaces
+
+    """
+    REPLACEMENTS_[replacement] = original
+
+def find_reachable_modules(module, max_depth=99):
+    """
+    Finds the modules a module depends on, directly or through other modules, the same way find_dependencies does, using the index.
+
+    The result is kept until sys.modules changes. Until then only the module itself, and the modules reached that sys.modules doesn't hold, are checked for names bound since they were indexed.
+
+    :param types.ModuleType module: The module to start from
+    :param int max_depth: The maximum depth to resolve dependencies
+
+    :rtype: set
+    """
+    if not isinstance(module, types.ModuleType):
+        return set([])
+    refresh()
+    reindex_module(module)
+    if module in REACHABLE_:
+        entries, reachable = REACHABLE_[module]
+        for m in entries:
+            if m is not module:
+                reindex_module(m)
+        if all([MODULES_[m] is entry for m, entry in entries.items()]):
+            return reachable
+
+    def index(m):
+        if is_registered(m):
+            return index_module(m)
+        return reindex_module(m)
+
+    reachable = set([module])
+    frontier = [module]
+    for depth in xrange(max_depth):
+        next_frontier = []
+        for m in frontier:
+            for dependency in index(m):
+                if dependency not in reachable:
+                    reachable.add(dependency)
+                    next_frontier.append(dependency)
+        if not next_frontier:
+            break
+        frontier = next_frontier
+    for m in frontier: # The deepest modules' own bindings still count
+        index(m)
+    entries = dict([(m, MODULES_[m]) for m in reachable if m is module or not is_registered(m)])
+    REACHABLE_[module] = (entries, reachable)
+    return reachable
+
+def find_bindings(target, modules, watched=None):
+    """
+    Finds where an object is bound at module level within some modules.
+
+    :param mixed target: The object to look for
+    :param set modules: The modules to look in. They have to have been indexed.
+    :param list watched: If given, every (module, name) looked at is appended to it, whether it's bound to the object or not. The object is bound at those sites and no others for as long as none of them is bound differently and the index is unchanged.
+
+    :rtype: list of tuples
+    :returns: (module, name) for every binding of the object, as it's bound now.
+    """
+    try:
+        candidates = set(BINDINGS_.get(target, ()))
+    except Exception: # Unhashable. Scan the bindings.
+        candidates = set([(module, name) for module in modules for name, object in MODULES_[module][1] if object == target])
+
+    # Names rebound in place since their modules were indexed, under the target's own name or one it's bound to elsewhere
+    names = set([name for module, name in candidates])
+    try:
+        names.add(target.__name__)
+    except Exception:
+        pass
+    for name in names:
+        if isinstance(name, basestring):
+            candidates.update([(module, name) for module in NAMES_.get(name, ())])
+
+    bindings = []
+    for module, name in candidates:
+        if module not in modules:
+            continue
+        if watched is not None:
+            watched.append((module, name))
+        if name in module.__dict__ and module.__dict__[name] == target:
+            bindings.append((module, name))
+    return bindings
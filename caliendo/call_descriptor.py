@@ -1,39 +1,44 @@
-import cPickle as pickle
 import copy_reg
 import types
 import sys
 
 from caliendo import config
 from caliendo import pickling
+from caliendo import lru
 
 if config.should_use_caliendo():
-    from caliendo.db.flatfiles import insert_io, select_io, delete_io
+    from caliendo.db import insert_io, select_io, delete_io, get_max_packet_size, record_used
+
+L1_ = lru.LRU(config.CALIENDO_L1_ENTRIES, config.CALIENDO_L1_BYTES) # Hash -> (stack, methodname, Decoded returnval, Decoded args)
 
 def fetch( hash ):
     """
     Fetches CallDescriptor from the local database given a hash key representing the call. If it doesn't exist returns None.
 
+    Decoded calls are kept in L1_ so calls made over and over aren't unpickled every time. The return value and arguments are copied according to CALIENDO_L1_COPY.
+
     :param str hash: The sha1 hexdigest to look the CallDescriptor up by.
 
     :rtype: CallDescriptor corresponding to the hash passed or None if it wasn't found.
     """
-    res = select_io( hash )
-
-    if res:
-      p = { 'methodname': '', 'returnval': '', 'args': '', 'stack': '' }
-      for packet in res:
-        hash, stack, methodname, returnval, args, packet_num = packet
-        p['methodname'] = p['methodname'] + methodname
-        p['returnval']  = p['returnval'] + returnval
-        p['args']       = p['args'] + args
-        p['stack']      = p['stack'] + stack
-                             
-      return CallDescriptor( hash = hash,
-                             stack = p['stack'],
-                             method = p['methodname'],
-                             returnval = pickle.loads( str( p['returnval'] ) ),
-                             args = pickle.loads( str( p['args'] ) ) )
-    return None
+    decoded = L1_.get( hash )
+    if decoded:
+      record_used( 'cache', hash )
+    else:
+      res = select_io( hash )
+      if not res:
+        return None
+
+      hashes, stack, methodname, returnval, args, packet_num = zip( *res )
+      decoded = ( "".join( stack ), "".join( methodname ), pickling.Decoded( str( "".join( returnval ) ) ), pickling.Decoded( str( "".join( args ) ) ) )
+      L1_.put( hash, decoded, len( decoded[0] ) + decoded[2].size + decoded[3].size )
+
+    stack, methodname, returnval, args = decoded
+    return CallDescriptor( hash = hash,
+                           stack = stack,
+                           method = methodname,
+                           returnval = returnval.get( config.CALIENDO_L1_COPY ),
+                           args = args.get( config.CALIENDO_L1_COPY ) )
 
 
 class CallDescriptorBuffer:
@@ -48,36 +53,28 @@ class CallDescriptorBuffer:
     returnval              = pickling.pickle_with_weak_refs(returnval)
 
 
-    self.__data            = "".join([ methodname, args, returnval, stack ])
-    self.__methodname_len  = len( methodname )
-    self.__args_len        = len( args )
-    self.__returnval_len   = len( returnval )
-    self.__stack_len       = len( stack )
-    self.length            = self.__methodname_len + self.__args_len + self.__returnval_len + self.__stack_len
-    self.char              = 0
+    self.__fields          = [ ( 'methodname', methodname ), ( 'args', args ), ( 'returnval', returnval ), ( 'stack', stack ) ]
+    self.length            = sum([ len( data ) for attr, data in self.__fields ])
 
-  def next(self):
-    if self.char + 1 > self.length:
-      raise StopIteration
-
-    c         = self.__data[ self.char ]
-    attr      = self.attr()
-    self.char = self.char + 1
-
-    return c, attr
+  def packets(self, max_packet_size=None):
+    """
+    Splits the method name, args, return value, and stack, in that order, into packets of at most max_packet_size characters. Each packet is a dict of the parts of those fields it holds, sliced straight out of them.
 
-  def __iter__(self):
-    return self
+    :param int max_packet_size: The most characters a packet can hold. None for a single packet.
 
-  def attr(self):
-    if self.char < self.__methodname_len:
-      return 'methodname'
-    elif self.char < self.__methodname_len + self.__args_len:
-      return 'args'
-    elif self.char < self.__methodname_len + self.__args_len + self.__returnval_len:
-      return 'returnval'
-    else:
-      return 'stack'
+    :rtype: list(dict)
+    """
+    max_packet_size = max_packet_size or self.length
+    packets         = [ ]
+    for start in xrange( 0, self.length, max_packet_size ):
+      end    = start + max_packet_size
+      p      = { }
+      offset = 0
+      for attr, data in self.__fields:
+        p[attr] = data[ max( start - offset, 0 ):max( end - offset, 0 ) ]
+        offset += len( data )
+      packets.append( p )
+    return packets
 
 
 class CallDescriptor:
@@ -114,20 +111,12 @@ class CallDescriptor:
           }
 
     def __enumerate_packets(self):
-        max_packet_size  = 1024 * 1024 # ~2MB depending on the size of a char, prolly more like 4MB for 4b char size. MySQL default limit is 16
         buffer           = CallDescriptorBuffer( self.methodname, self.args, self.returnval, self.stack )
-        packet_num       = 0
         packets          = [ ]
-        while buffer.char < buffer.length:
+        for packet_num, data in enumerate( buffer.packets( get_max_packet_size() ) ):
             p = self.__empty_packet( packet_num )
-            packet_length = 0
-            for char, attr in buffer:
-                p[attr] += char
-                packet_length += 1
-                if packet_length == max_packet_size:
-                    break
+            p.update( data )
             packets.append( p )
-            packet_num += 1
 
         return packets
 
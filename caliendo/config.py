@@ -17,3 +17,30 @@ def should_use_caliendo( ):
 CALIENDO_PROMPT = False
 if os.environ.get('CALIENDO_PROMPT', False) == 'True':
     CALIENDO_PROMPT = True
+
+CALIENDO_BACKEND = os.environ.get('CALIENDO_BACKEND', 'flatfiles')
+
+CALIENDO_WRITE_BEHIND = False
+if os.environ.get('CALIENDO_WRITE_BEHIND', False) == 'True':
+    CALIENDO_WRITE_BEHIND = True
+CALIENDO_WRITE_BEHIND_THRESHOLD = int(os.environ.get('CALIENDO_WRITE_BEHIND_THRESHOLD', 1000))
+
+CALIENDO_LOG_SEGMENT_SIZE = int(os.environ.get('CALIENDO_LOG_SEGMENT_SIZE', 64 * 1024 * 1024))
+
+CALIENDO_LOCK_TIMEOUT = float(os.environ.get('CALIENDO_LOCK_TIMEOUT', 60))
+
+CALIENDO_BLOB_THRESHOLD = int(os.environ.get('CALIENDO_BLOB_THRESHOLD', 1024 * 1024))
+CALIENDO_BLOB_VIEWS = False
+if os.environ.get('CALIENDO_BLOB_VIEWS', False) == 'True':
+    CALIENDO_BLOB_VIEWS = True
+
+CALIENDO_HASHER = os.environ.get('CALIENDO_HASHER', 'compat')
+
+CALIENDO_L1_ENTRIES = int(os.environ.get('CALIENDO_L1_ENTRIES', 1024))
+CALIENDO_L1_BYTES = int(os.environ.get('CALIENDO_L1_BYTES', 64 * 1024 * 1024))
+CALIENDO_L1_COPY = os.environ.get('CALIENDO_L1_COPY', 'unpickle')
+
+CALIENDO_REPLAY = False
+if os.environ.get('CALIENDO_REPLAY', False) == 'True':
+    CALIENDO_REPLAY = True
+CALIENDO_REPLAY_VERIFY = int(os.environ.get('CALIENDO_REPLAY_VERIFY', 100))
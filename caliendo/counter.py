@@ -1,12 +1,15 @@
 from hashlib import sha1
 import os
+import atexit
 
 from caliendo import config
 
 if config.should_use_caliendo():
-    from caliendo.db.flatfiles import insert_test, select_test
+    from caliendo.db import insert_tests, select_tests, record_used
 
-__counters = { }
+__counters = { } # Trace -> the next counter value for it
+SEEDS_ = None # Seed hash -> (random, seq), loaded in bulk the first time a counter is used
+PENDING_ = set() # Hashes of the seeds created since the last flush
 
 def get_from_trace_for_ev(trace):
     if os.environ.get('CALIENDO_DISABLE_EV_COUNTER', False) == 'True':
@@ -19,31 +22,36 @@ def get_from_trace_for_cache(trace):
     return get_from_trace(trace)
 
 def get_from_trace(trace):
-    key = sha1( trace ).hexdigest()
-    if key in __counters:
-        t = __counters[ key ]
-        __counters[ key ] = t + 1
-        return t
-    else:
+    try:
+        t = __counters[ trace ]
+    except KeyError:
         t = __get_seed_from_trace( trace )
-        if not t:
-            t = __set_seed_by_trace( trace )
 
-    __counters[ key ] = t + 1
+    __counters[ trace ] = t + 1
     return t
 
-def __get_seed_from_trace( trace):
-    key = sha1( trace ).hexdigest()
-    res = select_test( key )
-    if res:
-        r, seq = res[0]
-        return seq
-    return None
-
-def __set_seed_by_trace( trace):
+def __get_seed_from_trace( trace ):
+    global SEEDS_
+    if SEEDS_ is None:
+        SEEDS_ = select_tests()
     key = sha1( trace ).hexdigest()
-    t = 0
-    insert_test( hash=key, random=t, seq=t )
-    seq = __get_seed_from_trace( trace )
-    return seq
+    record_used( 'seeds', key )
+    if key not in SEEDS_:
+        SEEDS_[ key ] = ( 0, 0 )
+        PENDING_.add( key )
+    r, seq = SEEDS_[ key ]
+    return seq or 0
+
+def flush():
+    """
+    Saves the seeds for the traces seen for the first time since the last flush in one batch. Seeds another process saved in the meantime are left alone.
+
+    """
+    if not PENDING_:
+        return
+    existing = select_tests()
+    insert_tests([ ( key, 0, 0 ) for key in PENDING_ if key not in existing ])
+    PENDING_.clear()
 
+if config.should_use_caliendo():
+    atexit.register(flush)
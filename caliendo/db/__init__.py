@@ -0,0 +1,145 @@
+from __future__ import absolute_import
+
+import importlib
+
+from caliendo import config
+from caliendo import lru
+from caliendo.db import used
+from caliendo.db import blobs
+from caliendo.db.backend import Backend
+
+BACKENDS = {}
+BACKEND_ = None
+
+def register_backend(name, backend):
+    """
+    Registers a storage backend so it can be selected by name with CALIENDO_BACKEND or set_backend.
+
+    :param str name: The name to select the backend by.
+    :param type|str backend: A subclass of caliendo.db.backend.Backend, or the dotted path to one. Dotted paths aren't imported until the backend is selected.
+
+    """
+    BACKENDS[name] = backend
+
+def load_backend(name):
+    """
+    Instantiates a registered backend.
+
+    :param str name: The name the backend was registered under.
+
+    :rtype: caliendo.db.backend.Backend
+    """
+    if name not in BACKENDS:
+        raise Exception("Unknown caliendo backend: {0}".format(name))
+    backend = BACKENDS[name]
+    if isinstance(backend, basestring):
+        module_name, class_name = backend.rsplit('.', 1)
+        backend = getattr(importlib.import_module(module_name), class_name)
+    return backend()
+
+def get_backend():
+    """
+    Returns the backend in use, loading the one named by CALIENDO_BACKEND the first time it's needed.
+
+    :rtype: caliendo.db.backend.Backend
+    """
+    global BACKEND_
+    if BACKEND_ is None:
+        BACKEND_ = load_backend(config.CALIENDO_BACKEND)
+    return BACKEND_
+
+def set_backend(backend):
+    """
+    Switches the backend in use.
+
+    :param str|caliendo.db.backend.Backend backend: The name of a registered backend or a backend instance. None goes back to the one named by CALIENDO_BACKEND.
+
+    :rtype: caliendo.db.backend.Backend
+    :returns: The backend that was in use before.
+    """
+    global BACKEND_
+    previous = BACKEND_
+    if backend is None or isinstance(backend, Backend):
+        BACKEND_ = backend
+    else:
+        BACKEND_ = load_backend(backend)
+    lru.clear_all() # Values decoded from the previous backend's cache
+    return previous
+
+register_backend('flatfiles', 'caliendo.db.flatfiles.FlatfilesBackend')
+register_backend('sharded', 'caliendo.db.sharded.ShardedBackend')
+register_backend('sqlite', 'caliendo.db.sqlite.SqliteBackend')
+register_backend('memory', 'caliendo.db.memory.MemoryBackend')
+register_backend('compiled', 'caliendo.db.compiled.CompiledBackend')
+register_backend('log', 'caliendo.db.logstore.LogBackend')
+
+def insert_io(args):
+    return get_backend().insert_io(args)
+
+def select_io(hash):
+    return get_backend().select_io(hash)
+
+def delete_io(hash):
+    lru.discard_all(hash)
+    return get_backend().delete_io(hash)
+
+def get_max_packet_size():
+    return get_backend().max_packet_size
+
+def get_packets(cache_type):
+    return get_backend().get_packets(cache_type)
+
+def insert_expected_value(packet):
+    return get_backend().insert_expected_value(packet)
+
+def select_expected_value(hash):
+    return get_backend().select_expected_value(hash)
+
+def delete_expected_value(hash):
+    lru.discard_all(hash)
+    return get_backend().delete_expected_value(hash)
+
+def insert_test(hash, random, seq):
+    return get_backend().insert_test(hash, random, seq)
+
+def select_test(hash):
+    return get_backend().select_test(hash)
+
+def insert_tests(seeds):
+    return get_backend().insert_tests(seeds)
+
+def select_tests():
+    return get_backend().select_tests()
+
+def get_unique_hashes():
+    return get_backend().get_unique_hashes()
+
+def save_stack(stack):
+    return get_backend().save_stack(stack)
+
+def load_stack(stack):
+    return get_backend().load_stack(stack)
+
+def delete_stack(stack):
+    return get_backend().delete_stack(stack)
+
+def record_used(kind, hash):
+    return get_backend().record_used(kind, hash)
+
+def read_used():
+    return get_backend().read_used()
+
+def reset_used():
+    return get_backend().reset_used()
+
+def read_all():
+    return get_backend().read_all()
+
+def purge():
+    lru.clear_all()
+    get_backend().purge()
+    blobs.purge(get_backend())
+
+def flush():
+    get_backend().flush()
+    used.flush()
@@ -0,0 +1,302 @@
+from __future__ import absolute_import
+
+import dill as pickle
+
+from caliendo.db.used import record_used, read_used, reset_used
+
+PPROT = pickle.HIGHEST_PROTOCOL
+
+NAMESPACES = ('cache', 'evs', 'seeds', 'stacks')
+
+def pickle_entry(namespace, value):
+    """
+    Converts an entry to the form the file based backends store it in. Cache and expected value packets are pickled individually, as are stacks.
+
+    :param str namespace: One of 'cache', 'evs', 'seeds', or 'stacks'
+    :param mixed value: The entry
+
+    :rtype: mixed
+    """
+    if value is None:
+        return None
+    if namespace == 'cache':
+        return dict([(n, pickle.dumps(packet, PPROT)) for n, packet in value.items()])
+    if namespace == 'evs':
+        return [pickle.dumps(packet, PPROT) for packet in value]
+    if namespace == 'stacks':
+        return pickle.dumps(value, PPROT)
+    return value
+
+def unpickle_entry(namespace, value):
+    """
+    The inverse of pickle_entry.
+
+    :param str namespace: One of 'cache', 'evs', 'seeds', or 'stacks'
+    :param mixed value: The entry as it was stored
+
+    :rtype: mixed
+    """
+    if value is None:
+        return None
+    if namespace == 'cache':
+        return dict([(n, pickle.loads(packet)) for n, packet in value.items()])
+    if namespace == 'evs':
+        return [pickle.loads(packet) for packet in value]
+    if namespace == 'stacks':
+        return pickle.loads(value)
+    return dict(value)
+
+class Backend(object):
+    """
+    The interface every storage backend implements. Entries are kept in four namespaces, each keyed by a hash:
+
+      * 'cache': A dictionary of CallDescriptor packets (dicts with hash, stack, packet_num, methodname, args, and returnval) by packet number.
+      * 'evs': A list of ExpectedValue packets (dicts with call_hash, packet_num, and expected_value) in the order they were inserted.
+      * 'seeds': A counter seed. A dict with hash, random, and seq.
+      * 'stacks': A caliendo.hooks.CallStack, keyed by "<module>.<caller>".
+
+    A backend only has to implement get, put, delete, and iterate. The rest of the storage API is built on top of those, though backends are free to override any of it with something faster.
+
+    CallDescriptors and ExpectedValues are split into packets of at most max_packet_size characters before they're saved, for stores that limit how big a value can be (MySQL's default max_allowed_packet is 16MB). Backends without a limit set it to None to save each one as a single packet.
+
+    """
+    name = None
+    max_packet_size = 1024 * 1024
+
+    def get(self, namespace, key):
+        """
+        Returns the entry stored at key in namespace, or None if there isn't one.
+
+        :param str namespace: One of 'cache', 'evs', 'seeds', or 'stacks'
+        :param str key: The hash (or stack key) of the entry
+
+        :rtype: mixed
+        """
+        raise NotImplementedError
+
+    def put(self, namespace, key, value):
+        """
+        Stores an entry at key in namespace, replacing whatever was there.
+
+        :param str namespace: One of 'cache', 'evs', 'seeds', or 'stacks'
+        :param str key: The hash (or stack key) of the entry
+        :param mixed value: The entry
+
+        """
+        raise NotImplementedError
+
+    def delete(self, namespace, key):
+        """
+        Deletes the entry stored at key in namespace if there is one.
+
+        :param str namespace: One of 'cache', 'evs', 'seeds', or 'stacks'
+        :param str key: The hash (or stack key) of the entry
+
+        """
+        raise NotImplementedError
+
+    def iterate(self, namespace):
+        """
+        Returns the keys of all the entries in namespace.
+
+        :param str namespace: One of 'cache', 'evs', 'seeds', or 'stacks'
+
+        :rtype: list(<string>)
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Writes out any changes the backend has deferred.
+
+        """
+        pass
+
+    record_used = staticmethod(record_used)
+    read_used = staticmethod(read_used)
+    reset_used = staticmethod(reset_used)
+
+    def get_packets(self, cache_type):
+        return dict([(hash, len(self.get(cache_type, hash) or [])) for hash in self.iterate(cache_type)])
+
+    def delete_io(self, hash):
+        """
+        Deletes records associated with a particular hash
+
+        :param str hash: The hash
+
+        :rtype int: The number of records deleted
+        """
+        self.record_used('cache', hash)
+        num_deleted = len(self.get('cache', hash) or {})
+        self.delete('cache', hash)
+        return num_deleted
+
+    def insert_io(self, args):
+        """
+        Inserts a method's i/o into the datastore
+
+        :param dict args: A dictionary of the hash, stack, packet_num, methodname, args, and returnval
+
+        :rtype None:
+        """
+        hash = args['hash']
+        self.record_used('cache', hash)
+        packets = self.get('cache', hash) or {}
+        packets[args['packet_num']] = args
+        self.put('cache', hash, packets)
+
+    def select_io(self, hash):
+        """
+        Returns the relevant i/o for a method whose call is characterized by the hash
+
+        :param hash: The hash for the CallDescriptor
+
+        :rtype list(tuple( hash, stack, methodname, returnval, args, packet_num )):
+        """
+        self.record_used('cache', hash)
+        packets = self.get('cache', hash) or {}
+        return [(d['hash'], d['stack'], d['methodname'], d['returnval'], d['args'], d['packet_num'])
+                for d in [packets[n] for n in sorted(packets.keys())]]
+
+    def select_expected_value(self, hash):
+        if not hash:
+            return []
+        self.record_used('evs', hash)
+        return [(fr['call_hash'], fr['expected_value'], fr['packet_num']) for fr in self.get('evs', hash) or []]
+
+    def delete_expected_value(self, hash):
+        self.delete('evs', hash)
+
+    def insert_expected_value(self, packet):
+        hash = packet['call_hash']
+        self.record_used('evs', hash)
+        packets = self.get('evs', hash) or []
+        packets.append(packet)
+        self.put('evs', hash, packets)
+
+    def insert_test(self, hash, random, seq):
+        """
+        Inserts a random value and sequence for a local call counter
+
+        :param str hash: The hash for the call
+        :param str random: A random number for the seed
+        :param str seq: An integer from which to increment on the local call
+
+        :rtype None:
+        """
+        self.record_used('seeds', hash)
+        self.put('seeds', hash, {'hash': hash, 'random': random, 'seq': seq})
+
+    def select_test(self, hash):
+        """
+        Returns the seed values associated with a function call
+
+        :param str hash: The hash for the function call
+
+        :rtype [tuple(<string>, <string>)]:
+        """
+        self.record_used('seeds', hash)
+        d = self.get('seeds', hash)
+        if d:
+            return [(d.get('random', None), d.get('seq', None))]
+        return None
+
+    def insert_tests(self, seeds):
+        """
+        Inserts the seeds for many local call counters at once
+
+        :param list(tuple) seeds: (hash, random, seq) for each counter
+
+        :rtype None:
+        """
+        for hash, random, seq in seeds:
+            self.insert_test(hash, random, seq)
+
+    def select_tests(self):
+        """
+        Returns the seed values for every function call
+
+        :rtype dict: (random, seq) by hash
+        """
+        seeds = {}
+        for hash in self.iterate('seeds'):
+            d = self.get('seeds', hash)
+            if d:
+                seeds[hash] = (d.get('random', None), d.get('seq', None))
+        return seeds
+
+    def get_unique_hashes(self):
+        """
+        Returns all the hashes for cached calls
+
+        :rtype list(<string>)
+        """
+        return list(self.iterate('cache'))
+
+    def delete_from_directory_by_hashes(self, cache_type, hashes):
+        """
+        Deletes all the entries corresponding to a list of hashes
+
+        :param str cache_type: The namespace to delete entries from.
+        :param list(str) hashes: The hashes to delete the entries for
+
+        """
+        if hashes == '*':
+            hashes = list(self.iterate(cache_type))
+        for h in hashes:
+            self.delete(cache_type, h)
+
+    def read_all(self):
+        """
+        Reads all the hashes and returns them in a dictionary by type
+
+        :rtype: dict
+        :returns: A dictionary of sets of hashes by type
+        """
+        return {"evs"  : list(self.iterate('evs')),
+                "cache": list(self.iterate('cache')),
+                "seeds": list(self.iterate('seeds'))}
+
+    def purge(self):
+        """
+        Deletes all the cached entries since the last call to reset_used that have not been used.
+
+        """
+        all_hashes = self.read_all()
+        used_hashes = self.read_used()
+        for kind, hashes in used_hashes.items():
+            to_remove = set(all_hashes[kind]).difference(hashes)
+            self.delete_from_directory_by_hashes(kind, to_remove)
+
+        self.reset_used()
+        self.flush()
+
+    def save_stack(self, stack):
+        """
+        Saves a stack object.
+
+        :param caliendo.hooks.CallStack stack: The stack to save.
+
+        """
+        self.put('stacks', "{0}.{1}".format(stack.module, stack.caller), stack)
+
+    def load_stack(self, stack):
+        """
+        Loads the saved state of a CallStack and returns a whole instance given an instance with incomplete state.
+
+        :param caliendo.hooks.CallStack stack: The stack to load
+
+        :returns: A CallStack previously built in the context of a patch call.
+        :rtype: caliendo.hooks.CallStack
+
+        """
+        return self.get('stacks', "{0}.{1}".format(stack.module, stack.caller))
+
+    def delete_stack(self, stack):
+        """
+        Deletes a stack that was previously saved.
+
+        :param caliendo.hooks.CallStack stack: The stack to delete.
+        """
+        self.delete('stacks', "{0}.{1}".format(stack.module, stack.caller))
@@ -0,0 +1,129 @@
+from __future__ import absolute_import
+
+import os
+import re
+import time
+import mmap
+import tempfile
+from hashlib import sha1
+
+DEFAULT_ROOT = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', '..')
+ROOT = os.environ.get('CALIENDO_CACHE_PREFIX', DEFAULT_ROOT)
+BLOBDIR = os.path.join(ROOT, 'blobs')
+
+PREFIX = 'caliendo-blob:' # Pickles refer to a blob by a persistent id starting with this and the blob's hash.
+REFERENCE = re.compile(re.escape(PREFIX) + '([0-9a-f]{40})')
+
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+def get_path(hash):
+    """
+    Returns the path to the file holding a blob.
+
+    :param str hash: The sha1 hexdigest of the blob
+
+    :rtype str:
+    """
+    return os.path.join(BLOBDIR, hash)
+
+def put_blob(data):
+    """
+    Stores a blob, named by its content, if it isn't stored already. It's written to a temporary file first and renamed into place so readers never see a partial write.
+
+    :param str|bytearray|buffer data: The blob
+
+    :rtype str: The sha1 hexdigest of the blob
+    """
+    hash = sha1(data).hexdigest()
+    path = get_path(hash)
+    if os.path.exists(path):
+        os.utime(path, None) # Keeps a purge that's already running from deleting it.
+        return hash
+    if not os.path.exists(BLOBDIR):
+        try:
+            os.makedirs(BLOBDIR)
+        except OSError:
+            if not os.path.isdir(BLOBDIR):
+                raise
+    fd, tmp = tempfile.mkstemp(dir=BLOBDIR, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp, 0666 & ~UMASK) # mkstemp only gives the owner access.
+        os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return hash
+
+def get_blob(hash, view=False):
+    """
+    Reads a blob.
+
+    :param str hash: The sha1 hexdigest of the blob
+    :param bool view: Return a read-only buffer over the memory mapped blob instead of copying it into a str.
+
+    :rtype str|buffer:
+    """
+    try:
+        f = open(get_path(hash), 'rb')
+    except IOError:
+        raise Exception("Missing caliendo blob {0}. Recache the calls that returned it.".format(hash))
+    with f:
+        if view:
+            return buffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        return f.read()
+
+def find_references(data):
+    """
+    Returns the hashes of the blobs a pickle refers to.
+
+    :param str data: A pickle, or anything containing one
+
+    :rtype set:
+    """
+    return set(REFERENCE.findall(data))
+
+def get_references(backend):
+    """
+    Returns the hashes of the blobs any cached call or expected value refers to.
+
+    :param caliendo.db.backend.Backend backend: The backend holding the cache
+
+    :rtype set:
+    """
+    references = set()
+    for hash in backend.iterate('cache'):
+        packets = [p for n, p in sorted((backend.get('cache', hash) or {}).items())]
+        references.update(find_references("".join([p['args'] for p in packets])))
+        references.update(find_references("".join([p['returnval'] for p in packets])))
+    for hash in backend.iterate('evs'):
+        references.update(find_references("".join([p['expected_value'] for p in backend.get('evs', hash) or []])))
+    return references
+
+def purge(backend):
+    """
+    Deletes the blobs nothing in the cache refers to. Blobs stored since the purge started are kept since the calls they belong to may not be saved yet.
+
+    :param caliendo.db.backend.Backend backend: The backend holding the cache
+
+    :rtype int: The number of blobs deleted
+    """
+    if not os.path.isdir(BLOBDIR):
+        return 0
+    started = time.time()
+    references = get_references(backend)
+    deleted = 0
+    for name in os.listdir(BLOBDIR):
+        if name in references or name.startswith('.tmp-'):
+            continue
+        path = get_path(name)
+        try:
+            if os.path.getmtime(path) < started:
+                os.unlink(path)
+                deleted += 1
+        except OSError:
+            pass
+    return deleted
@@ -0,0 +1,222 @@
+from __future__ import absolute_import
+
+import os
+import sys
+import mmap
+import struct
+import tempfile
+from hashlib import sha1
+
+import dill as pickle
+
+from caliendo.logger import get_logger
+from caliendo.db.backend import Backend, NAMESPACES, PPROT
+from caliendo.db.memory import MemoryBackend
+
+logger = get_logger(__name__)
+
+DEFAULT_ROOT = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', '..')
+ROOT = os.environ.get('CALIENDO_CACHE_PREFIX', DEFAULT_ROOT)
+COMPILED = os.path.join(ROOT, 'cache.compiled')
+
+MAGIC = 'CLDOC001'
+HEADER = struct.Struct('>8sI')     # magic, number of entries
+RECORD = struct.Struct('>B40sQI')  # namespace, key, offset, length
+KEY_LENGTH = 41                    # The namespace byte and the key. What the index is sorted by.
+
+MAP_ = None
+MAP_STAT_ = None
+
+def index_key(namespace, key):
+    """
+    Returns the key an entry is indexed by. Hashes are indexed as is and stacks by the sha1 of their key.
+
+    :param str namespace: One of 'cache', 'evs', 'seeds', or 'stacks'
+    :param str key: The hash (or stack key) of the entry
+
+    :rtype: str
+    """
+    if namespace == 'stacks':
+        key = sha1(key).hexdigest()
+    return struct.pack('>B40s', NAMESPACES.index(namespace), key)
+
+def compile_cache(source='flatfiles', path=None):
+    """
+    Compiles every entry in a backend into an immutable cache file for the compiled backend. The file is a sorted index of fixed width records pointing into a data region of pickled entries. It's written to a temporary file and renamed into place, so processes that already have the old file open keep reading it.
+
+    :param str|caliendo.db.backend.Backend source: The backend to compile, or the name it's registered under.
+    :param str path: Where to write the file. Defaults to $CALIENDO_CACHE_PREFIX/cache.compiled
+
+    :rtype: int
+    :returns: The number of entries compiled
+    """
+    from caliendo.db import load_backend
+    if not isinstance(source, Backend):
+        source = load_backend(source)
+    path = path or COMPILED
+
+    entries = []
+    for namespace in NAMESPACES:
+        for key in source.iterate(namespace):
+            value = source.get(namespace, key)
+            if value is not None:
+                entries.append((index_key(namespace, key), pickle.dumps(value, PPROT)))
+    entries.sort()
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(entries)))
+            offset = HEADER.size + RECORD.size * len(entries)
+            for key, data in entries:
+                namespace, key = struct.unpack('>B40s', key)
+                f.write(RECORD.pack(namespace, key, offset, len(data)))
+                offset += len(data)
+            for key, data in entries:
+                f.write(data)
+        os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return len(entries)
+
+def get_map():
+    """
+    Returns the memory map of the compiled cache, opening it the first time it's needed and again if the file was recompiled since. Pages are shared with every other process mapping the file, including forked children.
+
+    :rtype: mmap.mmap
+    """
+    global MAP_
+    global MAP_STAT_
+    try:
+        stat = os.stat(COMPILED)
+        stat = (stat.st_ino, stat.st_mtime, stat.st_size)
+    except OSError:
+        raise Exception("No compiled cache at {0}. Compile one with caliendo.db.compiled.compile_cache().".format(COMPILED))
+
+    if MAP_ is None or stat != MAP_STAT_:
+        with open(COMPILED, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = HEADER.unpack_from(m, 0)
+        if magic != MAGIC:
+            m.close()
+            raise Exception("{0} isn't a compiled caliendo cache.".format(COMPILED))
+        if MAP_ is not None:
+            MAP_.close()
+        MAP_ = m
+        MAP_STAT_ = stat
+    return MAP_
+
+def count_entries(m):
+    return HEADER.unpack_from(m, 0)[1]
+
+def find(m, key):
+    """
+    Binary searches the index for an entry.
+
+    :param mmap.mmap m: The compiled cache
+    :param str key: The index key of the entry. See index_key.
+
+    :rtype: tuple(int, int)
+    :returns: The offset and length of the entry's data, or None if it isn't there.
+    """
+    lo, hi = 0, count_entries(m)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = HEADER.size + mid * RECORD.size
+        found = m[start:start + KEY_LENGTH]
+        if found < key:
+            lo = mid + 1
+        elif found > key:
+            hi = mid
+        else:
+            return RECORD.unpack_from(m, start)[2:]
+    return None
+
+def read_entry(namespace, key):
+    """
+    Reads a single entry from the compiled cache. It costs a binary search of the index and one unpickling of the entry's data.
+
+    :param str namespace: One of 'cache', 'evs', 'seeds', or 'stacks'
+    :param str key: The hash (or stack key) of the entry
+
+    :rtype: mixed
+    """
+    return read_indexed(index_key(namespace, key))
+
+def read_indexed(key):
+    """
+    Reads a single entry from the compiled cache by its index key.
+
+    :param str key: The index key of the entry. See index_key.
+
+    :rtype: mixed
+    """
+    m = get_map()
+    location = find(m, key)
+    if location:
+        offset, length = location
+        return pickle.loads(buffer(m, offset, length)) # Unpickled straight out of the map, without copying it to a string first.
+
+def list_entries(namespace):
+    """
+    Lists the keys of all the entries in a namespace. Stacks are listed by the sha1 of their key.
+
+    :param str namespace: One of 'cache', 'evs', 'seeds', or 'stacks'
+
+    :rtype: list(<string>)
+    """
+    m = get_map()
+    n = NAMESPACES.index(namespace)
+    keys = []
+    for i in range(count_entries(m)):
+        ns, key, offset, length = RECORD.unpack_from(m, HEADER.size + i * RECORD.size)
+        if ns == n:
+            keys.append(key.rstrip('\0'))
+    return keys
+
+class CompiledBackend(Backend):
+    """
+    Reads from a cache compiled by compile_cache. Use it for runs that only replay: opening the cache costs the same whatever its size.
+
+    The compiled file is never written. Anything written while it's in use (saved stacks, calls that weren't recorded) is kept in memory for the life of the process.
+
+    """
+    name = 'compiled'
+    max_packet_size = None
+
+    def __init__(self):
+        self.overlay = MemoryBackend()
+        self.deleted = set()
+
+    def get(self, namespace, key):
+        value = self.overlay.get(namespace, key)
+        if value is not None:
+            return value
+        if (namespace, key) not in self.deleted:
+            return read_entry(namespace, key)
+
+    def put(self, namespace, key, value):
+        self.deleted.discard((namespace, key))
+        self.overlay.put(namespace, key, value)
+
+    def delete(self, namespace, key):
+        self.deleted.add((namespace, key))
+        self.overlay.delete(namespace, key)
+
+    def iterate(self, namespace):
+        if namespace == 'stacks':
+            keys = ["{0}.{1}".format(stack.module, stack.caller)
+                    for stack in [read_indexed(struct.pack('>B40s', NAMESPACES.index('stacks'), h)) for h in list_entries('stacks')] if stack]
+        else:
+            keys = list_entries(namespace)
+        keys = [k for k in keys if (namespace, k) not in self.deleted]
+        return keys + [k for k in self.overlay.iterate(namespace) if k not in keys]
+
+    def purge(self):
+        raise Exception("The compiled cache is read-only. Purge the cache it was compiled from and compile it again.")
+
+if __name__ == '__main__':
+    source = sys.argv[1] if len(sys.argv) > 1 else 'flatfiles'
+    print "Compiled {0} entries from {1} into {2}".format(compile_cache(source), source, COMPILED)
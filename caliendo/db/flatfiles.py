@@ -1,10 +1,15 @@
 from __future__ import absolute_import
-import sys
 
 import os
+import atexit
+import tempfile
 import dill as pickle
 
+from caliendo import config
 from caliendo.logger import get_logger
+from caliendo.db.used import LOG_FILEPATH, record_used, read_used, reset_used
+from caliendo.db.backend import Backend, pickle_entry, unpickle_entry
+from caliendo.db.locking import FileLock
 
 logger = get_logger(__name__)
 
@@ -12,35 +17,22 @@ DEFAULT_ROOT = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', '.
 ROOT = os.environ.get('CALIENDO_CACHE_PREFIX', DEFAULT_ROOT)
 CACHE = os.path.join(ROOT, 'cache')
 CACHE_ = None
+CACHE_STAT_ = None
+JOURNAL_ = []
 
 PPROT = pickle.HIGHEST_PROTOCOL
 
 LOCKFILE = os.path.join(ROOT, 'lock')
-LOG_FILEPATH = os.path.join(ROOT, 'used')
-
-def record_used(kind, hash):
-    """
-    Indicates a cachefile with the name 'hash' of a particular kind has been used so it will note be deleted on the next purge.
-
-    :param str kind: The kind of cachefile. One of 'cache', 'seeds', or 'evs'
-    :param str hash: The hash for the call descriptor, expected value descriptor, or counter seed.
-
-    :rtype: None
-    """
-    if os.path.exists(LOG_FILEPATH):
-        log = open(os.path.join(ROOT, 'used'), 'a')
-    else:
-        log = open(os.path.join(ROOT, 'used'), 'w+')
-
-    log.writelines(["%s...%s\n" % (kind, hash)])
 
+UMASK = os.umask(0)
+os.umask(UMASK)
 
 def get_packets(cache_type):
-    load_cache(True)
+    load_cache()
     global CACHE_
     packets   = {}
     all_cached = CACHE_[cache_type]
-    for hash, all_packets in all_cached:
+    for hash, all_packets in all_cached.items():
         packets[hash] = len(all_packets)
     return packets
 
@@ -53,12 +45,10 @@ def delete_io( hash ):
     :rtype int: The number of records deleted
     """
     global CACHE_
-    load_cache(True)
+    load_cache()
     record_used('cache', hash)
     num_deleted = len(CACHE_['cache'].get(hash, []))
-    if hash in CACHE_['cache']:
-        del CACHE_['cache'][hash]
-    write_out()
+    journal(('delete', 'cache', hash))
     return num_deleted
 
 def insert_io( args ):
@@ -73,11 +63,7 @@ def insert_io( args ):
     load_cache()
     hash = args['hash']
     record_used('cache', hash)
-    packet_num = args['packet_num']
-    if hash not in CACHE_['cache']:
-        CACHE_['cache'][hash] = {}
-    CACHE_['cache'][hash][packet_num] = pickle.dumps(args, PPROT)
-    write_out()
+    journal(('set_packet', 'cache', hash, args['packet_num'], pickle.dumps(args, PPROT)))
 
 def select_io( hash ):
     """
@@ -87,7 +73,7 @@ def select_io( hash ):
 
     :rtype list(tuple( hash, stack, methodname, returnval, args, packet_num )):
     """
-    load_cache(True)
+    load_cache()
     global CACHE_
     res = []
     record_used('cache', hash)
@@ -97,7 +83,7 @@ def select_io( hash ):
     return res
 
 def select_expected_value(hash):
-    load_cache(True)
+    load_cache()
     global CACHE_
     if not hash:
         return []
@@ -118,10 +104,7 @@ def insert_expected_value(packet):
     load_cache()
     hash = packet['call_hash']
     record_used('evs', hash)
-    if hash not in CACHE_['evs']:
-        CACHE_['evs'][hash] = []
-    CACHE_['evs'][hash].append(pickle.dumps(packet, PPROT))
-    write_out()
+    journal(('append', 'evs', hash, pickle.dumps(packet, PPROT)))
 
 def insert_test( hash, random, seq ):
     """
@@ -136,8 +119,7 @@ def insert_test( hash, random, seq ):
     global CACHE_
     load_cache()
     record_used('seeds', hash)
-    CACHE_['seeds'][hash] = {'hash': hash, 'random': random, 'seq': seq}
-    write_out()
+    journal(('set', 'seeds', hash, {'hash': hash, 'random': random, 'seq': seq}))
 
 def select_test( hash ):
     """
@@ -147,7 +129,7 @@ def select_test( hash ):
 
     :rtype [tuple(<string>, <string>)]:
     """
-    load_cache(True)
+    load_cache()
     global CACHE_
     record_used('seeds', hash)
     d = CACHE_['seeds'].get(hash, {})
@@ -157,6 +139,28 @@ def select_test( hash ):
     else:
         return None
 
+def insert_tests(seeds):
+    """
+    Inserts the seeds for many local call counters, writing the cache once
+
+    :param list(tuple) seeds: (hash, random, seq) for each counter
+
+    :rtype None:
+    """
+    load_cache()
+    for i, (hash, random, seq) in enumerate(seeds):
+        record_used('seeds', hash)
+        journal(('set', 'seeds', hash, {'hash': hash, 'random': random, 'seq': seq}), write=i == len(seeds) - 1)
+
+def select_tests():
+    """
+    Returns the seed values for every function call
+
+    :rtype dict: (random, seq) by hash
+    """
+    load_cache()
+    return dict([(hash, (d.get('random', None), d.get('seq', None))) for hash, d in CACHE_['seeds'].items()])
+
 
 def get_unique_hashes():
     """
@@ -164,7 +168,7 @@ def get_unique_hashes():
 
     :rtype list(<string>)
     """
-    load_cache(True)
+    load_cache()
     global CACHE_
     return CACHE_['cache'].keys()
 
@@ -177,30 +181,12 @@ def delete_from_directory_by_hashes(cache_type, hashes):
 
     """
     global CACHE_
+    load_cache()
     if hashes == '*':
-        CACHE_[cache_type] = {}
+        hashes = CACHE_[cache_type].keys()
     for h in hashes:
-        if h in CACHE_[cache_type]:
-            del CACHE_[cache_type][h]
-    write_out()
-
-def read_used():
-    """
-    Read all hashes that have been used since the last call to purge (or reset_hashes).
-
-    :rtype: dict
-    :returns: A dictionary of sets of hashes organized by type
-    """
-    used_hashes = {"evs": set([]),
-                   "cache": set([]),
-                   "seeds": set([])}
-
-    with open(LOG_FILEPATH, 'rb') as logfile:
-        for line in logfile.readlines():
-            kind, hash = tuple(line.split('...'))
-            used_hashes[kind].add(hash.rstrip())
-
-    return used_hashes
+        journal(('delete', cache_type, h), write=False)
+    flush()
 
 def read_all():
     """
@@ -210,7 +196,7 @@ def read_all():
     :returns: A dictionary of sets of hashes by type
     """
     global CACHE_
-    load_cache(True)
+    load_cache()
     evs = CACHE_['evs'].keys()
     cache = CACHE_['cache'].keys()
     seeds = CACHE_['seeds'].keys()
@@ -218,14 +204,6 @@ def read_all():
             "cache": cache,
             "seeds": seeds}
 
-def reset_used():
-    """
-    Deletes all the records of which hashes have been used since the last call to this method.
-
-    """
-    with open(LOG_FILEPATH, 'w+') as logfile:
-        pass
-
 def purge():
     """
     Deletes all the cached files since the last call to reset_used that have not been used.
@@ -239,7 +217,7 @@ def purge():
         delete_from_directory_by_hashes(kind, to_remove)
 
     reset_used()
-    write_out()
+    flush()
 
 def save_stack(stack):
     """
@@ -249,9 +227,9 @@ def save_stack(stack):
 
     """
     global CACHE_
+    load_cache()
     serialized = pickle.dumps(stack, PPROT)
-    CACHE_['stacks']["{0}.{1}".format(stack.module, stack.caller)] = serialized
-    write_out()
+    journal(('set', 'stacks', "{0}.{1}".format(stack.module, stack.caller), serialized))
 
 def load_stack(stack):
     """
@@ -264,7 +242,7 @@ def load_stack(stack):
 
     """
     global CACHE_
-    load_cache(True)
+    load_cache()
     key = "{0}.{1}".format(stack.module, stack.caller)
     if key in CACHE_['stacks']:
         return pickle.loads(CACHE_['stacks'][key])
@@ -276,31 +254,108 @@ def delete_stack(stack):
     :param caliendo.hooks.CallStack stack: The stack to delete.
     """
     global CACHE_
+    load_cache()
     key = "{0}.{1}".format(stack.module, stack.caller)
     if key in CACHE_['stacks']:
-        del CACHE_['stacks'][key]
+        journal(('delete', 'stacks', key))
+
+def apply_change(cache, change):
+    """
+    Applies a journaled change to a cache dictionary.
+
+    :param dict cache: The cache to modify. Has the keys 'seeds', 'evs', 'stacks', and 'cache'
+    :param tuple change: The change. One of ('set', kind, key, value), ('set_packet', kind, key, packet_num, value), ('append', kind, key, value), or ('delete', kind, key)
+
+    """
+    op, kind, key = change[0:3]
+    if op == 'set':
+        cache[kind][key] = change[3]
+    elif op == 'set_packet':
+        cache[kind].setdefault(key, {})[change[3]] = change[4]
+    elif op == 'append':
+        cache[kind].setdefault(key, []).append(change[3])
+    elif op == 'delete':
+        cache[kind].pop(key, None)
+
+def journal(change, write=True):
+    """
+    Records a change to the cache. The change is visible to reads in this process immediately. It's written to disk right away unless write-behind is enabled, in which case it's written when the journal is flushed or grows past CALIENDO_WRITE_BEHIND_THRESHOLD changes.
+
+    :param tuple change: The change. See apply_change.
+    :param bool write: Whether the journal may be written out after this change.
+
+    """
+    global CACHE_
+    JOURNAL_.append(change)
+    apply_change(CACHE_, change)
+    if write and (not config.CALIENDO_WRITE_BEHIND or len(JOURNAL_) >= config.CALIENDO_WRITE_BEHIND_THRESHOLD):
+        write_out()
+
+def flush():
+    """
+    Writes any journaled changes to disk in a single write.
+
+    """
+    if JOURNAL_:
         write_out()
 
 def write_out():
+    """
+    Writes the cache, with any journaled changes, to disk. Writers hold an exclusive lock while they merge with what other processes wrote and write the result out. The cache is written to a temporary file and renamed into place, so readers never wait on the lock or see a partial write.
+
+    """
     global CACHE_
-    import time
+    global CACHE_STAT_
     try:
-        while os.path.exists(LOCKFILE):
-            sys.stderr.write("Waiting on lock...\n")
-            time.sleep(0.01)
-
-        with open(LOCKFILE, 'w+') as lock:
-            with open(CACHE, 'w+') as f:
-                pickle.dump(CACHE_, f, pickle.HIGHEST_PROTOCOL)
+        with FileLock(LOCKFILE):
+            load_cache() # Merge with whatever other processes wrote since we last read.
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(CACHE), prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(CACHE_, f, pickle.HIGHEST_PROTOCOL)
+                    f.flush()
+                    stat = get_stat(os.fstat(f.fileno()))
+                os.chmod(tmp, 0666 & ~UMASK) # mkstemp only gives the owner access.
+                os.rename(tmp, CACHE)
+            except:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                raise
+            CACHE_STAT_ = stat
+            del JOURNAL_[:]
     finally:
-        if os.path.exists(LOCKFILE):
-            os.unlink(LOCKFILE)
-        load_cache(True)
+        load_cache()
+
+def get_stat(stat=None):
+    """
+    Returns the signature used to tell whether the cache file changed since it was last read.
+
+    :param posix.stat_result stat: The stat of the cache file if it's already known.
+
+    :rtype: tuple(<float>, <int>, <int>) or None if there is no cache file.
+    """
+    if not stat:
+        try:
+            stat = os.stat(CACHE)
+        except OSError:
+            return None
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
 
 def load_cache(reload=False):
+    """
+    Loads the cache file into CACHE_. The file is only read again when its mtime, size, or inode changed since it was last read or written by this process.
+
+    :param bool reload: Read the file even if it appears unchanged.
+
+    """
     global CACHE_
+    global CACHE_STAT_
+
+    stat = get_stat()
+    if CACHE_ is not None and stat == CACHE_STAT_ and not reload:
+        return
 
-    if os.path.exists(CACHE):
+    if stat:
         with open(CACHE, 'rb') as f:
             CACHE_ = pickle.load(f)
     else:
@@ -308,6 +363,58 @@ def load_cache(reload=False):
                   'evs': {},
                   'stacks': {},
                   'cache': {}}
+    CACHE_STAT_ = stat
+
+    for change in JOURNAL_: # Pending writes stay visible on top of what's on disk.
+        apply_change(CACHE_, change)
+
+class FlatfilesBackend(Backend):
+    """
+    Keeps the whole cache in a single pickled file. See the module level functions.
+
+    """
+    name = 'flatfiles'
+    max_packet_size = None
+
+    def get(self, namespace, key):
+        load_cache()
+        return unpickle_entry(namespace, CACHE_[namespace].get(key))
+
+    def put(self, namespace, key, value):
+        load_cache()
+        journal(('set', namespace, key, pickle_entry(namespace, value)))
+
+    def delete(self, namespace, key):
+        load_cache()
+        if key in CACHE_[namespace]:
+            journal(('delete', namespace, key))
+
+    def iterate(self, namespace):
+        load_cache()
+        return CACHE_[namespace].keys()
+
+    flush = staticmethod(flush)
+    get_packets = staticmethod(get_packets)
+    delete_io = staticmethod(delete_io)
+    insert_io = staticmethod(insert_io)
+    select_io = staticmethod(select_io)
+    select_expected_value = staticmethod(select_expected_value)
+    delete_expected_value = staticmethod(delete_expected_value)
+    insert_expected_value = staticmethod(insert_expected_value)
+    insert_test = staticmethod(insert_test)
+    select_test = staticmethod(select_test)
+    insert_tests = staticmethod(insert_tests)
+    select_tests = staticmethod(select_tests)
+    get_unique_hashes = staticmethod(get_unique_hashes)
+    delete_from_directory_by_hashes = staticmethod(delete_from_directory_by_hashes)
+    read_all = staticmethod(read_all)
+    purge = staticmethod(purge)
+    save_stack = staticmethod(save_stack)
+    load_stack = staticmethod(load_stack)
+    delete_stack = staticmethod(delete_stack)
 
 
 load_cache()
+
+if config.CALIENDO_WRITE_BEHIND:
+    atexit.register(flush)
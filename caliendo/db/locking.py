@@ -0,0 +1,85 @@
+from __future__ import absolute_import
+
+import os
+import time
+import fcntl
+
+from caliendo import config
+from caliendo.logger import get_logger
+
+logger = get_logger(__name__)
+
+POLL_INTERVAL = 0.001
+MAX_POLL_INTERVAL = 0.05
+
+class FileLock(object):
+    """
+    A cross-process lock on a file using fcntl.flock. Shared locks can be held by many processes at once, exclusive locks by one process and only while no shared lock is held.
+
+    The kernel releases the lock when the holder closes the file or dies, so a crashed process can't leave a stale lock behind. The lock file itself is never deleted, since unlinking it would let two processes lock different files by the same name.
+
+    """
+    def __init__(self, path, shared=False, timeout=None):
+        """
+        :param str path: The path to the lock file. It's created if it doesn't exist.
+        :param bool shared: Take a shared lock instead of an exclusive one.
+        :param float timeout: Seconds to wait for the lock before giving up. Defaults to CALIENDO_LOCK_TIMEOUT.
+
+        """
+        self.path = path
+        self.shared = shared
+        self.timeout = config.CALIENDO_LOCK_TIMEOUT if timeout is None else timeout
+        self.fd = None
+
+    def acquire(self):
+        """
+        Waits for the lock, backing off up to MAX_POLL_INTERVAL between attempts.
+
+        :raises Exception: If the lock couldn't be acquired within the timeout.
+
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0666)
+        operation = (fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX) | fcntl.LOCK_NB
+        deadline = time.time() + self.timeout
+        interval = POLL_INTERVAL
+        while True:
+            try:
+                fcntl.flock(fd, operation)
+                break
+            except IOError:
+                if time.time() >= deadline:
+                    holder = self.holder()
+                    os.close(fd)
+                    raise Exception("Timed out after {0} seconds waiting for the lock on {1}, last held exclusively by pid {2}".format(self.timeout, self.path, holder))
+                time.sleep(interval)
+                interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+        if not self.shared:
+            os.ftruncate(fd, 0)
+            os.write(fd, str(os.getpid()))
+        self.fd = fd
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def holder(self):
+        """
+        Returns the pid of the last process to hold the lock exclusively, for diagnostics.
+
+        :rtype: str
+        """
+        try:
+            with open(self.path) as f:
+                return f.read().strip() or None
+        except IOError:
+            return None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -0,0 +1,411 @@
+from __future__ import absolute_import
+
+import os
+import struct
+import tempfile
+import threading
+from zlib import crc32
+
+import dill as pickle
+
+from caliendo import config
+from caliendo.logger import get_logger
+from caliendo.db.backend import Backend, NAMESPACES, PPROT
+from caliendo.db.locking import FileLock
+
+logger = get_logger(__name__)
+
+DEFAULT_ROOT = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', '..')
+ROOT = os.environ.get('CALIENDO_CACHE_PREFIX', DEFAULT_ROOT)
+LOGDIR = os.path.join(ROOT, 'log')
+
+MARKER = 'CL'
+HEADER = struct.Struct('>2sBBHII') # marker, op, namespace, key length, value length, crc32 of key and value
+PUT = 1
+DELETE = 2
+
+COMPACT_RATIO = 0.5 # Compact in the background once this fraction of the sealed segments is dead.
+
+INDEX_ = None      # {namespace: {key: (segment, offset, length)}}
+SEGMENTS_ = []     # The live segments this process has indexed, oldest first.
+POSITION_ = 0      # How far into the last of SEGMENTS_ this process has indexed.
+DIR_STAT_ = None
+PID_ = None
+FILES_ = {}
+APPEND_ = None     # (segment, fd) of the segment this process appends to.
+COMPACTION_ = None # The background compaction thread.
+
+def segment_name(seq, generation):
+    return "%010d-%04d.seg" % (seq, generation)
+
+def parse_segment_name(name):
+    seq, generation = name[:-len('.seg')].split('-')
+    return int(seq), int(generation)
+
+def get_path(name):
+    return os.path.join(LOGDIR, name)
+
+def get_lock(shared=False):
+    if not os.path.exists(LOGDIR):
+        try:
+            os.makedirs(LOGDIR)
+        except OSError:
+            if not os.path.isdir(LOGDIR):
+                raise
+    return FileLock(os.path.join(LOGDIR, 'lock'), shared=shared)
+
+def list_segments():
+    """
+    Lists the live segments, oldest first. A compacted segment supersedes every segment up to its sequence number with a lower generation, so those are left out even if the compaction that replaced them hasn't deleted them yet.
+
+    :rtype: list(<string>)
+    """
+    names = [n for n in os.listdir(LOGDIR) if n.endswith('.seg') and not n.startswith('.')]
+    segments = sorted([parse_segment_name(n) for n in names])
+    live = []
+    for seq, generation in segments:
+        if not [s for s, g in segments if s >= seq and g > generation]:
+            live.append(segment_name(seq, generation))
+    return live
+
+def apply_record(index, op, namespace, key, location):
+    if op == PUT:
+        index[namespace][key] = location
+    else:
+        index[namespace].pop(key, None)
+
+def scan(name, start=0, index=None, records=None, path=None):
+    """
+    Reads the records in a segment from an offset, adding them to an index. Corrupt records (left by a crash mid-write) are skipped, and an incomplete record at the end of the segment is left for the next scan since it may still be being written.
+
+    :param str name: The segment
+    :param int start: The offset to start reading at
+    :param dict index: The index to add the records to
+    :param list records: If given, (op, namespace, key, offset, length) is appended for each record.
+    :param str path: Where the segment is, if it isn't in place yet.
+
+    :rtype: int
+    :returns: The offset of the end of the last complete record
+    """
+    with open(path or get_path(name), 'rb') as f:
+        f.seek(start)
+        data = f.read()
+
+    pos = 0
+    while pos + HEADER.size <= len(data):
+        marker, op, ns, key_length, value_length, crc = HEADER.unpack_from(data, pos)
+        key_start = pos + HEADER.size
+        end = key_start + key_length + value_length
+        if marker != MARKER or (end <= len(data) and crc32(data[key_start:end]) & 0xffffffff != crc):
+            logger.warning("Skipping a corrupt record at {0} in {1}".format(start + pos, name))
+            found = data.find(MARKER, pos + 1)
+            pos = found if found != -1 else len(data)
+            continue
+        if end > len(data):
+            break
+        key = data[key_start:key_start + key_length]
+        location = (name, start + key_start + key_length, value_length)
+        if index is not None:
+            apply_record(index, op, NAMESPACES[ns], key, location)
+        if records is not None:
+            records.append((op, ns, key, location[1], location[2]))
+        pos = end
+    return start + pos
+
+def load_segment(name, index):
+    """
+    Adds a whole segment to an index, from its hint file if it has one.
+
+    :param str name: The segment
+    :param dict index: The index to add its records to
+
+    :rtype: int
+    :returns: The offset of the end of the last complete record
+    """
+    try:
+        with open(get_path(name) + '.idx', 'rb') as f:
+            hints = pickle.load(f)
+    except (IOError, EOFError):
+        return scan(name, 0, index)
+    for op, ns, key, offset, length in hints['records']:
+        apply_record(index, op, NAMESPACES[ns], key, (name, offset, length))
+    return scan(name, hints['size'], index)
+
+def write_hints(name, path=None):
+    """
+    Writes the hint file for a sealed segment: every record's key and location, so the segment can be indexed without reading it.
+
+    :param str name: The segment
+    :param str path: Where the segment is, if it isn't in place yet.
+
+    """
+    records = []
+    size = scan(name, 0, None, records, path)
+    fd, tmp = tempfile.mkstemp(dir=LOGDIR, prefix='.tmp-')
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump({'size': size, 'records': records}, f, PPROT)
+    os.rename(tmp, get_path(name) + '.idx')
+
+def build_index(segments):
+    index = dict([(namespace, {}) for namespace in NAMESPACES])
+    position = 0
+    for name in segments:
+        position = load_segment(name, index)
+    return index, position
+
+def refresh():
+    """
+    Brings this process's index up to date with what's on disk. New records at the end of the active segment are scanned, and the index is rebuilt from the segments (and their hint files) when segments were added or compacted.
+
+    """
+    global INDEX_
+    global SEGMENTS_
+    global POSITION_
+    global DIR_STAT_
+    global PID_
+    global FILES_
+    global APPEND_
+
+    if PID_ != os.getpid(): # File positions are shared with the parent after a fork.
+        FILES_ = {}
+        APPEND_ = None
+        PID_ = os.getpid()
+
+    try:
+        stat = os.stat(LOGDIR)
+    except OSError: # Nothing has been written yet.
+        INDEX_ = dict([(namespace, {}) for namespace in NAMESPACES])
+        SEGMENTS_ = []
+        POSITION_ = 0
+        DIR_STAT_ = None
+        return
+
+    stat = (stat.st_mtime, stat.st_ino)
+    if INDEX_ is not None and stat == DIR_STAT_:
+        try:
+            if SEGMENTS_ and os.path.getsize(get_path(SEGMENTS_[-1])) > POSITION_:
+                POSITION_ = scan(SEGMENTS_[-1], POSITION_, INDEX_)
+            return
+        except EnvironmentError: # Sealed and compacted away since the directory was last listed.
+            pass
+
+    while True:
+        segments = list_segments()
+        try:
+            if INDEX_ is not None and SEGMENTS_ and segments[:len(SEGMENTS_)] == SEGMENTS_:
+                POSITION_ = scan(SEGMENTS_[-1], POSITION_, INDEX_)
+                for name in segments[len(SEGMENTS_):]:
+                    POSITION_ = load_segment(name, INDEX_)
+            else:
+                INDEX_, POSITION_ = build_index(segments)
+                FILES_ = {}
+            break
+        except EnvironmentError: # A compaction removed segments while they were being read.
+            INDEX_ = None
+    SEGMENTS_ = segments
+    DIR_STAT_ = stat
+
+def append(op, namespace, key, value=None):
+    """
+    Appends a record to the active segment with a single write. Appending holds a shared lock so segments aren't sealed out from under it.
+
+    :param int op: PUT or DELETE
+    :param str namespace: One of 'cache', 'evs', 'seeds', or 'stacks'
+    :param str key: The hash (or stack key) of the entry
+    :param mixed value: The entry, for a PUT
+
+    """
+    global APPEND_
+    global DIR_STAT_
+    global COMPACTION_
+    data = pickle.dumps(value, PPROT) if op == PUT else ''
+    record = HEADER.pack(MARKER, op, NAMESPACES.index(namespace), len(key), len(data), crc32(key + data) & 0xffffffff) + key + data
+
+    with get_lock(shared=True):
+        refresh()
+        if not SEGMENTS_:
+            open(get_path(segment_name(1, 0)), 'ab').close()
+            refresh()
+        active = SEGMENTS_[-1]
+        if os.path.exists(get_path(segment_name(parse_segment_name(active)[0] + 1, 0))): # Sealed too recently to change the directory's mtime.
+            DIR_STAT_ = None
+            refresh()
+            active = SEGMENTS_[-1]
+        if APPEND_ is None or APPEND_[0] != active:
+            if APPEND_ is not None:
+                os.close(APPEND_[1])
+            APPEND_ = (active, os.open(get_path(active), os.O_WRONLY | os.O_APPEND))
+        os.write(APPEND_[1], record)
+        refresh()
+        full = POSITION_ >= config.CALIENDO_LOG_SEGMENT_SIZE
+
+    if full:
+        roll_over()
+        refresh()
+        if (COMPACTION_ is None or not COMPACTION_.is_alive()) and get_dead_ratio(SEGMENTS_[:-1]) >= COMPACT_RATIO:
+            COMPACTION_ = threading.Thread(target=compact, kwargs={'block': False})
+            COMPACTION_.daemon = True
+            COMPACTION_.start()
+
+def roll_over(force=False):
+    """
+    Seals the active segment, writing its hint file, and starts a new one.
+
+    :param bool force: Seal the active segment even if it isn't full.
+
+    :rtype: list(<string>)
+    :returns: The sealed segments
+    """
+    with get_lock():
+        segments = list_segments()
+        if segments and (force or os.path.getsize(get_path(segments[-1])) >= config.CALIENDO_LOG_SEGMENT_SIZE):
+            active = segments[-1]
+            write_hints(active)
+            segments.append(segment_name(parse_segment_name(active)[0] + 1, 0))
+            open(get_path(segments[-1]), 'ab').close()
+        return segments[:-1]
+
+def get_dead_ratio(segments):
+    """
+    Returns the fraction of the bytes in some segments that belong to records that have since been replaced or deleted.
+
+    :param list(str) segments: The segments
+
+    :rtype: float
+    """
+    try:
+        total = sum([os.path.getsize(get_path(name)) for name in segments])
+    except OSError: # Being compacted already
+        return 0.0
+    if not total:
+        return 0.0
+    segments = set(segments)
+    live = sum([length + HEADER.size + len(key)
+                for namespace in NAMESPACES
+                for key, (name, offset, length) in INDEX_[namespace].items() if name in segments])
+    return 1 - float(live) / total
+
+def compact(keep=None, block=True):
+    """
+    Merges the sealed segments into one, dropping replaced records, tombstones, and any entry keep rejects. The active segment is sealed first so everything written before the call is compacted. Other processes keep reading and appending while the merged segment is written.
+
+    :param function keep: Called with the namespace and key of each live entry. Entries it returns False for are dropped.
+    :param bool block: Wait for a compaction already in progress instead of skipping this one.
+
+    :rtype: bool
+    :returns: Whether a compaction was done
+    """
+    if not os.path.exists(LOGDIR):
+        return False
+    lock = FileLock(os.path.join(LOGDIR, 'compact.lock'), timeout=config.CALIENDO_LOCK_TIMEOUT if block else 0)
+    try:
+        lock.acquire()
+    except Exception:
+        if block:
+            raise
+        return False
+
+    try:
+        sealed = roll_over(force=True)
+        if not sealed:
+            return False
+        index = build_index(sealed)[0]
+        seq = max([parse_segment_name(name)[0] for name in sealed])
+        generation = max([parse_segment_name(name)[1] for name in sealed]) + 1
+        name = segment_name(seq, generation)
+
+        fd, tmp = tempfile.mkstemp(dir=LOGDIR, prefix='.tmp-')
+        files = {}
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for ns, namespace in enumerate(NAMESPACES):
+                    for key, (segment, offset, length) in sorted(index[namespace].items()):
+                        if keep and not keep(namespace, key):
+                            continue
+                        if segment not in files:
+                            files[segment] = open(get_path(segment), 'rb')
+                        files[segment].seek(offset)
+                        data = files[segment].read(length)
+                        out.write(HEADER.pack(MARKER, PUT, ns, len(key), len(data), crc32(key + data) & 0xffffffff) + key + data)
+                out.flush()
+                os.fsync(out.fileno())
+        except:
+            os.unlink(tmp)
+            raise
+        finally:
+            for f in files.values():
+                f.close()
+
+        write_hints(name, tmp)
+        os.rename(tmp, get_path(name))
+
+        live = list_segments()
+        for old in [n for n in os.listdir(LOGDIR) if n.endswith('.seg') and not n.startswith('.') and n not in live]:
+            for path in (get_path(old), get_path(old) + '.idx'):
+                if os.path.exists(path):
+                    os.unlink(path)
+        return True
+    finally:
+        lock.release()
+
+def read(namespace, key, retry=True):
+    """
+    Reads the latest value of an entry.
+
+    :param str namespace: One of 'cache', 'evs', 'seeds', or 'stacks'
+    :param str key: The hash (or stack key) of the entry
+    :param bool retry: Whether to index the segments again and retry if the entry's segment was compacted away.
+
+    :rtype: mixed
+    """
+    global DIR_STAT_
+    refresh()
+    location = INDEX_[namespace].get(key)
+    if not location:
+        return None
+    name, offset, length = location
+    try:
+        if name not in FILES_:
+            FILES_[name] = open(get_path(name), 'rb')
+    except IOError:
+        if not retry:
+            raise
+        DIR_STAT_ = None # Compacted away since we last looked.
+        return read(namespace, key, False)
+    f = FILES_[name]
+    f.seek(offset)
+    return pickle.loads(f.read(length))
+
+class LogBackend(Backend):
+    """
+    Keeps the cache in an append-only log of segments. Every write, replacement, or delete appends one record, and an index of where each entry's latest record is lives in memory. Purging compacts the log.
+
+    """
+    name = 'log'
+    max_packet_size = None
+
+    def get(self, namespace, key):
+        return read(namespace, key)
+
+    def put(self, namespace, key, value):
+        append(PUT, namespace, key, value)
+
+    def delete(self, namespace, key):
+        refresh()
+        if key in INDEX_[namespace]:
+            append(DELETE, namespace, key)
+
+    def iterate(self, namespace):
+        refresh()
+        return INDEX_[namespace].keys()
+
+    def purge(self):
+        """
+        Compacts the log, dropping the entries that haven't been used since the last call to reset_used.
+
+        """
+        used = self.read_used()
+        compact(keep=lambda namespace, key: namespace not in used or key in used[namespace])
+        self.reset_used()
+
+    compact = staticmethod(compact)
@@ -0,0 +1,30 @@
+from __future__ import absolute_import
+
+import dill as pickle
+
+from caliendo.db.backend import Backend, NAMESPACES, PPROT
+
+class MemoryBackend(Backend):
+    """
+    Keeps every entry in a dictionary in this process. Nothing is written to disk, so entries are lost when the process exits and aren't shared with forked children.
+
+    """
+    name = 'memory'
+    max_packet_size = None
+
+    def __init__(self):
+        self.store = dict([(namespace, {}) for namespace in NAMESPACES])
+
+    def get(self, namespace, key):
+        value = self.store[namespace].get(key)
+        if value is not None:
+            return pickle.loads(value)
+
+    def put(self, namespace, key, value):
+        self.store[namespace][key] = pickle.dumps(value, PPROT)
+
+    def delete(self, namespace, key):
+        self.store[namespace].pop(key, None)
+
+    def iterate(self, namespace):
+        return self.store[namespace].keys()
@@ -0,0 +1,347 @@
+from __future__ import absolute_import
+
+import os
+import tempfile
+from hashlib import sha1
+
+import dill as pickle
+
+from caliendo.logger import get_logger
+from caliendo.db.used import record_used, read_used, reset_used
+from caliendo.db.backend import Backend, pickle_entry, unpickle_entry
+
+logger = get_logger(__name__)
+
+DEFAULT_ROOT = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', '..')
+ROOT = os.environ.get('CALIENDO_CACHE_PREFIX', DEFAULT_ROOT)
+SHARDS = os.path.join(ROOT, 'shards')
+
+PPROT = pickle.HIGHEST_PROTOCOL
+
+KINDS = ('cache', 'seeds', 'evs', 'stacks')
+PREFIX_LENGTH = 2
+
+def get_path(kind, key):
+    """
+    Returns the path to the file holding a single entry. Entries are sharded into subdirectories by the first characters of their key.
+
+    :param str kind: One of 'cache', 'seeds', 'evs', or 'stacks'
+    :param str key: The hash (or stack key) of the entry
+
+    :rtype: str
+    """
+    if kind == 'stacks':
+        key = sha1(key).hexdigest()
+    return os.path.join(SHARDS, kind, key[:PREFIX_LENGTH], key)
+
+def read_entry(kind, key, default=None):
+    """
+    Reads a single entry from its shard.
+
+    :param str kind: One of 'cache', 'seeds', 'evs', or 'stacks'
+    :param str key: The hash (or stack key) of the entry
+    :param mixed default: The value to return when the entry doesn't exist
+
+    :rtype: mixed
+    """
+    return read_file(get_path(kind, key), default)
+
+def read_file(path, default=None):
+    """
+    Reads the entry in a shard file.
+
+    :param str path: The path to the file
+    :param mixed default: The value to return when the file doesn't exist
+
+    :rtype: mixed
+    """
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, OSError, EOFError):
+        return default
+
+def write_entry(kind, key, value):
+    """
+    Writes a single entry to its shard. The entry is written to a temporary file first and renamed into place so readers never see a partial write.
+
+    :param str kind: One of 'cache', 'seeds', 'evs', or 'stacks'
+    :param str key: The hash (or stack key) of the entry
+    :param mixed value: The value to store
+
+    """
+    path = get_path(kind, key)
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, PPROT)
+        os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+def delete_entry(kind, key):
+    """
+    Deletes a single entry from its shard.
+
+    :param str kind: One of 'cache', 'seeds', 'evs', or 'stacks'
+    :param str key: The hash (or stack key) of the entry
+
+    :rtype: bool
+    :returns: True if an entry was deleted
+    """
+    try:
+        os.unlink(get_path(kind, key))
+        return True
+    except OSError:
+        return False
+
+def list_entries(kind):
+    """
+    Lists the keys of all the entries of a kind.
+
+    :param str kind: One of 'cache', 'seeds', or 'evs'
+
+    :rtype: list(<string>)
+    """
+    keys = []
+    directory = os.path.join(SHARDS, kind)
+    if not os.path.exists(directory):
+        return keys
+    for prefix in os.listdir(directory):
+        shard = os.path.join(directory, prefix)
+        if not os.path.isdir(shard):
+            continue
+        keys += [k for k in os.listdir(shard) if not k.startswith('.tmp-')]
+    return keys
+
+def flush():
+    """
+    Every write goes straight to its own entry's file, so there is nothing to flush.
+
+    """
+    pass
+
+def get_packets(cache_type):
+    return dict([(hash, len(read_entry(cache_type, hash, {}))) for hash in list_entries(cache_type)])
+
+def delete_io( hash ):
+    """
+    Deletes records associated with a particular hash
+
+    :param str hash: The hash
+
+    :rtype int: The number of records deleted
+    """
+    record_used('cache', hash)
+    num_deleted = len(read_entry('cache', hash, {}))
+    delete_entry('cache', hash)
+    return num_deleted
+
+def insert_io( args ):
+    """
+    Inserts a method's i/o into the datastore
+
+    :param dict args: A dictionary of the hash, stack, packet_num, methodname, args, and returnval
+
+    :rtype None:
+    """
+    hash = args['hash']
+    record_used('cache', hash)
+    packets = read_entry('cache', hash, {})
+    packets[args['packet_num']] = pickle.dumps(args, PPROT)
+    write_entry('cache', hash, packets)
+
+def select_io( hash ):
+    """
+    Returns the relevant i/o for a method whose call is characterized by the hash
+
+    :param hash: The hash for the CallDescriptor
+
+    :rtype list(tuple( hash, stack, methodname, returnval, args, packet_num )):
+    """
+    res = []
+    record_used('cache', hash)
+    packets = read_entry('cache', hash, {})
+    for packet_num in sorted(packets.keys()):
+        d = pickle.loads(packets[packet_num])
+        res += [(d['hash'], d['stack'], d['methodname'], d['returnval'], d['args'], d['packet_num'])]
+    return res
+
+def select_expected_value(hash):
+    if not hash:
+        return []
+    res = []
+    record_used('evs', hash)
+    for fr in read_entry('evs', hash, []):
+        fr = pickle.loads(fr)
+        res += [(fr['call_hash'], fr['expected_value'], fr['packet_num'])]
+    return res
+
+def delete_expected_value(hash):
+    delete_entry('evs', hash)
+
+def insert_expected_value(packet):
+    hash = packet['call_hash']
+    record_used('evs', hash)
+    packets = read_entry('evs', hash, [])
+    packets.append(pickle.dumps(packet, PPROT))
+    write_entry('evs', hash, packets)
+
+def insert_test( hash, random, seq ):
+    """
+    Inserts a random value and sequence for a local call counter
+
+    :param str hash: The hash for the call
+    :param str random: A random number for the seed
+    :param str seq: An integer from which to increment on the local call
+
+    :rtype None:
+    """
+    record_used('seeds', hash)
+    write_entry('seeds', hash, {'hash': hash, 'random': random, 'seq': seq})
+
+def select_test( hash ):
+    """
+    Returns the seed values associated with a function call
+
+    :param str hash: The hash for the function call
+
+    :rtype [tuple(<string>, <string>)]:
+    """
+    record_used('seeds', hash)
+    d = read_entry('seeds', hash, {})
+
+    if d:
+        return [( d.get('random', None), d.get('seq', None) )]
+    else:
+        return None
+
+def get_unique_hashes():
+    """
+    Returns all the hashes for cached calls
+
+    :rtype list(<string>)
+    """
+    return list_entries('cache')
+
+def delete_from_directory_by_hashes(cache_type, hashes):
+    """
+    Deletes all cache files corresponding to a list of hashes from a directory
+
+    :param str directory: The type of cache to delete files for.
+    :param list(str) hashes: The hashes to delete the files for
+
+    """
+    if hashes == '*':
+        hashes = list_entries(cache_type)
+    for h in hashes:
+        delete_entry(cache_type, h)
+
+def read_all():
+    """
+    Reads all the hashes and returns them in a dictionary by type
+
+    :rtype: dict
+    :returns: A dictionary of sets of hashes by type
+    """
+    return {"evs"  : list_entries('evs'),
+            "cache": list_entries('cache'),
+            "seeds": list_entries('seeds')}
+
+def purge():
+    """
+    Deletes all the cached files since the last call to reset_used that have not been used.
+
+    """
+    all_hashes = read_all()
+    used_hashes = read_used()
+    for kind, hashes in used_hashes.items():
+        to_remove = set(all_hashes[kind]).difference(hashes)
+        delete_from_directory_by_hashes(kind, to_remove)
+
+    reset_used()
+
+def save_stack(stack):
+    """
+    Saves a stack object to its own file.
+
+    :param caliendo.hooks.CallStack stack: The stack to save.
+
+    """
+    key = "{0}.{1}".format(stack.module, stack.caller)
+    write_entry('stacks', key, pickle.dumps(stack, PPROT))
+
+def load_stack(stack):
+    """
+    Loads the saved state of a CallStack and returns a whole instance given an instance with incomplete state.
+
+    :param caliendo.hooks.CallStack stack: The stack to load
+
+    :returns: A CallStack previously built in the context of a patch call.
+    :rtype: caliendo.hooks.CallStack
+
+    """
+    key = "{0}.{1}".format(stack.module, stack.caller)
+    serialized = read_entry('stacks', key)
+    if serialized:
+        return pickle.loads(serialized)
+
+def delete_stack(stack):
+    """
+    Deletes a stack that was previously saved.
+
+    :param caliendo.hooks.CallStack stack: The stack to delete.
+    """
+    key = "{0}.{1}".format(stack.module, stack.caller)
+    delete_entry('stacks', key)
+
+class ShardedBackend(Backend):
+    """
+    Keeps one file per entry, sharded into subdirectories by hash prefix. See the module level functions.
+
+    """
+    name = 'sharded'
+    max_packet_size = None
+
+    def get(self, namespace, key):
+        return unpickle_entry(namespace, read_entry(namespace, key))
+
+    def put(self, namespace, key, value):
+        write_entry(namespace, key, pickle_entry(namespace, value))
+
+    def delete(self, namespace, key):
+        delete_entry(namespace, key)
+
+    def iterate(self, namespace):
+        if namespace == 'stacks': # Stack files are named by the hash of their key
+            directory = os.path.join(SHARDS, 'stacks')
+            stacks = [unpickle_entry('stacks', read_file(os.path.join(directory, h[:PREFIX_LENGTH], h))) for h in list_entries('stacks')]
+            return ["{0}.{1}".format(stack.module, stack.caller) for stack in stacks if stack]
+        return list_entries(namespace)
+
+    flush = staticmethod(flush)
+    get_packets = staticmethod(get_packets)
+    delete_io = staticmethod(delete_io)
+    insert_io = staticmethod(insert_io)
+    select_io = staticmethod(select_io)
+    select_expected_value = staticmethod(select_expected_value)
+    delete_expected_value = staticmethod(delete_expected_value)
+    insert_expected_value = staticmethod(insert_expected_value)
+    insert_test = staticmethod(insert_test)
+    select_test = staticmethod(select_test)
+    get_unique_hashes = staticmethod(get_unique_hashes)
+    delete_from_directory_by_hashes = staticmethod(delete_from_directory_by_hashes)
+    read_all = staticmethod(read_all)
+    purge = staticmethod(purge)
+    save_stack = staticmethod(save_stack)
+    load_stack = staticmethod(load_stack)
+    delete_stack = staticmethod(delete_stack)
@@ -0,0 +1,373 @@
+from __future__ import absolute_import
+
+import os
+import atexit
+import sqlite3
+
+import dill as pickle
+
+from caliendo import config
+from caliendo.logger import get_logger
+from caliendo.db.used import record_used, read_used, reset_used
+from caliendo.db.backend import Backend
+
+logger = get_logger(__name__)
+
+DEFAULT_ROOT = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', '..')
+ROOT = os.environ.get('CALIENDO_CACHE_PREFIX', DEFAULT_ROOT)
+DATABASE = os.path.join(ROOT, 'cache.sqlite')
+
+PPROT = pickle.HIGHEST_PROTOCOL
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS cache (
+         hash       TEXT    NOT NULL,
+         packet_num INTEGER NOT NULL,
+         stack      BLOB    NOT NULL,
+         methodname BLOB    NOT NULL,
+         returnval  BLOB    NOT NULL,
+         args       BLOB    NOT NULL,
+         PRIMARY KEY (hash, packet_num)
+       )""",
+    """CREATE TABLE IF NOT EXISTS evs (
+         hash           TEXT    NOT NULL,
+         packet_num     INTEGER NOT NULL,
+         expected_value BLOB    NOT NULL
+       )""",
+    "CREATE INDEX IF NOT EXISTS evs_hash ON evs (hash)",
+    """CREATE TABLE IF NOT EXISTS seeds (
+         hash   TEXT PRIMARY KEY,
+         random INTEGER,
+         seq    INTEGER
+       )""",
+    """CREATE TABLE IF NOT EXISTS stacks (
+         key   TEXT PRIMARY KEY,
+         stack BLOB NOT NULL
+       )""",
+]
+
+CONNECTION_ = None
+CONNECTION_PID_ = None
+PENDING_ = 0
+
+def get_connection():
+    """
+    Returns the connection for this process, opening it (and creating the schema) if need be. Connections aren't shared across a fork.
+
+    :rtype: sqlite3.Connection
+    """
+    global CONNECTION_
+    global CONNECTION_PID_
+    global PENDING_
+    if CONNECTION_ is None or CONNECTION_PID_ != os.getpid():
+        CONNECTION_ = sqlite3.connect(DATABASE, timeout=30)
+        CONNECTION_.text_factory = str
+        CONNECTION_.execute("PRAGMA journal_mode=WAL")
+        CONNECTION_.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            CONNECTION_.execute(statement)
+        CONNECTION_.commit()
+        CONNECTION_PID_ = os.getpid()
+        PENDING_ = 0
+    return CONNECTION_
+
+def commit():
+    """
+    Commits the current transaction unless write-behind is enabled, in which case it's committed on flush() or once CALIENDO_WRITE_BEHIND_THRESHOLD changes are pending.
+
+    """
+    global PENDING_
+    PENDING_ += 1
+    if not config.CALIENDO_WRITE_BEHIND or PENDING_ >= config.CALIENDO_WRITE_BEHIND_THRESHOLD:
+        flush()
+
+def flush():
+    """
+    Commits any pending changes.
+
+    """
+    global PENDING_
+    if CONNECTION_ is not None and CONNECTION_PID_ == os.getpid():
+        CONNECTION_.commit()
+    PENDING_ = 0
+
+def get_packets(cache_type):
+    conn = get_connection()
+    return dict(conn.execute("SELECT hash, COUNT(*) FROM {0} GROUP BY hash".format(cache_type)).fetchall())
+
+def delete_io( hash ):
+    """
+    Deletes records associated with a particular hash
+
+    :param str hash: The hash
+
+    :rtype int: The number of records deleted
+    """
+    record_used('cache', hash)
+    num_deleted = get_connection().execute("DELETE FROM cache WHERE hash = ?", (hash,)).rowcount
+    commit()
+    return num_deleted
+
+def insert_io( args ):
+    """
+    Inserts a method's i/o into the datastore
+
+    :param dict args: A dictionary of the hash, stack, packet_num, methodname, args, and returnval
+
+    :rtype None:
+    """
+    record_used('cache', args['hash'])
+    get_connection().execute("INSERT OR REPLACE INTO cache (hash, packet_num, stack, methodname, returnval, args) VALUES (?, ?, ?, ?, ?, ?)",
+                             (args['hash'], args['packet_num'], buffer(args['stack']), buffer(args['methodname']), buffer(args['returnval']), buffer(args['args'])))
+    commit()
+
+def select_io( hash ):
+    """
+    Returns the relevant i/o for a method whose call is characterized by the hash
+
+    :param hash: The hash for the CallDescriptor
+
+    :rtype list(tuple( hash, stack, methodname, returnval, args, packet_num )):
+    """
+    record_used('cache', hash)
+    return read_io(hash)
+
+def read_io(hash):
+    """
+    Reads the i/o for a call like select_io, without recording it as used.
+
+    :param hash: The hash for the CallDescriptor
+
+    :rtype list(tuple( hash, stack, methodname, returnval, args, packet_num )):
+    """
+    rows = get_connection().execute("SELECT hash, stack, methodname, returnval, args, packet_num FROM cache WHERE hash = ? ORDER BY packet_num", (hash,))
+    return [(h, str(stack), str(methodname), str(returnval), str(args), packet_num) for h, stack, methodname, returnval, args, packet_num in rows]
+
+def select_expected_value(hash):
+    if not hash:
+        return []
+    record_used('evs', hash)
+    return read_expected_value(hash)
+
+def read_expected_value(hash):
+    rows = get_connection().execute("SELECT hash, expected_value, packet_num FROM evs WHERE hash = ? ORDER BY rowid", (hash,))
+    return [(h, str(expected_value), packet_num) for h, expected_value, packet_num in rows]
+
+def delete_expected_value(hash):
+    get_connection().execute("DELETE FROM evs WHERE hash = ?", (hash,))
+    commit()
+
+def insert_expected_value(packet):
+    hash = packet['call_hash']
+    record_used('evs', hash)
+    get_connection().execute("INSERT INTO evs (hash, packet_num, expected_value) VALUES (?, ?, ?)",
+                             (hash, packet['packet_num'], buffer(packet['expected_value'])))
+    commit()
+
+def insert_test( hash, random, seq ):
+    """
+    Inserts a random value and sequence for a local call counter
+
+    :param str hash: The hash for the call
+    :param str random: A random number for the seed
+    :param str seq: An integer from which to increment on the local call
+
+    :rtype None:
+    """
+    record_used('seeds', hash)
+    get_connection().execute("INSERT OR REPLACE INTO seeds (hash, random, seq) VALUES (?, ?, ?)", (hash, random, seq))
+    commit()
+
+def select_test( hash ):
+    """
+    Returns the seed values associated with a function call
+
+    :param str hash: The hash for the function call
+
+    :rtype [tuple(<string>, <string>)]:
+    """
+    record_used('seeds', hash)
+    rows = get_connection().execute("SELECT random, seq FROM seeds WHERE hash = ?", (hash,)).fetchall()
+    return rows or None
+
+def insert_tests(seeds):
+    """
+    Inserts the seeds for many local call counters in one transaction
+
+    :param list(tuple) seeds: (hash, random, seq) for each counter
+
+    :rtype None:
+    """
+    for hash, random, seq in seeds:
+        record_used('seeds', hash)
+    get_connection().executemany("INSERT OR REPLACE INTO seeds (hash, random, seq) VALUES (?, ?, ?)", seeds)
+    commit()
+
+def select_tests():
+    """
+    Returns the seed values for every function call
+
+    :rtype dict: (random, seq) by hash
+    """
+    rows = get_connection().execute("SELECT hash, random, seq FROM seeds").fetchall()
+    return dict([(hash, (random, seq)) for hash, random, seq in rows])
+
+def get_unique_hashes():
+    """
+    Returns all the hashes for cached calls
+
+    :rtype list(<string>)
+    """
+    return [h for h, in get_connection().execute("SELECT DISTINCT hash FROM cache")]
+
+def delete_from_directory_by_hashes(cache_type, hashes):
+    """
+    Deletes all the rows corresponding to a list of hashes from a table
+
+    :param str cache_type: The type of cache to delete rows for. One of 'cache', 'seeds', or 'evs'
+    :param list(str) hashes: The hashes to delete the rows for
+
+    """
+    conn = get_connection()
+    if hashes == '*':
+        conn.execute("DELETE FROM {0}".format(cache_type))
+    else:
+        conn.executemany("DELETE FROM {0} WHERE hash = ?".format(cache_type), [(h,) for h in hashes])
+    commit()
+
+def read_all():
+    """
+    Reads all the hashes and returns them in a dictionary by type
+
+    :rtype: dict
+    :returns: A dictionary of sets of hashes by type
+    """
+    conn = get_connection()
+    return dict([(kind, [h for h, in conn.execute("SELECT DISTINCT hash FROM {0}".format(kind))])
+                 for kind in ('evs', 'cache', 'seeds')])
+
+def purge():
+    """
+    Deletes all the cached rows since the last call to reset_used that have not been used.
+
+    """
+    all_hashes = read_all()
+    used_hashes = read_used()
+    for kind, hashes in used_hashes.items():
+        to_remove = set(all_hashes[kind]).difference(hashes)
+        delete_from_directory_by_hashes(kind, to_remove)
+
+    reset_used()
+    flush()
+
+def save_stack(stack):
+    """
+    Saves a stack object to the stacks table.
+
+    :param caliendo.hooks.CallStack stack: The stack to save.
+
+    """
+    key = "{0}.{1}".format(stack.module, stack.caller)
+    get_connection().execute("INSERT OR REPLACE INTO stacks (key, stack) VALUES (?, ?)", (key, buffer(pickle.dumps(stack, PPROT))))
+    commit()
+
+def load_stack(stack):
+    """
+    Loads the saved state of a CallStack and returns a whole instance given an instance with incomplete state.
+
+    :param caliendo.hooks.CallStack stack: The stack to load
+
+    :returns: A CallStack previously built in the context of a patch call.
+    :rtype: caliendo.hooks.CallStack
+
+    """
+    key = "{0}.{1}".format(stack.module, stack.caller)
+    row = get_connection().execute("SELECT stack FROM stacks WHERE key = ?", (key,)).fetchone()
+    if row:
+        return pickle.loads(str(row[0]))
+
+def delete_stack(stack):
+    """
+    Deletes a stack that was previously saved.
+
+    :param caliendo.hooks.CallStack stack: The stack to delete.
+    """
+    key = "{0}.{1}".format(stack.module, stack.caller)
+    get_connection().execute("DELETE FROM stacks WHERE key = ?", (key,))
+    commit()
+
+class SqliteBackend(Backend):
+    """
+    Keeps the cache in an SQLite database in WAL mode. See the module level functions.
+
+    """
+    name = 'sqlite'
+    max_packet_size = None
+
+    def get(self, namespace, key):
+        conn = get_connection()
+        if namespace == 'cache':
+            rows = read_io(key)
+            if rows:
+                return dict([(packet_num, {'hash': h, 'stack': stack, 'methodname': methodname, 'returnval': returnval, 'args': args, 'packet_num': packet_num})
+                             for h, stack, methodname, returnval, args, packet_num in rows])
+        elif namespace == 'evs':
+            rows = read_expected_value(key)
+            if rows:
+                return [{'call_hash': h, 'expected_value': expected_value, 'packet_num': packet_num} for h, expected_value, packet_num in rows]
+        elif namespace == 'seeds':
+            row = conn.execute("SELECT random, seq FROM seeds WHERE hash = ?", (key,)).fetchone()
+            if row:
+                return {'hash': key, 'random': row[0], 'seq': row[1]}
+        elif namespace == 'stacks':
+            row = conn.execute("SELECT stack FROM stacks WHERE key = ?", (key,)).fetchone()
+            if row:
+                return pickle.loads(str(row[0]))
+
+    def put(self, namespace, key, value):
+        conn = get_connection()
+        if namespace == 'cache':
+            conn.execute("DELETE FROM cache WHERE hash = ?", (key,))
+            for packet in value.values():
+                insert_io(dict(packet, hash=key))
+        elif namespace == 'evs':
+            conn.execute("DELETE FROM evs WHERE hash = ?", (key,))
+            for packet in value:
+                insert_expected_value(dict(packet, call_hash=key))
+        elif namespace == 'seeds':
+            conn.execute("INSERT OR REPLACE INTO seeds (hash, random, seq) VALUES (?, ?, ?)", (key, value.get('random'), value.get('seq')))
+            commit()
+        elif namespace == 'stacks':
+            conn.execute("INSERT OR REPLACE INTO stacks (key, stack) VALUES (?, ?)", (key, buffer(pickle.dumps(value, PPROT))))
+            commit()
+
+    def delete(self, namespace, key):
+        column = 'key' if namespace == 'stacks' else 'hash'
+        get_connection().execute("DELETE FROM {0} WHERE {1} = ?".format(namespace, column), (key,))
+        commit()
+
+    def iterate(self, namespace):
+        column = 'key' if namespace == 'stacks' else 'hash'
+        return [k for k, in get_connection().execute("SELECT DISTINCT {0} FROM {1}".format(column, namespace))]
+
+    flush = staticmethod(flush)
+    get_packets = staticmethod(get_packets)
+    delete_io = staticmethod(delete_io)
+    insert_io = staticmethod(insert_io)
+    select_io = staticmethod(select_io)
+    select_expected_value = staticmethod(select_expected_value)
+    delete_expected_value = staticmethod(delete_expected_value)
+    insert_expected_value = staticmethod(insert_expected_value)
+    insert_test = staticmethod(insert_test)
+    select_test = staticmethod(select_test)
+    insert_tests = staticmethod(insert_tests)
+    select_tests = staticmethod(select_tests)
+    get_unique_hashes = staticmethod(get_unique_hashes)
+    delete_from_directory_by_hashes = staticmethod(delete_from_directory_by_hashes)
+    read_all = staticmethod(read_all)
+    purge = staticmethod(purge)
+    save_stack = staticmethod(save_stack)
+    load_stack = staticmethod(load_stack)
+    delete_stack = staticmethod(delete_stack)
+
+atexit.register(flush)
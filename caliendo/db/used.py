@@ -0,0 +1,132 @@
+import os
+import atexit
+import tempfile
+from binascii import hexlify, unhexlify
+
+DEFAULT_ROOT = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..', '..')
+ROOT = os.environ.get('CALIENDO_CACHE_PREFIX', DEFAULT_ROOT)
+
+LOG_FILEPATH = os.path.join(ROOT, 'used') # The text log older versions kept. Still read, never written.
+USED_FILEPATH = os.path.join(ROOT, 'used.bin')
+
+KINDS = ('cache', 'evs', 'seeds')
+RECORD_LENGTH = 21 # The kind's index in KINDS and the sha1 digest.
+GENERATION_LENGTH = 8 # The used file starts with a random token that changes whenever it's reset.
+FLUSH_THRESHOLD = 1000
+
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+SEEN_ = dict([(kind, set()) for kind in KINDS]) # Hashes written to the used file in its current generation
+PENDING_ = dict([(kind, set()) for kind in KINDS]) # Hashes used since the last flush and not in SEEN_
+USED_ = dict([(kind, set()) for kind in KINDS]) # Every hash used since the last flush, to write again if the file was reset in the meantime
+GENERATION_ = None
+
+def record_used(kind, hash):
+    """
+    Indicates a cachefile with the name 'hash' of a particular kind has been used so it will note be deleted on the next purge. Hashes are kept in memory and written out by flush().
+
+    :param str kind: The kind of cachefile. One of 'cache', 'seeds', or 'evs'
+    :param str hash: The hash for the call descriptor, expected value descriptor, or counter seed.
+
+    :rtype: None
+    """
+    USED_[kind].add(hash)
+    if hash in SEEN_[kind]:
+        return
+    SEEN_[kind].add(hash)
+    PENDING_[kind].add(hash)
+    if sum([len(hashes) for hashes in PENDING_.values()]) >= FLUSH_THRESHOLD:
+        flush()
+
+def open_used():
+    """
+    Opens the used file for appending, creating it with a new generation if it doesn't exist.
+
+    :rtype: int
+    :returns: A file descriptor positioned at the generation
+    """
+    while True:
+        if not os.path.exists(USED_FILEPATH):
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(USED_FILEPATH), prefix='.tmp-')
+            os.write(fd, os.urandom(GENERATION_LENGTH))
+            os.close(fd)
+            os.chmod(tmp, 0666 & ~UMASK)
+            try:
+                os.link(tmp, USED_FILEPATH) # Unlike rename, never replaces a file another process just created.
+            except OSError:
+                pass
+            os.unlink(tmp)
+        try:
+            return os.open(USED_FILEPATH, os.O_RDWR | os.O_APPEND)
+        except OSError: # Reset since we looked
+            pass
+
+def flush():
+    """
+    Appends the hashes used since the last flush to the used file in a single write, so processes flushing at the same time don't interleave. Each hash is written once per generation of the file.
+
+    """
+    global GENERATION_
+    if not [kind for kind in KINDS if USED_[kind]]:
+        return
+
+    fd = open_used()
+    try:
+        generation = os.read(fd, GENERATION_LENGTH)
+        if GENERATION_ is not None and generation != GENERATION_: # Reset by another process since the last flush. Anything used since may have been used after it.
+            for kind in KINDS:
+                SEEN_[kind] = set(USED_[kind])
+                PENDING_[kind] = set(USED_[kind])
+        records = "".join([chr(KINDS.index(kind)) + unhexlify(hash) for kind in KINDS for hash in PENDING_[kind]])
+        if records:
+            os.write(fd, records)
+        GENERATION_ = generation
+    finally:
+        os.close(fd)
+    for kind in KINDS:
+        PENDING_[kind].clear()
+        USED_[kind].clear()
+
+def read_used():
+    """
+    Read all hashes that have been used since the last call to purge (or reset_hashes), by every process.
+
+    :rtype: dict
+    :returns: A dictionary of sets of hashes organized by type
+    """
+    flush()
+    used_hashes = {"evs": set([]),
+                   "cache": set([]),
+                   "seeds": set([])}
+
+    if os.path.exists(USED_FILEPATH):
+        with open(USED_FILEPATH, 'rb') as f:
+            data = f.read()
+        for i in xrange(GENERATION_LENGTH, len(data) - RECORD_LENGTH + 1, RECORD_LENGTH):
+            used_hashes[KINDS[ord(data[i])]].add(hexlify(data[i + 1:i + RECORD_LENGTH]))
+
+    if os.path.exists(LOG_FILEPATH):
+        with open(LOG_FILEPATH, 'rb') as logfile:
+            for line in logfile:
+                kind, hash = tuple(line.split('...'))
+                used_hashes[kind].add(hash.rstrip())
+
+    return used_hashes
+
+def reset_used():
+    """
+    Deletes all the records of which hashes have been used since the last call to this method.
+
+    """
+    global GENERATION_
+    for path in (USED_FILEPATH, LOG_FILEPATH):
+        if os.path.exists(path):
+            os.unlink(path)
+    for kind in KINDS:
+        SEEN_[kind].clear()
+        PENDING_[kind].clear()
+        USED_[kind].clear()
+    GENERATION_ = None
+
+atexit.register(flush)
@@ -1,22 +1,21 @@
-import cPickle as pickle
 import sys
 import copy_reg
 import types
-import inspect
 from hashlib import sha1
 
 import caliendo
 from caliendo import config
 from caliendo import pickling
+from caliendo import lru
 from caliendo import util
 from caliendo import prompt
 from caliendo import counter
 
 if config.should_use_caliendo():
-    from caliendo.db.flatfiles import select_expected_value, delete_expected_value, insert_expected_value
+    from caliendo.db import select_expected_value, delete_expected_value, insert_expected_value, get_max_packet_size, record_used
 
 def get_or_store(observed_value):
-    caller = inspect.stack()[2][3]
+    caller = sys._getframe(2).f_code.co_name
     trace_string = util.get_stack(caller)
     counter_value = counter.get_from_trace_for_ev(trace_string)
     call_hash = sha1("%s.%s" % (trace_string,
@@ -49,53 +48,60 @@ def contains(observed_value, el):
 def does_not_contain(observed_value, el):
     return el not in get_or_store(observed_value)
 
+L1_ = lru.LRU(config.CALIENDO_L1_ENTRIES, config.CALIENDO_L1_BYTES) # Call hash -> Decoded expected value
+
 def fetch( call_hash ):
     """
     Fetches CallDescriptor from the local database given a hash key representing the call. If it doesn't exist returns None.
 
+    Decoded expected values are kept in L1_ and copied according to CALIENDO_L1_COPY.
+
     :param str hash: The sha1 hexdigest to look the CallDescriptor up by.
 
     :rtype: CallDescriptor corresponding to the hash passed or None if it wasn't found.
     """
+    decoded = L1_.get(call_hash)
+    if decoded:
+        record_used('evs', call_hash)
+        return ExpectedValue( call_hash      = call_hash,
+                              expected_value = decoded.get(config.CALIENDO_L1_COPY) )
+
     res = select_expected_value(call_hash)
     if not res:
         return None
 
     last_packet_number = -1
-    expected_value = ""
+    expected_value = []
     for packet in res:
-        call_hash, expected_value_fragment, packet_num = packet
-        expected_value += expected_value_fragment
+        hash, expected_value_fragment, packet_num = packet
+        expected_value.append(expected_value_fragment)
         if packet_num <= last_packet_number:
             raise Exception("Received expected_value data out of order!")
 
         last_packet_number = packet_num
 
+    decoded = pickling.Decoded(str("".join(expected_value)))
+    L1_.put(call_hash, decoded, decoded.size)
     return ExpectedValue( call_hash      = call_hash,
-                          expected_value = pickle.loads(str(expected_value)) )
+                          expected_value = decoded.get(config.CALIENDO_L1_COPY) )
 
 class ExpectedValueBuffer:
     def __init__(self, expected_value):
         returnval   = pickling.pickle_with_weak_refs(expected_value)
         self.__data = returnval
         self.length = len(self.__data)
-        self.char   = 0
-
-    def next(self):
-        if self.char + 1 > self.length:
-            raise StopIteration
 
-        c         = self.__data[ self.char ]
-        attr      = self.attr()
-        self.char = self.char + 1
-
-        return c, attr
+    def packets(self, max_packet_size=None):
+        """
+        Splits the pickled expected value into packets of at most max_packet_size characters.
 
-    def __iter__(self):
-        return self
+        :param int max_packet_size: The most characters a packet can hold. None for a single packet.
 
-    def attr(self):
-        return 'expected_value'
+        :rtype: list(dict)
+        """
+        max_packet_size = max_packet_size or self.length
+        return [{'expected_value': self.__data[start:start + max_packet_size]}
+                for start in xrange(0, self.length, max_packet_size)]
 
 class ExpectedValue:
 
@@ -111,20 +117,12 @@ class ExpectedValue:
           }
 
     def __enumerate_packets(self):
-        max_packet_size  = 1024 * 1024 # ~2MB, prolly more like 4MB for 4b char size. MySQL default limit is 16
         buffer           = ExpectedValueBuffer(self.expected_value)
-        packet_num       = 0
         packets          = [ ]
-        while buffer.char < buffer.length:
+        for packet_num, data in enumerate(buffer.packets(get_max_packet_size())):
             p = self.__empty_packet(packet_num)
-            packet_length = 0
-            for char, attr in buffer:
-                p[attr] += char
-                packet_length += 1
-                if packet_length == max_packet_size:
-                    break
+            p.update(data)
             packets.append( p )
-            packet_num += 1
 
         return packets
 
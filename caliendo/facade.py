@@ -5,6 +5,7 @@ import sys
 import inspect
 import importlib
 import types
+import threading
 from contextlib import contextmanager
 import caliendo
 from caliendo import util
@@ -14,11 +15,14 @@ from caliendo import counter
 from caliendo import prompt
 from caliendo.__init__ import UNDEFINED
 from caliendo.hooks import Hook
+from caliendo.hooks import Context
 
 USE_CALIENDO = config.should_use_caliendo()
 
 if USE_CALIENDO:
-    from caliendo.db.flatfiles import delete_io
+    from caliendo.db import delete_io
+
+PLANS_ = {} # (type, exclusion list) -> {attribute name: the Wrapper method that stores it}
 
 def should_exclude(type_or_instance, exclusion_list):
     """
@@ -37,6 +41,34 @@ def should_exclude(type_or_instance, exclusion_list):
 
     return False
 
+def get_plan(o, exclusion_list):
+    """
+    Returns the plan for wrapping an object's attributes: the Wrapper method that stores each of its class's methods and nested classes. Every object of the same type wrapped with the same exclusion list shares a plan, so those attributes are only classified once.
+
+    :param mixed o: The object being wrapped
+    :param list exclusion_list: The list of types NOT to wrap
+
+    :rtype dict:
+    """
+    try:
+        return PLANS_.setdefault((getattr(o, '__class__', type(o)), tuple(exclusion_list)), {})
+    except TypeError: # Unhashable type or exclusion
+        return {}
+
+def is_plannable(o, name):
+    """
+    Tests whether an attribute is stored the same way for every object of its type. That's the case for methods and classes defined on the type that the object doesn't override.
+
+    :param mixed o: The object being wrapped
+    :param str name: The name of the attribute
+
+    :rtype bool:
+    """
+    if name in getattr(o, '__dict__', {}):
+        return False
+    member = getattr(getattr(o, '__class__', type(o)), name, None)
+    return inspect.isroutine(member) or inspect.isclass(member)
+
 def get_hash(args, trace_string, kwargs, ignore=UNDEFINED):
     counter_value = counter.get_from_trace_for_cache(trace_string)
 
@@ -53,6 +85,9 @@ def get_hash(args, trace_string, kwargs, ignore=UNDEFINED):
         args_with_ignores = args
         kwargs_with_ignores = kwargs
 
+    if config.CALIENDO_HASHER == 'stream':
+        return util.hash_args(args_with_ignores, counter_value, kwargs_with_ignores, trace_string)
+
     return sha1((str(util.serialize_args(args_with_ignores)) + "\n" +
                               str(counter_value) + "\n" +
                               str(util.serialize_item(kwargs_with_ignores)) + "\n" +
@@ -67,9 +102,25 @@ class LazyBones:
         self.__class  = cls
         self.__args   = args
         self.__kwargs = kwargs
+        self.__lock   = threading.Lock()
+        self.instance = UNDEFINED
     def init(self):
-        self.instance = self.__class( *self.__args, **self.__kwargs )
+        """
+        Returns the instance, constructing it the first time it's needed. Threads asking for it at the same time share one instance.
+
+        """
+        if self.instance is UNDEFINED:
+            with self.__lock:
+                if self.instance is UNDEFINED:
+                    self.instance = self.__class( *self.__args, **self.__kwargs )
         return self.instance
+    def reset(self):
+        """
+        Forgets the instance so the next call to init() constructs a new one.
+
+        """
+        with self.__lock:
+            self.instance = UNDEFINED
 
 class Wrapper( dict ):
     """
@@ -147,7 +198,8 @@ class Wrapper( dict ):
             c  = self.__store__['callables'][method_name]
             if hasattr( c, '__class__' ) and c.__class__ == LazyBones:
                 c = c.init()
-            returnval = c(*args, **kwargs)
+            with running():
+                returnval = c(*args, **kwargs)
             cd = call_descriptor.CallDescriptor( hash      = call_hash,
                                                  stack     = trace_string,
                                                  method    = method_name,
@@ -181,22 +233,30 @@ class Wrapper( dict ):
         return lambda *args, **kwargs: Facade( self.__cache( method_name, *args, **kwargs ), list(self.__exclusion_list) )
 
     def __getattr__( self, key ):
-        if key not in self.__store__: # Attempt to lazy load the method (assuming __getattr__ is set on the incoming object)
-            try:
-                oo = self['__original_object']
-                if hasattr( oo, '__class__' ) and oo.__class__ == LazyBones:
-                    oo = oo.init()
-                val = eval( "oo." + key )
-                self.__store_any(oo, key, val)
-            except:
-                raise Exception( "Key, " + str( key ) + " has not been set in the facade and failed to lazy load! Method is undefined." )
+        if key == '__store__':
+            raise AttributeError( key )
+        if key not in self.__store__: # Resolve and store the attribute the first time it's used
+            self.__load( key )
 
         val = self.__store__[key]
 
         if val and type(val) == tuple and val[0] == 'attr':
-            return Facade(val[1])
+            if key not in self.__facades:
+                self.__facades[ key ] = Facade(val[1])
+            return self.__facades[ key ]
+
+        return val
 
-        return self.__store__[ key ]
+    def wrapper__reset(self):
+        """
+        Forgets the wrapped attributes, and the instance if it's lazy-loaded, so they're looked up again the next time they're used.
+
+        """
+        oo = self['__original_object']
+        if hasattr( oo, '__class__' ) and oo.__class__ == LazyBones:
+            oo.reset()
+        self.__store__  = {'callables': {}}
+        self.__facades  = {}
 
     def wrapper__get_store(self):
         """
@@ -205,58 +265,75 @@ class Wrapper( dict ):
         """
         return self.__store__
 
-    def __store_callable(self, o, method_name, member):
+    def __load(self, key):
+        """
+        Looks an attribute up on the original object and stores it. An attribute can also be reached by its name with the first letter lower cased.
+
+        :param str key: The name the attribute is being accessed by
+
+        """
+        oo = self['__original_object']
+        if hasattr( oo, '__class__' ) and oo.__class__ == LazyBones:
+            oo = oo.init()
+        plan = get_plan( oo, self.__exclusion_list )
+        if key in plan and is_plannable( oo, key ): # Unless this object overrides what its type has
+            plan[ key ]( self, key, getattr( oo, key ) )
+            return
+        for name in ( key, key[:1].upper() + key[1:] ):
+            try:
+                member = getattr( oo, name )
+            except Exception:
+                continue
+            store = self.__store_any( name, member )
+            if name != key: # Wrapped under its real name so its calls get the same keys either way
+                self.__store__[ key ] = self.__store__[ name ]
+                if name in self.__store__['callables']:
+                    self.__store__['callables'][ key ] = self.__store__['callables'][ name ]
+            elif is_plannable( oo, key ):
+                plan[ key ] = store
+            return
+        raise Exception( "Key, " + str( key ) + " has not been set in the facade and failed to lazy load! Method is undefined." )
+
+    def __store_callable(self, method_name, member):
         """
         Stores a callable member to the private __store__
 
-        :param mixed o: Any callable (function or method)
         :param str method_name: The name of the attribute
         :param mixed member: A reference to the member
 
         """
-        self.__store__['callables'][method_name] = eval( "o." + method_name )
-        self.__store__['callables'][method_name[0].lower() + method_name[1:]] = eval( "o." + method_name )
-        ret_val = self.__wrap( method_name )
-        self.__store__[ method_name ] = ret_val
-        self.__store__[ method_name[0].lower() + method_name[1:] ] = ret_val
+        self.__store__['callables'][method_name] = member
+        self.__store__[ method_name ] = self.__wrap( method_name )
 
-    def __store_class(self, o, method_name, member):
+    def __store_class(self, method_name, member):
         """
         Stores a class to the private __store__
 
-        :param class o: The class to store
         :param str method_name: The name of the method
         :param class member: The actual class definition
         """
-        self.__store__['callables'][method_name] = eval( "o." + method_name )
-        self.__store__['callables'][method_name[0].lower() + method_name[1:]] = eval( "o." + method_name )
-        ret_val = self.__wrap( method_name )
-        self.__store__[ method_name ] = ret_val
-        self.__store__[ method_name[0].lower() + method_name[1:] ] = ret_val
+        self.__store__['callables'][method_name] = member
+        self.__store__[ method_name ] = self.__wrap( method_name )
 
-    def __store_nonprimitive(self, o, method_name, member):
+    def __store_nonprimitive(self, method_name, member):
         """
         Stores any 'non-primitive'. A primitive is in ( float, long, str, int, dict, list, unicode, tuple, set, frozenset, datetime.datetime, datetime.timedelta )
 
-        :param mixed o: The non-primitive to store
         :param str method_name: The name of the attribute
         :param mixed member: The reference to the non-primitive
 
         """
         self.__store__[ method_name ] = ( 'attr', member )
-        self.__store__[ method_name[0].lower() + method_name[1:] ] = ( 'attr', member )
 
-    def __store_other(self, o, method_name, member):
+    def __store_other(self, method_name, member):
         """
-        Stores a reference to an attribute on o
+        Stores a reference to an attribute on the original object
 
-        :param mixed o: Some object
         :param str method_name: The name of the attribute
         :param mixed member: The attribute
 
         """
-        self.__store__[ method_name ] = eval( "o." + method_name )
-        self.__store__[ method_name[0].lower() + method_name[1:] ] = eval( "o." + method_name )
+        self.__store__[ method_name ] = member
 
     def __save_reference(self, o, cls, args, kwargs):
         """
@@ -276,31 +353,31 @@ class Wrapper( dict ):
                 o = o.wrapper__unwrap()
             self['__original_object'] = o
 
-    def __store_any(self, o, method_name, member):
+    def __store_any(self, method_name, member):
         """
         Determines type of member and stores it accordingly
 
-        :param mixed o: Any parent object
-        :param str method_name: The name of the method or attribuet
+        :param str method_name: The name of the method or attribute
         :param mixed member: Any child object
 
+        :rtype function: The Wrapper method that stored it
         """
-        if should_exclude( eval( "o." + method_name ), self.__exclusion_list ):
-            self.__store__[ method_name ] = eval( "o." + method_name )
-            return
-
-        if hasattr( member, '__call__' ):
-            self.__store_callable( o, method_name, member )
+        if should_exclude( member, self.__exclusion_list ):
+            store = Wrapper.__store_other
+        elif hasattr( member, '__call__' ):
+            store = Wrapper.__store_callable
         elif inspect.isclass( member ):
-            self.__store_class( o, method_name, member ) # Default ot lazy-loading classes here.
+            store = Wrapper.__store_class # Default ot lazy-loading classes here.
         elif not util.is_primitive( member ):
-            self.__store_nonprimitive( o, method_name, member )
+            store = Wrapper.__store_nonprimitive
         else:
-            self.__store_other( o, method_name, member )
+            store = Wrapper.__store_other
+        store( self, method_name, member )
+        return store
 
     def __init__( self, o=None, exclusion_list=[], cls=None, args=tuple(), kwargs={} ):
         """
-        The init method for the Wrapper class.
+        The init method for the Wrapper class. Attributes of the object are wrapped the first time they're used, so this takes the same time however many the object has.
 
         :param mixed o: Some object to wrap.
         :param list exclusion_list: The list of types NOT to wrap
@@ -310,6 +387,7 @@ class Wrapper( dict ):
 
         """
         self.__store__            = {'callables': {}}
+        self.__facades            = {}
         self.__class              = cls
         self.__args               = args
         self.__kwargs             = kwargs
@@ -317,18 +395,8 @@ class Wrapper( dict ):
 
         self.__save_reference(o, cls, args, kwargs)
 
-        for method_name, member in inspect.getmembers(o):
-            self.__store_any(o, method_name, member)
-
-        try: # try-except because o is mixed type
-            if o.wrapper__get_store: # For wrapping facades in a chain.
-                store = o.wrapper__get_store()
-                for key, val in store.items():
-                    if key == 'callables':
-                        self.__store__[key].update( val )
-                    self.__store__[key] = val
-        except:
-            pass
+        if hasattr( o, '__class__' ) and o.__class__ == Wrapper: # For wrapping facades in a chain.
+            self.__store__.update( o.wrapper__get_store() )
 
 def Facade( some_instance=None, exclusion_list=[], cls=None, args=tuple(), kwargs={}  ):
     """
@@ -356,7 +424,47 @@ def Facade( some_instance=None, exclusion_list=[], cls=None, args=tuple(), kwarg
 
 
 
-def cache(handle=lambda *args, **kwargs: None, args=UNDEFINED, kwargs=UNDEFINED, ignore=UNDEFINED, call_stack=UNDEFINED, callback=UNDEFINED, subsequent_rvalue=UNDEFINED):
+def get_replayed(handle, call_stack):
+    """
+    Returns the call recorded at the next position in a test's saved CallStack if it's a call to the same method, so it can be served without working out its full key. Once the calls made stop lining up with the ones recorded the stack goes back to looking calls up by their full keys.
+
+    :param function handle: The method called
+    :param caliendo.hooks.CallStack call_stack: The stack of calls for the test
+
+    :rtype caliendo.call_descriptor.CallDescriptor: The recorded call, or None
+    """
+    if call_stack.depth: # Nested in a call that wasn't replayed
+        call_stack.stop_replay()
+        return None
+    h = call_stack.next_recorded()
+    if not h:
+        return None
+    cd = call_descriptor.fetch(h)
+    if cd and cd.methodname == handle.__name__:
+        return cd
+    call_stack.stop_replay()
+    return None
+
+@contextmanager
+def running(call_stack=UNDEFINED):
+    """
+    Counts a cached method as running on a CallStack while it's called, so the calls made from inside it are recorded as nested in it.
+
+    :param caliendo.hooks.CallStack call_stack: The stack. Defaults to the one for the patched test running, if there is one.
+
+    """
+    if call_stack == UNDEFINED and Context.running:
+        call_stack = Context.running[-1].stack
+    if call_stack == UNDEFINED or call_stack is None:
+        yield
+        return
+    call_stack.depth += 1
+    try:
+        yield
+    finally:
+        call_stack.depth -= 1
+
+def cache(handle=lambda *args, **kwargs: None, args=UNDEFINED, kwargs=UNDEFINED, ignore=UNDEFINED, call_stack=UNDEFINED, callback=UNDEFINED, subsequent_rvalue=UNDEFINED, stop_at_test=False):
     """
     Store a call descriptor
 
@@ -367,6 +475,9 @@ def cache(handle=lambda *args, **kwargs: None, args=UNDEFINED, kwargs=UNDEFINED,
     :param caliendo.hooks.CallStack call_stack: The stack of calls thus far for this patch.
     :param function callback: The callback function to execute each time there is a cache hit for 'handle' (actually mechanism is more complicated, but this is what it boils down to)
     :param mixed subsequent_rvalue: If passed; this will be the return value each time this method is run regardless of what is returned when it is initially cached. Caching for this method will be skipped. This is useful when the method returns something unpickleable but we still need to stub it out.
+    :param bool stop_at_test: Identify the call by the stack up to the running test method, as though the test were decorated with patch. Used by patches applied as context managers.
+
+    With CALIENDO_REPLAY set, calls in a test with a saved call_stack are served by their position in it. Only every CALIENDO_REPLAY_VERIFY'th of them has its full key worked out to check it's the call recorded there.
 
     :returns: The value of handle(*args, **kwargs)
     """
@@ -381,11 +492,30 @@ def cache(handle=lambda *args, **kwargs: None, args=UNDEFINED, kwargs=UNDEFINED,
     filtered_args = ignore.filter_args(args) if ignore is not UNDEFINED else args
     filtered_kwargs = ignore.filter_kwargs(kwargs) if ignore is not UNDEFINED else args
 
-    trace_string      = util.get_stack(handle.__name__)
-    call_hash         = get_hash(filtered_args, trace_string, filtered_kwargs, ignore)
-    cd                = call_descriptor.fetch(call_hash)
+    trace_string      = None
+    call_hash         = None
+    cd                = None
     modify_or_replace = 'no'
 
+    if config.CALIENDO_REPLAY and call_stack != UNDEFINED and not config.CALIENDO_PROMPT:
+        cd = get_replayed(handle, call_stack)
+    if cd and config.CALIENDO_REPLAY_VERIFY and (call_stack.cursor - 1) % config.CALIENDO_REPLAY_VERIFY == 0:
+        trace_string = util.get_stack(handle.__name__, stop_at_test)
+        if trace_string == cd.stack:
+            call_hash = get_hash(filtered_args, trace_string, filtered_kwargs, ignore)
+        if call_hash != cd.hash:
+            call_stack.stop_replay()
+            cd = None
+    elif cd:
+        counter.get_from_trace_for_cache(cd.stack) # Leaves the counter where working out the key would have
+
+    if cd:
+        call_hash = cd.hash
+    else:
+        trace_string = trace_string or util.get_stack(handle.__name__, stop_at_test)
+        call_hash    = call_hash or get_hash(filtered_args, trace_string, filtered_kwargs, ignore)
+        cd           = call_descriptor.fetch(call_hash)
+
     util.set_current_hash(call_hash)
 
     if config.CALIENDO_PROMPT:
@@ -399,7 +529,8 @@ def cache(handle=lambda *args, **kwargs: None, args=UNDEFINED, kwargs=UNDEFINED,
             modify_or_replace = prompt.should_modify_or_replace_cached(display_name)
 
     if not cd or modify_or_replace == 'replace':
-        returnval = handle(*args, **kwargs)
+        with running(call_stack):
+            returnval = handle(*args, **kwargs)
     elif cd and modify_or_replace == 'modify':
         returnval = prompt.modify_cached_value(cd.returnval,
                                                calling_method=display_name,
@@ -3,12 +3,15 @@ import sys
 import inspect
 
 from caliendo.__init__ import UNDEFINED
+from caliendo import config
 
 from caliendo.call_descriptor import fetch
+from caliendo import counter
 
-from caliendo.db.flatfiles import save_stack
-from caliendo.db.flatfiles import load_stack
-from caliendo.db.flatfiles import delete_stack
+from caliendo.db import save_stack
+from caliendo.db import load_stack
+from caliendo.db import delete_stack
+from caliendo.db import flush
 
 class ContextException(Exception):
     def __init__(self, value):
@@ -21,6 +24,7 @@ class Context(object):
     Stores metadata for a set of patch decorators on a single method.
 
     """
+    running = [] # The contexts of the patched tests running, innermost last
     def __init__(self, calling_method, stack=UNDEFINED):
         if not calling_method:
             raise ContextException("The calling method is required for the context.")
@@ -33,6 +37,9 @@ class Context(object):
             self.stack = CallStack(calling_method) 
 
         self.depth = 1
+        self.levels = 1 # How many times exit() is called each time the method runs
+        self.applied = set([]) # The patch layers applied while the method runs
+        self.replacements = {} # (id(instance), attribute) -> (instance, replacement) for lazy-loaded methods patched while the method runs
 
     @staticmethod
     def exists(method):
@@ -66,16 +73,23 @@ class Context(object):
 
     def enter(self):
         self.depth += 1
+        self.levels += 1
 
     def exit(self):
         self.depth -= 1
         if self.depth < 0:
             raise ContextException("Invalid 'exit()' call! Context depth is below -1: {0}".format(self.depth))
-        if self.depth == 0 and self.stack:
+        if self.depth == 0:
             self.leave_context()
+            self.depth = self.levels # Ready to run again
 
     def leave_context(self):
-        self.stack.save()
+        self.replacements.clear()
+        counter.flush()
+        if self.stack:
+            self.stack.save()
+            self.stack.rewind()
+            flush()
 
 
 class CallStack(object):
@@ -92,6 +106,10 @@ class CallStack(object):
         self.calls = []
         self.hooks = {}
         self.__skip = {}
+        self.depths = [] # How many cached calls were running on this stack when each of the calls was made
+        self.depth = 0 # How many cached calls are running on this stack
+        self.recorded = [] # The calls made at the top level when the stack was saved, to replay by position
+        self.cursor = None # The position of the next call to replay, or None when calls are looked up by their full keys
 
         if caller != UNDEFINED:
             self.module  = inspect.getmodule(caller).__name__
@@ -117,6 +135,11 @@ class CallStack(object):
         if s:
             self.hooks = s.hooks
             self.calls = s.calls
+            self.depths = getattr(s, 'depths', None) or [None] * len(s.calls) # Not kept by older versions
+            if config.CALIENDO_REPLAY and None not in self.depths:
+                # Nested calls are left out, since replaying serves the calls they're nested in instead of making them.
+                self.recorded = [h for h, depth in zip(self.calls, self.depths) if not depth]
+                self.rewind()
 
     def set_caller(self, caller):
         """
@@ -143,6 +166,34 @@ class CallStack(object):
         """
         delete_stack(self)
 
+    def next_recorded(self):
+        """
+        Returns the hash of the next call recorded when this stack was saved, moving on to the one after it.
+
+        :rtype str: The hash, or None if calls aren't being replayed by position.
+        """
+        if self.cursor is None:
+            return None
+        if self.cursor >= len(self.recorded):
+            self.cursor = None
+            return None
+        self.cursor += 1
+        return self.recorded[self.cursor - 1]
+
+    def stop_replay(self):
+        """
+        Goes back to looking calls up by their full keys for the rest of the run, once the calls made stop lining up with the ones recorded.
+
+        """
+        self.cursor = None
+
+    def rewind(self):
+        """
+        Replays calls by position from the first one again, for the next run of the method.
+
+        """
+        self.cursor = 0 if self.recorded else None
+
     def add(self, call_descriptor):
         """
         Adds a CallDescriptor hash to the stack. If there is a hook associated with this call it will be executed and passed an instance of the call descriptor.
@@ -152,6 +203,7 @@ class CallStack(object):
         """
         h = call_descriptor.hash
         self.calls.append(h)
+        self.depths.append(self.depth)
         if h in self.__skip:
             self.__skip[h] -= 1
             if self.__skip[h] == 0:
@@ -0,0 +1,103 @@
+from collections import OrderedDict
+
+CACHES_ = [] # Every LRU created, so entries can be dropped from all of them when the cache changes underneath
+
+def clear_all():
+    """
+    Empties every LRU.
+
+    """
+    for cache in CACHES_:
+        cache.clear()
+
+def discard_all(key):
+    """
+    Removes an entry from every LRU.
+
+    :param str key: The key the entry was stored under.
+
+    """
+    for cache in CACHES_:
+        cache.discard(key)
+
+class LRU:
+    """
+    A least recently used cache with a limit on the number of entries and on their total size.
+
+    """
+    def __init__(self, max_entries, max_bytes):
+        """
+        :param int max_entries: The most entries to keep. 0 disables the cache.
+        :param int max_bytes: The most total size to keep. Entries bigger than this aren't kept at all.
+        """
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+        self.entries     = OrderedDict() # Key -> (size, value), least recently used first
+        self.size        = 0
+        self.hits        = 0
+        self.misses      = 0
+        self.evictions   = 0
+        CACHES_.append(self)
+
+    def get(self, key):
+        """
+        Looks an entry up, marking it as the most recently used.
+
+        :param str key: The key the entry was stored under.
+
+        :rtype mixed: The value stored, or None if there isn't one.
+        """
+        try:
+            entry = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value, size):
+        """
+        Stores an entry, evicting the least recently used ones until it fits.
+
+        :param str key: The key to store the entry under.
+        :param mixed value: The value to store.
+        :param int size: The size the value counts for against max_bytes.
+
+        """
+        self.discard(key)
+        if not self.max_entries or size > self.max_bytes:
+            return
+        self.entries[key] = ( size, value )
+        self.size += size
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            evicted_size, evicted = self.entries.popitem(last=False)[1]
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def discard(self, key):
+        """
+        Removes an entry if there is one.
+
+        :param str key: The key the entry was stored under.
+
+        """
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.size -= entry[0]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        """
+        Returns the hit, miss, and eviction counters along with how much is stored.
+
+        :rtype dict:
+        """
+        return { 'hits': self.hits,
+                 'misses': self.misses,
+                 'evictions': self.evictions,
+                 'entries': len(self.entries),
+                 'bytes': self.size }
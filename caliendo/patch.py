@@ -1,8 +1,8 @@
 import inspect
 import sys
 import types
+import unittest
 from contextlib import contextmanager
-from mock import _get_target
 
 import caliendo
 
@@ -16,6 +16,7 @@ from caliendo.hooks import Hook
 from caliendo.hooks import Context
 
 from caliendo import util
+from caliendo import bindings
 
 def find_dependencies(module, depth=0, deps=None, seen=None, max_depth=99):
     """
@@ -53,14 +54,18 @@ def find_dependencies(module, depth=0, deps=None, seen=None, max_depth=99):
     return deps
 
 
-def find_modules_importing(dot_path, starting_with):
+def find_modules_importing(dot_path, starting_with, watched=None):
     """
     Finds all the modules importing a particular attribute of a module pointed to by dot_path that starting_with is dependent on.
 
+    The modules starting_with depends on are indexed once, so looking up where dot_path is imported doesn't have to walk every object in them again.
+
     :param dot_path: The dot path to the object of interest
     :type dot_path: str
     :param starting_with: The module from which to start resolving dependencies. The only modules importing dot_path returned will be dependencies of this module.
     :type starting_with: types.ModuleType
+    :param watched: If given, every (module, name) that could be bound to the object is appended to it, as caliendo.bindings.find_bindings does.
+    :type watched: list
 
     :rtype: list of tuples
     :returns: A list of module, name, object representing modules depending on dot_path where module is a reference to the module, name is the name of the object in that module, and object is the imported object in that module.
@@ -71,23 +76,20 @@ def find_modules_importing(dot_path, starting_with):
     if '.' not in dot_path:
         module_or_method = __import__(dot_path)
     else:
-        getter, attribute = _get_target(dot_path)
-        module_or_method = getattr(getter(), attribute)
+        owner, attribute = bindings.resolve_target(dot_path)
+        module_or_method = getattr(owner, attribute)
 
     if isinstance(module_or_method, types.UnboundMethodType):
-        klass = getter()
+        klass = owner
         module_or_method = klass
 
-    deps = find_dependencies(inspect.getmodule(starting_with))
+    modules = bindings.find_reachable_modules(inspect.getmodule(starting_with))
 
-    for depth, dependencies in deps.items():
-        for dependency in dependencies:
-            module, name, object = dependency
-            if object == module_or_method:
-                if klass:
-                    filtered.append((module, name, (klass, attribute)))
-                else:
-                    filtered.append((module, name, object))
+    for module, name in bindings.find_bindings(module_or_method, modules, watched):
+        if klass:
+            filtered.append((module, name, (klass, attribute)))
+        else:
+            filtered.append((module, name, module.__dict__[name]))
 
     return filtered
 
@@ -115,7 +117,7 @@ def execute_side_effect(side_effect=UNDEFINED, args=UNDEFINED, kwargs=UNDEFINED)
     else:
         raise Exception("Caliendo doesn't know what to do with your side effect. {0}".format(side_effect))
 
-def get_replacement_method(method_to_patch, side_effect=UNDEFINED, rvalue=UNDEFINED, ignore=UNDEFINED, callback=UNDEFINED, context=UNDEFINED, subsequent_rvalue=UNDEFINED):
+def get_replacement_method(method_to_patch, side_effect=UNDEFINED, rvalue=UNDEFINED, ignore=UNDEFINED, callback=UNDEFINED, context=UNDEFINED, subsequent_rvalue=UNDEFINED, stop_at_test=False):
     """
     Returns the method to be applied in place of an original method. This method either executes a side effect, returns an rvalue, or implements caching in place of the method_to_patch
 
@@ -126,6 +128,7 @@ def get_replacement_method(method_to_patch, side_effect=UNDEFINED, rvalue=UNDEFI
     :param function callback: A pickleable callback to execute when the patched method is called and the cache is hit. (has to have been cached the first time).
     :param caliendo.hooks.Context ctxt: The context this patch should be executed under. Generally reserved for internal use. The vast majority of use cases should leave this parameter alone.
     :param mixed subsequent_rvalue: If passed; this will be the return value each time this method is run regardless of what is returned when it is initially cached. Caching for this method will be skipped. This is useful when the method returns something unpickleable but we still need to stub it out.
+    :param bool stop_at_test: Identify calls by the stack up to the running test method, for replacements that aren't called from a test decorated with patch.
 
     :rtype: function
     :returns: The function to replace all references to method_to_patch with.
@@ -136,13 +139,139 @@ def get_replacement_method(method_to_patch, side_effect=UNDEFINED, rvalue=UNDEFI
         if rvalue != UNDEFINED:
             return rvalue
 
-        return cache(method_to_patch, args=args, kwargs=kwargs, ignore=ignore, call_stack=context.stack, callback=callback, subsequent_rvalue=subsequent_rvalue)
+        return cache(method_to_patch, args=args, kwargs=kwargs, ignore=ignore, call_stack=context.stack, callback=callback, subsequent_rvalue=subsequent_rvalue, stop_at_test=stop_at_test)
+    bindings.add_replacement(patch_with, method_to_patch)
     return patch_with
 
+def get_layers(method):
+    """
+    Returns the patch layers a patched test applies: one (import path, replacement factory) for itself followed by those of the patched test it wraps, if it wraps one directly.
+
+    :param function method: A patched test, or any other function
+
+    :rtype: list of tuples
+    """
+    return getattr(method, '__layers', [])
+
+def build_plan(layers, module, dependencies=None):
+    """
+    Works out every attribute to replace for a set of patch layers.
+
+    :param list layers: The layers, from the outermost in, as returned by get_layers
+    :param types.ModuleType module: The module the patched test is in. Only modules it depends on are patched.
+    :param list dependencies: If given, (owner, attribute, value) is appended to it for every target, every site patched and every site that could be bound to a target, with what the owner binds the attribute to now. The plan stays the same for as long as they all do.
+
+    :rtype: list of tuples
+    :returns: (owner, attribute, replacement) for every module or class attribute to patch, in the order to patch them in.
+    """
+    plan = []
+    watched = []
+    for import_path, get_replacement in layers:
+        owner, attribute = bindings.resolve_target(import_path)
+        watched.append((owner, attribute))
+        replacement = get_replacement(getattr(owner, attribute))
+        patched = set([])
+        for importer, name, obj in find_modules_importing(import_path, module, watched):
+            if hasattr(obj, '__len__') and len(obj) == 2: # We're patching an unbound method
+                owner, attribute = getattr(importer, name), obj[1]
+            else:
+                owner, attribute = importer, name
+            if (id(owner), attribute) not in patched:
+                patched.add((id(owner), attribute))
+                plan.append((owner, attribute, replacement))
+                watched.append((owner, attribute))
+    if dependencies is not None:
+        dependencies.extend([(owner, attribute, owner.__dict__.get(attribute, UNDEFINED)) for owner, attribute in watched])
+    return plan
+
+def refresh_plan(plan, layers, module):
+    """
+    Returns a plan built before if nothing it was built from has changed, or a new one. Rather than walking the modules again, only the size of sys.modules, what each target resolves to and the sites build_plan lists as dependencies are checked.
+
+    :param tuple plan: What refresh_plan returned before, or None
+    :param list layers: The layers, as returned by get_layers
+    :param types.ModuleType module: The module the patched test is in
+
+    :rtype: tuple
+    :returns: ((number of modules in sys.modules, the module or class holding each target, dependencies), plan as returned by build_plan)
+    """
+    if plan is not None and is_current_plan(plan, layers):
+        return plan
+    modules = len(sys.modules)
+    owners = [bindings.resolve_target(import_path)[0] for import_path, get_replacement in layers]
+    dependencies = []
+    steps = build_plan(layers, module, dependencies)
+    return ((modules, owners, dependencies), steps)
+
+def is_current_plan(plan, layers):
+    """
+    Tests whether build_plan would still build a plan returned by refresh_plan the same way.
+
+    :param tuple plan: What refresh_plan returned
+    :param list layers: The layers it was built for
+
+    :rtype bool:
+    """
+    (modules, owners, dependencies), steps = plan
+    if len(sys.modules) != modules:
+        return False
+    for (import_path, get_replacement), owner in zip(layers, owners):
+        if bindings.resolve_target(import_path)[0] is not owner:
+            return False
+    for owner, attribute, value in dependencies:
+        if owner.__dict__.get(attribute, UNDEFINED) is not value:
+            return False
+    return True
+
+def get_plan(patched_test, context):
+    """
+    Returns the plan for a patched test, building it the first time the test runs and again if anything it was built from has changed since.
+
+    :param function patched_test: The patched test
+    :param caliendo.hooks.Context context: The context the test runs in
+
+    :rtype: list of tuples
+    :returns: (owner, attribute, replacement) as returned by build_plan
+    """
+    plan = refresh_plan(getattr(patched_test, '__plan', None), get_layers(patched_test), context.module)
+    setattr(patched_test, '__plan', plan)
+    return plan[1]
+
+def apply_plan(plan):
+    """
+    Patches everything in a plan.
+
+    :param list plan: (owner, attribute, replacement) as returned by build_plan
+
+    :rtype: list
+    :returns: What each attribute was set to on its owner before, UNDEFINED if it wasn't, for revert_plan
+    """
+    originals = []
+    for owner, attribute, replacement in plan:
+        originals.append(owner.__dict__.get(attribute, UNDEFINED))
+        setattr(owner, attribute, replacement)
+    return originals
+
+def revert_plan(plan, originals):
+    """
+    Undoes apply_plan.
+
+    :param list plan: (owner, attribute, replacement) as returned by build_plan
+    :param list originals: What apply_plan returned
+
+    """
+    for (owner, attribute, replacement), original in reversed(zip(plan, originals)):
+        if original is UNDEFINED: # Inherited. Uncover it again.
+            delattr(owner, attribute)
+        else:
+            setattr(owner, attribute, original)
+
 def get_patched_test(import_path, unpatched_test, rvalue=UNDEFINED, side_effect=UNDEFINED, context=UNDEFINED, ignore=UNDEFINED, callback=UNDEFINED, subsequent_rvalue=UNDEFINED):
     """
     Defines a method for the decorator to return. The return value is the patched version of the original test. The original test will be run in the context for the patch, and the patched methods will be restored to their original state when the context's depth has counted down to 0
 
+    Stacked patches are applied together by the outermost one, following a plan it builds once and reuses. The patches under it just run what they wrap.
+
     :param str import_path: The import path of the method to patch.
     :param function unpatched_test: A reference to the method that will be patched.
     :param mixed rvalue: The value that should be immediately returned without executing the target.
@@ -153,67 +282,41 @@ def get_patched_test(import_path, unpatched_test, rvalue=UNDEFINED, side_effect=
     :param mixed subsequent_rvalue: If passed; this will be the return value each time this method is run regardless of what is returned when it is initially cached. Caching for this method will be skipped. This is useful when the method returns something unpickleable but we still need to stub it out.
 
     """
-    def get_or_store_backup_method(vessel, obj, callable_name):
-        """
-        Stores a backed-up callable for further retrieval so that the original is not lost by altering references.
-
-        :param dict vessel: A dictionary in which to store the backup callables.
-        :param type|module obj: A higher level object which contains the callable to store.
-        :param str name: The name of the callable to store.
-        :param function|instancemethod value: The original callable to backup.
+    def get_replacement(method_to_patch):
+        return get_replacement_method(method_to_patch,
+                                      side_effect=side_effect,
+                                      rvalue=rvalue,
+                                      ignore=ignore,
+                                      callback=callback,
+                                      context=context,
+                                      subsequent_rvalue=subsequent_rvalue)
 
-        """
-        if not (obj in vessel and callable_name in vessel[obj]):
-            callable_obj = getattr(obj, callable_name)
-            vessel[obj] = {callable_name: (callable_obj,)}
-        elif obj in vessel and vessel[obj].get(callable_name):
-            return vessel[obj][callable_name][0]
+    layer = (import_path, get_replacement)
 
     def patched_test(*args, **kwargs):
-        caliendo.util.current_test_module = context.module
-        caliendo.util.current_test_handle = context.handle
-        caliendo.util.current_test = "%s.%s" % (context.module, context.handle.__name__)
-
-        getter, attribute = _get_target(import_path)
-        method_to_patch = getattr(getter(), attribute)
-
-        patch_with = get_replacement_method(method_to_patch,
-                                            side_effect=side_effect,
-                                            rvalue=rvalue,
-                                            ignore=ignore,
-                                            callback=callback,
-                                            context=context,
-                                            subsequent_rvalue=subsequent_rvalue)
-
-        to_patch = find_modules_importing(import_path, context.module)
-
-        # Patch methods in all modules requiring it
-        drawer = {}
-        for module, name, obj in to_patch:
-            if hasattr(obj, '__len__') and len(obj) == 2: # We're patching an unbound method
-                klass, attribute = obj
-                get_or_store_backup_method(drawer, klass, attribute)
-                setattr(getattr(module, name), attribute, patch_with)
-            else:
-                get_or_store_backup_method(drawer, module, name)
-                setattr(module, name, patch_with)
+        if layer in context.applied: # An outer patch applied this one already
+            try:
+                return unpatched_test(*args, **kwargs)
+            finally:
+                context.exit() # One level shallower
+
+        set_current_test(context)
 
+        layers = get_layers(patched_test)
+        plan = get_plan(patched_test, context)
+        originals = apply_plan(plan)
+        context.applied.update(layers)
+        Context.running.append(context)
         try:
             # Run the test with patched methods.
             return unpatched_test(*args, **kwargs)
         finally:
-            # Un-patch patched methods
-            for module, name, obj in to_patch:
-                if hasattr(obj, '__len__') and len(obj) == 2: # We're patching an unbound method
-                    klass, attribute = obj
-                    method = get_or_store_backup_method(drawer, klass, attribute)
-                    setattr(getattr(module, name), attribute, method)
-                else:
-                    method = get_or_store_backup_method(drawer, module, name)
-                    setattr(module, name, method)
-
+            Context.running.pop()
+            context.applied.difference_update(layers)
+            revert_plan(plan, originals)
             context.exit() # One level shallower
 
+    patched_test.__layers = [layer] + get_layers(unpatched_test)
     return patched_test
 
 def get_context(method):
@@ -238,6 +341,12 @@ def patch(import_path, rvalue=UNDEFINED, side_effect=UNDEFINED, ignore=UNDEFINED
     decorated method is called patch_in_place unpatches the patched module with
     the original method.
 
+    Decorating a TestCase applies the patch once, from setUpClass to
+    tearDownClass, instead of around each test. As a context manager it applies
+    the patch for the with block, for fixtures set up once for a whole module.
+    Either way each test records its calls on its own CallStack, under the same
+    keys it would if it were decorated with the patch itself.
+
     :param str import_path: The import path of the method to patch.
     :param mixed rvalue: The return value of the patched method.
     :param mixed side_effect: The side effect to execute. Either a callable with the same parameters as the target, or an exception.
@@ -247,7 +356,49 @@ def patch(import_path, rvalue=UNDEFINED, side_effect=UNDEFINED, ignore=UNDEFINED
     :param mixed subsequent_rvalue: If passed; this will be the return value each time this method is run regardless of what is returned when it is initially cached. Caching for this method will be skipped. This is useful when the method returns something unpickleable but we still need to stub it out.
 
     """
-    def patch_test(unpatched_test):
+    return Patch(import_path, rvalue=rvalue, side_effect=side_effect, ignore=ignore, callback=callback, ctxt=ctxt, subsequent_rvalue=subsequent_rvalue)
+
+class Patch(object):
+    """
+    A patch, as returned by patch(). It decorates tests and TestCases, and is a context manager.
+
+    """
+    def __init__(self, import_path, rvalue=UNDEFINED, side_effect=UNDEFINED, ignore=UNDEFINED, callback=UNDEFINED, ctxt=UNDEFINED, subsequent_rvalue=UNDEFINED):
+        self.import_path       = import_path
+        self.rvalue            = rvalue
+        self.side_effect       = side_effect
+        self.ignore            = ignore
+        self.callback          = callback
+        self.ctxt              = ctxt
+        self.subsequent_rvalue = subsequent_rvalue
+        self.__applied         = [] # (plan, originals) for each with block entered and not exited yet
+
+    def get_layer(self, context, stop_at_test=False):
+        """
+        Returns the layer the patch applies, as get_layers does, with replacements running in a context.
+
+        :param caliendo.hooks.Context|SharedContext context: The context the replacements run in
+        :param bool stop_at_test: Whether the replacements identify calls by the stack up to the running test method
+
+        :rtype: tuple
+        """
+        def get_replacement(method_to_patch):
+            return get_replacement_method(method_to_patch,
+                                          side_effect=self.side_effect,
+                                          rvalue=self.rvalue,
+                                          ignore=self.ignore,
+                                          callback=self.callback,
+                                          context=context,
+                                          subsequent_rvalue=self.subsequent_rvalue,
+                                          stop_at_test=stop_at_test)
+        return (self.import_path, get_replacement)
+
+    def __call__(self, unpatched_test):
+        if isinstance(unpatched_test, (type, types.ClassType)):
+            return patch_test_case(unpatched_test, self)
+        return self.patch_test(unpatched_test)
+
+    def patch_test(self, unpatched_test):
         """
         Patches a callable dependency of an unpatched test with a callable corresponding to patch_with.
 
@@ -259,27 +410,159 @@ def patch(import_path, rvalue=UNDEFINED, side_effect=UNDEFINED, ignore=UNDEFINED
         :returns: The patched test
         :rtype: instance method
         """
-        if ctxt == UNDEFINED:
+        if self.ctxt == UNDEFINED:
             context = get_context(unpatched_test)
         else:
-            context = ctxt
+            context = self.ctxt
             context.enter()
 
 
-        patched_test = get_patched_test(import_path=import_path,
+        patched_test = get_patched_test(import_path=self.import_path,
                                         unpatched_test=unpatched_test,
-                                        rvalue=rvalue,
-                                        side_effect=side_effect,
+                                        rvalue=self.rvalue,
+                                        side_effect=self.side_effect,
                                         context=context,
-                                        ignore=ignore,
-                                        callback=callback,
-                                        subsequent_rvalue=subsequent_rvalue)
+                                        ignore=self.ignore,
+                                        callback=self.callback,
+                                        subsequent_rvalue=self.subsequent_rvalue)
 
-        patched_test.__context = context
+        setattr(patched_test, '__context', context) # Not name mangled, so Context.exists finds it
         patched_test.__name__ = context.name
 
         return patched_test
-    return patch_test
+
+    def __enter__(self):
+        module = sys.modules.get(sys._getframe(1).f_globals.get('__name__'))
+        plan = build_plan([self.get_layer(SharedContext(), stop_at_test=True)], module)
+        self.__applied.append((plan, apply_plan(plan)))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        plan, originals = self.__applied.pop()
+        revert_plan(plan, originals)
+
+class SharedContext(object):
+    """
+    Stands in for the context of whichever test is running, for patches applied to a whole TestCase or with a with block.
+
+    """
+    @property
+    def stack(self):
+        context = get_running_context()
+        return context.stack if context else UNDEFINED
+
+def get_running_context():
+    """
+    Returns the context of the test running. A test that wasn't patched on its own gets a context the first time it's asked for, left when the test finishes.
+
+    :rtype: caliendo.hooks.Context
+    :returns: The context, or None if no test is running.
+    """
+    if Context.running:
+        return Context.running[-1]
+    frame = util.find_test_frame()
+    test_case = frame.f_locals.get('self') if frame else None
+    if not isinstance(test_case, unittest.TestCase):
+        return None
+    context = getattr(test_case, '_caliendo_context', None)
+    if context is None:
+        context = Context(getattr(test_case, test_case._testMethodName).im_func)
+        set_current_test(context)
+        test_case._caliendo_context = context
+        test_case.addCleanup(context.exit)
+    return context
+
+def set_current_test(context):
+    caliendo.util.current_test_module = context.module
+    caliendo.util.current_test_handle = context.handle
+    caliendo.util.current_test = "%s.%s" % (context.module, context.handle.__name__)
+
+def patch_test_case(test_case, patch):
+    """
+    Patches a TestCase from setUpClass to tearDownClass. Each test runs in its own context, as it would if it were decorated with the patch itself.
+
+    :param type test_case: The TestCase to patch
+    :param Patch patch: The patch to apply
+
+    :rtype: type
+    :returns: The TestCase
+    """
+    patches = test_case.__dict__.get('_caliendo_patches')
+    if patches is None:
+        patches = TestCasePatches(test_case)
+        test_case._caliendo_patches = patches
+    patches.layers.insert(0, patch.get_layer(SharedContext())) # Decorators apply from the inside out
+    return test_case
+
+class TestCasePatches(object):
+    """
+    The patches applied to a TestCase for all of its tests. Stacked class decorators share one.
+
+    :param type test_case: The TestCase to patch
+
+    """
+    def __init__(self, test_case):
+        self.test_case = test_case
+        self.layers    = []
+        self.applied   = [] # (plan, originals) for each time setUpClass has run without tearDownClass
+        self.plan      = None # What refresh_plan returned, as get_plan keeps it
+
+        patches         = self
+        set_up_class    = test_case.setUpClass.im_func
+        tear_down_class = test_case.tearDownClass.im_func
+
+        def setUpClass(cls):
+            patches.apply()
+            try:
+                set_up_class(cls)
+            except:
+                patches.revert()
+                raise
+
+        def tearDownClass(cls):
+            try:
+                tear_down_class(cls)
+            finally:
+                patches.revert()
+
+        test_case.setUpClass = classmethod(setUpClass)
+        test_case.tearDownClass = classmethod(tearDownClass)
+        for name in unittest.TestLoader().getTestCaseNames(test_case):
+            setattr(test_case, name, self.wrap_test(getattr(test_case, name).im_func))
+
+    def apply(self):
+        self.plan = refresh_plan(self.plan, self.layers, sys.modules.get(self.test_case.__module__))
+        self.applied.append((self.plan[1], apply_plan(self.plan[1])))
+
+    def revert(self):
+        plan, originals = self.applied.pop()
+        revert_plan(plan, originals)
+
+    def wrap_test(self, unpatched_test):
+        """
+        Runs a test in its own context. Tests decorated with patch already run in one.
+
+        :param function unpatched_test: The test
+
+        :rtype: function
+        """
+        if Context.exists(unpatched_test):
+            return unpatched_test
+
+        context = Context(unpatched_test)
+
+        def patched_test(*args, **kwargs): # Named like the method patch decorates tests with, so calls get the same keys.
+            set_current_test(context)
+            Context.running.append(context)
+            try:
+                return unpatched_test(*args, **kwargs)
+            finally:
+                Context.running.pop()
+                context.exit() # Leaves the context, saving the test's stack
+
+        patched_test.__name__ = unpatched_test.__name__
+        patched_test.__doc__ = unpatched_test.__doc__
+        return patched_test
 
 def get_recorder(import_path, ctxt):
     """
@@ -291,8 +574,8 @@ def get_recorder(import_path, ctxt):
     :rtype: function
     :returns: A method that acts like the target, but adds a hook for each call.
     """
-    getter, attribute = _get_target(import_path)
-    method_to_patch = getattr(getter(), attribute)
+    owner, attribute = bindings.resolve_target(import_path)
+    method_to_patch = getattr(owner, attribute)
     def recorder(*args, **kwargs):
         ctxt.stack.add_hook(Hook(call_descriptor_hash=util.get_current_hash(),
                                  callback=lambda cd: method_to_patch(*args, **kwargs)))
@@ -330,6 +613,8 @@ def patch_lazy(import_path, rvalue=UNDEFINED, side_effect=UNDEFINED, ignore=UNDE
     """
     Patches lazy-loaded methods of classes. Patching at the class definition overrides the __getattr__ method for the class with a new version that patches any callables returned by __getattr__ with a key matching the last element of the dot path given
 
+    Each instance's lazy-loaded method is patched the first time it's looked up in a run of the test, and the same replacement is returned after that until the test's context exits.
+
     :param str import_path: The absolute path to the lazy-loaded method to patch. It can be either abstract, or defined by calling __getattr__
     :param mixed rvalue: The value that should be immediately returned without executing the target.
     :param mixed side_effect: The side effect to execute. Either a callable with the same parameters as the target, or an exception.
@@ -343,23 +628,29 @@ def patch_lazy(import_path, rvalue=UNDEFINED, side_effect=UNDEFINED, ignore=UNDE
     def patch_method(unpatched_method):
         context = get_context(unpatched_method)
 
-        getter, attribute = _get_target(import_path)
-        klass = getter()
+        klass, attribute = bindings.resolve_target(import_path)
 
         getattr_path = ".".join(import_path.split('.')[0:-1] + ['__getattr__'])
 
         def wrapper(wrapped_method, instance, attr):
+            if attr == attribute:
+                replacement = context.replacements.get((id(instance), attr))
+                if replacement:
+                    return replacement[1]
+
             lazy_loaded = wrapped_method.original(instance, attr)
 
             if attr != attribute:
                 return lazy_loaded
 
-            return get_replacement_method(lazy_loaded,
-                                          side_effect=side_effect,
-                                          rvalue=rvalue,
-                                          ignore=ignore,
-                                          callback=callback,
-                                          context=context)
+            replacement = get_replacement_method(lazy_loaded,
+                                                 side_effect=side_effect,
+                                                 rvalue=rvalue,
+                                                 ignore=ignore,
+                                                 callback=callback,
+                                                 context=context)
+            context.replacements[(id(instance), attr)] = (instance, replacement) # Holding the instance keeps its id from being reused
+            return replacement
 
         @patch(getattr_path, side_effect=WrappedMethod(klass.__getattr__, wrapper), ctxt=context)
         def patched_method(*args, **kwargs):
@@ -1,15 +1,20 @@
 from collections import Mapping, Sequence, Set
 import weakref
 import pickle
+import cPickle
+import copy
 import types
+import array
 import copy_reg
 import datetime
+from cStringIO import StringIO
+
+from caliendo import config
+from caliendo.db import blobs
 
 MAX_DEPTH = 10
 
 string_types = (str, unicode) if str is bytes else (str, bytes)
-iteritems = lambda mapping: getattr(mapping, 'iteritems', mapping.items)()
-class_iterator = lambda mapping: iteritems(vars(mapping)) if hasattr( mapping, '__dict__' ) else iteritems(vars(mapping()))
 primitives = ( float, long, str, int, dict, list, unicode, tuple, set, frozenset, datetime.datetime, datetime.timedelta, type(None) )
 
 def reduce_method(m):
@@ -23,111 +28,147 @@ class C:
 def is_lambda(v):
     return isinstance(v, type(lambda: None)) and hasattr( v, '__name__' ) and v.__name__ == '<lambda>'
 
-def objwalk(obj, path=(), memo=None):
+def is_container(v):
     """
-    Walks an arbitrary python pbject.
+    Tests whether a value holds other values that are pickled nested within it: mappings, sequences, sets, and objects with attributes.
 
-    :param mixed obj: Any python object
-    :param tuple path: A tuple of the set attributes representing the path to the value
-    :param set memo: The list of attributes traversed thus far
+    :param mixed v: Any value
 
-    :rtype <tuple<tuple>, <mixed>>: The path to the value on the object, the value.
+    :rtype bool:
     """
-    if len( path ) > MAX_DEPTH + 1:
-        yield path, obj # Truncate it!
-    if memo is None:
-        memo = set()
-    iterator = None
-    if isinstance(obj, Mapping):
-        iterator = iteritems
-    elif isinstance(obj, (Sequence, Set)) and not isinstance(obj, string_types):
-        iterator = enumerate
-    elif hasattr( obj, '__class__' ) and hasattr( obj, '__dict__' ) and type(obj) not in primitives: # If type(obj) == <instance>
-        iterator = class_iterator
-    elif hasattr(obj, '__iter__') or isinstance(obj, types.GeneratorType):
-        obj = [o for o in obj]
-    else:
-        pass
-    if iterator:
-        if id(obj) not in memo:
-            memo.add(id(obj))
-            for path_component, value in iterator(obj):
-                for result in objwalk(value, path + (path_component,), memo):
-                    yield result
-            memo.remove(id(obj))
-    else:
-        yield path, obj
+    if isinstance(v, Mapping):
+        return True
+    if isinstance(v, (Sequence, Set)) and not isinstance(v, string_types):
+        return True
+    return hasattr( v, '__class__' ) and hasattr( v, '__dict__' ) and type(v) not in primitives
 
-def setattr_at_path( obj, path, val ):
+class Pickler(pickle.Pickler):
     """
-    Traverses a set of nested attributes to the value on an object
+    Pickles at the highest protocol, resolving weak references, leaving out lambdas, and truncating values nested more than MAX_DEPTH deep as it goes. The object being pickled is never changed.
 
-    :param mixed obj: The object to set the attribute on
-    :param tuple path: The path to the attribute on the object
-    :param mixed val: The value at the attribute
+    Entries of a mapping and attributes of an object nested deeper than MAX_DEPTH are left out, though containers at MAX_DEPTH + 1 are kept, empty. Elements of sequences and sets are always kept.
 
-    :rtype None:
     """
-    target = obj
-    last_attr = path[-1]
-    for attr in path[0:-1]:
+    dispatch = pickle.Pickler.dispatch.copy()
+
+    def __init__(self, file, protocol=pickle.HIGHEST_PROTOCOL):
+        pickle.Pickler.__init__(self, file, protocol)
+        self.depth = 0 # How deeply nested the values being pickled are
+
+    def persistent_id(self, obj):
+        """
+        Stores strings, bytearrays, and arrays of at least CALIENDO_BLOB_THRESHOLD bytes as blobs outside the pickle, which only holds a reference to them.
+
+        :param mixed obj: The object being pickled
+
+        :rtype str: The reference to the blob, or None to pickle obj
+        """
+        t = type(obj)
+        if t not in (str, bytearray, array.array) or not config.CALIENDO_BLOB_THRESHOLD:
+            return None
+        if t is array.array:
+            if obj.itemsize * len(obj) < config.CALIENDO_BLOB_THRESHOLD:
+                return None
+            return "%s%s:array:%s" % (blobs.PREFIX, blobs.put_blob(buffer(obj)), obj.typecode)
+        if len(obj) < config.CALIENDO_BLOB_THRESHOLD:
+            return None
+        if t is str and obj.startswith(blobs.PREFIX): # The reference itself, pickled by save_pers
+            return None
+        return "%s%s:%s" % (blobs.PREFIX, blobs.put_blob(obj), t.__name__)
+
+    def truncates(self, v):
+        """
+        Tests whether a mapping entry or attribute with the value v is left out at the current depth.
+
+        :param mixed v: The value of the entry
+
+        :rtype bool:
+        """
+        if is_lambda(v):
+            return True
+        return self.depth > MAX_DEPTH and ( self.depth > MAX_DEPTH + 1 or not is_container(v) )
+
+    def _batch_setitems(self, items):
+        self.depth += 1
+        try:
+            pickle.Pickler._batch_setitems(self, ((k, v) for k, v in items if not self.truncates(v)))
+        finally:
+            self.depth -= 1
+
+    def _batch_appends(self, items):
+        self.depth += 1
+        try:
+            pickle.Pickler._batch_appends(self, items)
+        finally:
+            self.depth -= 1
+
+    def save_tuple(self, obj):
+        self.depth += 1
+        try:
+            pickle.Pickler.save_tuple(self, obj)
+        finally:
+            self.depth -= 1
+    dispatch[tuple] = save_tuple
+
+    def save_set(self, obj):
+        self.depth -= 1 # Sets reduce to a tuple holding a list of their elements. Count them as one level.
         try:
-            if type(attr) in ( str, unicode ) and target and hasattr( target, attr ):
-                target = getattr( target, attr )
-            else:
-                target = target[attr]
-        except:
-            pass
-    # Ensures we set by reference
-    try:
-        setattr( target, last_attr, val )
-    except:
-        target[last_attr] = val
-
-def truncate_attr_at_path( obj, path ):
+            self.save_reduce(obj=obj, *obj.__reduce_ex__(self.proto))
+        finally:
+            self.depth += 1
+    dispatch[set] = save_set
+    dispatch[frozenset] = save_set
+
+    def save_weakref(self, obj):
+        self.save(obj())
+    dispatch[weakref.ReferenceType] = save_weakref
+
+    def save_function(self, obj):
+        if is_lambda(obj):
+            self.save_none(obj)
+        else:
+            self.save_global(obj)
+    dispatch[types.FunctionType] = save_function
+
+def persistent_load(pid):
     """
-    Traverses a set of nested attributes and truncates the value on an object
+    Loads a blob a pickle refers to. Strings are returned as read-only buffers over the memory mapped blob, without copying it, if CALIENDO_BLOB_VIEWS is set.
 
-    :param mixed obj: The object to set the attribute on
-    :param tuple path: The path to the attribute on the object
+    :param str pid: The reference to the blob
 
-    :rtype None:
+    :rtype str|buffer|bytearray|array.array:
     """
-    target = obj
-    last_attr = path[-1]
-    message = []
+    if not pid.startswith(blobs.PREFIX):
+        raise cPickle.UnpicklingError("Unknown persistent id {0}".format(pid))
+    hash, kind = pid[len(blobs.PREFIX):].split(':', 1)
+    if kind == 'str':
+        return blobs.get_blob(hash, view=config.CALIENDO_BLOB_VIEWS)
+    data = blobs.get_blob(hash, view=True)
+    if kind == 'bytearray':
+        return bytearray(data)
+    a = array.array(kind[len('array:'):])
+    a.fromstring(data)
+    return a
+
+def loads( data, sizes=None ):
+    """
+    Unpickles data pickled by pickle_with_weak_refs, loading any blobs it refers to.
 
-    if type(last_attr) == tuple:
-        last_attr = last_attr[-1]
-    for attr in path[0:-1]:
-        try:
-            if type(attr) in ( str, unicode ) and target and hasattr( target, attr ) and hasattr( target, '__getitem__' ):
-                target = getattr( target, attr )
-            elif target:
-                try: target = target[attr]
-                except: target = eval( "target." + str( attr ) )
-        except:
-            pass
-        try:
-            if not target: return
-        except: return
-        if isinstance( target, ( tuple, list ) ): target = list(target) # Tuples are immutable. Need to be able to manipulate.
-
-    try:
-        del_statement = "del target." + str( last_attr )
-        eval( del_statement )
-        return
-    except: pass
-
-    if type( last_attr ) in ( str, unicode ) and target and hasattr( target, last_attr ):
-        try: delattr( target, last_attr )
-        except: message.append("Failed to delete attribute" + str(last_attr) + "on target" + str(target) )
-    elif type(target) == list:
-        try: target.pop(last_attr)
-        except: message.append( "Failed to delete value on list" + str(target) + "at index" + str(last_attr) )
+    :param str data: The pickled object
+    :param list sizes: If given, the size in bytes of each blob loaded is appended to it
+
+    :rtype mixed:
+    """
+    unpickler = cPickle.Unpickler(StringIO(data))
+    if sizes is None:
+        unpickler.persistent_load = persistent_load
     else:
-        try: del target[str(last_attr)]
-        except: message.append( "failed to delete attribute on subscriptable object" )
+        def load_and_measure(pid):
+            blob = persistent_load(pid)
+            sizes.append(len(blob) * getattr(blob, 'itemsize', 1))
+            return blob
+        unpickler.persistent_load = load_and_measure
+    return unpickler.load()
 
 def pickle_with_weak_refs( o ):
     """
@@ -139,10 +180,55 @@ def pickle_with_weak_refs( o ):
     """
     if isinstance(o, types.GeneratorType):
         o = [i for i in o]
-    walk = dict([ (path,val) for path, val in objwalk(o)])
-    for path, val in walk.items():
-        if len(path) > MAX_DEPTH or is_lambda(val):
-            truncate_attr_at_path(o, path)
-        if isinstance(val, weakref.ref):
-            setattr_at_path( o, path, val() ) # Resolve weak references
-    return pickle.dumps(o)
+    f = StringIO()
+    Pickler(f).dump(o)
+    return f.getvalue()
+
+immutable_types = ( str, unicode, int, long, float, complex, bool, buffer, types.NoneType )
+
+def is_immutable(value):
+    """
+    Tests whether a value, and everything it holds, can't be changed in place, so it's safe to hand the same one out more than once.
+
+    :param mixed value: Any value
+
+    :rtype bool:
+    """
+    if type(value) in immutable_types:
+        return True
+    if type(value) in ( tuple, frozenset ):
+        return all( is_immutable(v) for v in value )
+    return False
+
+class Decoded:
+    """
+    A value decoded from the cache along with the pickle it came from. Its size counts the pickle and the blobs the value holds.
+
+    """
+    def __init__(self, data):
+        sizes = []
+        self.data  = data
+        self.value = loads(data, sizes)
+        self.size  = len(data) + sum(sizes)
+        self.immutable = is_immutable(self.value)
+        self.given = False # Whether value has been handed to a caller that's free to change it
+
+    def get(self, policy):
+        """
+        Returns the value to hand to a caller.
+
+        :param str policy: 'share' returns the decoded value itself, 'deepcopy' a deep copy of it, and 'unpickle' the value itself if it's immutable and one no other caller has been given otherwise. That's the value decoded along with this the first time, so it's only unpickled again for later callers.
+
+        :rtype mixed:
+        """
+        if self.given:
+            self.value = loads(self.data)
+            self.given = False
+        if policy == 'share' or self.immutable:
+            return self.value
+        if policy == 'deepcopy':
+            return copy.deepcopy(self.value)
+        if policy == 'unpickle':
+            self.given = True
+            return self.value
+        raise Exception("Unknown caliendo L1 copy policy: {0}".format(policy))
@@ -3,7 +3,9 @@ import types
 import sys
 import inspect
 import datetime
+import unittest
 
+from hashlib import sha1
 from collections import Iterable
 
 from caliendo import config
@@ -18,8 +20,18 @@ current_hash = None
 current_test = False
 test_suite = False
 
+HASH_MODULUS = 2 ** 160
+
+KEY_FUNCTIONS_ = {} # Type -> function returning the key its instances are hashed by
+DISPATCH_ = {} # Type -> key function of its nearest registered ancestor, or None
+
+FRAMES_ = {} # Code object -> (module name, trace string entry, whether the trace stops there)
+
+RUN_CODE = unittest.TestCase.run.im_func.func_code # What runs each test method
+PATCHED_TEST_ENTRY = "patch.py patched_test " # The trace string entry for the patched_test frame a test decorated with patch runs in
+
 if config.should_use_caliendo():
-    from caliendo.db.flatfiles import delete_io, get_unique_hashes # No connection. It's ok.
+    from caliendo.db import delete_io, get_unique_hashes # No connection. It's ok.
 
 def set_last_hash(h):
     """
@@ -58,8 +70,8 @@ def register_suite():
 
     """
     global test_suite
-    frm = inspect.stack()[1]
-    test_suite = ".".join(os.path.basename(frm[1]).split('.')[0:-1])
+    module_name = describe_code(sys._getframe(1).f_code)[0]
+    test_suite = ".".join(module_name.split('.')[0:-1])
 
 def is_primitive(var):
     """
@@ -72,9 +84,64 @@ def is_primitive(var):
             return True
     return False
 
+def register_key(type_, function=None):
+    """
+    Registers a function returning the key instances of a type, and its subclasses, are hashed by when they're passed to a cached call. Without one an instance is hashed by its class name. Can be used as a decorator:
+
+        @register_key(MyModel)
+        def model_key(model):
+            return "MyModel:%s" % model.pk
+
+    :param type type_: The type to register the function for
+    :param function function: Takes an instance and returns a str
+
+    :rtype function: The registered function
+    """
+    if function is None:
+        return lambda function: register_key(type_, function)
+    KEY_FUNCTIONS_[type_] = function
+    DISPATCH_.clear()
+    return function
+
+def unregister_key(type_):
+    """
+    Removes the key function registered for a type.
+
+    :param type type_: The type the function was registered for
+
+    :rtype None:
+    """
+    KEY_FUNCTIONS_.pop(type_, None)
+    DISPATCH_.clear()
+
+def get_key_function(item):
+    """
+    Returns the key function registered for the item's type or its nearest ancestor. The result is cached per type.
+
+    :param mixed item: The item to look up a key function for
+
+    :rtype function: The key function, or None
+    """
+    cls = type(item)
+    if cls is types.InstanceType:
+        cls = item.__class__
+    try:
+        return DISPATCH_[cls]
+    except KeyError:
+        function = None
+        for base in inspect.getmro(cls):
+            if base in KEY_FUNCTIONS_:
+                function = KEY_FUNCTIONS_[base]
+                break
+        DISPATCH_[cls] = function
+        return function
+
 def serialize_item(item, depth=0, serialized=False):
     if depth >= 99:
         return '' # Prevent recursion errors
+    key_function = not serialized and KEY_FUNCTIONS_ and get_key_function(item)
+    if key_function:
+        return str(key_function(item))
     if isinstance(item, tuple):
         return serialize_item([serialize_item(i, depth=depth+1) for i in item], depth=depth+1, serialized=True)
     elif isinstance(item, dict):
@@ -110,6 +177,74 @@ def serialize_args(args):
     """
     return str([serialize_item(a) for a in args])
 
+def hash_item(item, depth=0):
+    """
+    Hashes an item the way serialize_item serializes it, without building the string. Like serialize_item it ignores the order of elements in tuples, lists, dicts, and other iterables. Their elements are hashed one at a time and the hashes summed, so memory doesn't grow with the number of elements.
+
+    :param mixed item: The item to hash
+    :param int depth: How deeply nested the item is
+
+    :rtype long: A 160 bit hash
+    """
+    key_function = KEY_FUNCTIONS_ and get_key_function(item)
+    if depth >= 99:
+        token = 'd' # Prevent recursion errors
+    elif key_function:
+        token = 's' + str(key_function(item))
+    elif isinstance(item, dict):
+        return hash_elements(item.iteritems(), depth)
+    elif isinstance(item, (tuple, list)):
+        return hash_elements(item, depth)
+    elif isinstance(item, (types.FunctionType, types.BuiltinMethodType, types.MethodType)):
+        token = 's' + item.__name__
+    elif isinstance(item, unicode):
+        token = 's' + item.encode('utf-8')
+    elif isinstance(item, (str, int, float, long)):
+        token = 's' + str(item)
+    elif isinstance(item, Iterable):
+        return hash_elements(item, depth)
+    elif hasattr(item, '__class__'):
+        token = 's' + item.__class__.__name__
+    else:
+        try:
+            token = 's' + str(item)
+        except:
+            token = 's'
+    return long(sha1(token).hexdigest(), 16)
+
+def hash_elements(elements, depth):
+    """
+    Hashes the elements of a container, in any order.
+
+    :param iterable elements: The elements of the container
+    :param int depth: How deeply nested the container is
+
+    :rtype long: A 160 bit hash
+    """
+    total = 0
+    count = 0
+    for element in elements:
+        total = (total + hash_item(element, depth + 1)) % HASH_MODULUS
+        count = count + 1
+    return long(sha1("c%d:%040x" % (count, total)).hexdigest(), 16)
+
+def hash_args(args, counter_value, kwargs, trace_string):
+    """
+    Returns the hash of a call. The arguments are hashed in order, each with hash_item, and fed into a sha1 along with the counter value, keyword arguments, and trace.
+
+    :param tuple args: The arguments to the call
+    :param int counter_value: The counter value for the trace
+    :param dict kwargs: The keyword arguments to the call
+    :param str trace_string: The stack trace of the call
+
+    :rtype str: A sha1 hexdigest
+    """
+    h = sha1()
+    for arg in args:
+        h.update("%040x" % hash_item(arg))
+    h.update("\n%s\n%040x\n%s\n" % (counter_value, hash_item(kwargs), trace_string))
+    return h.hexdigest()
+
 def seq():
     """
     Counts up sequentially from a number based on the current time
@@ -166,20 +301,64 @@ def recache( methodname=None, filename=None ):
                 deleted = deleted + 1
         return deleted
 
-def get_stack(method_name):
+def describe_code(code):
+    """
+    Returns the module name, the trace string entry, and whether the stack trace stops for frames running code. The file name is worked out the same way inspect.stack() does, but only once per code object.
+
+    :param code code: The code object a frame is running
+
+    :rtype tuple:
+    """
+    try:
+        return FRAMES_[code]
+    except KeyError:
+        module_name = os.path.basename(inspect.getsourcefile(code) or inspect.getfile(code))
+        description = (module_name,
+                       "%s %s " % (module_name, code.co_name),
+                       module_name == 'patch.py' and code.co_name == 'patched_test')
+        FRAMES_[code] = description
+        return description
+
+def get_stack(method_name, stop_at_test=False):
     """
     Returns the stack trace to hash to identify a call descriptor
 
     :param str method_name: The calling method.
+    :param bool stop_at_test: Whether to stop at the test method unittest is running, if there is one, as though it were decorated with patch.
 
     :rtype str:
     """
     global test_suite
-    trace_string      = method_name + " "
-    for f in inspect.stack():
-        module_name = os.path.basename(f[1])
-        method_name = f[3]
-        trace_string = trace_string + "%s %s " % (module_name, method_name)
-        if test_suite and module_name == test_suite or (module_name == 'patch.py' and method_name == 'patched_test'):
-            return trace_string
-    return trace_string
+    trace             = [method_name + " "]
+    frame             = sys._getframe(0)
+    while frame:
+        module_name, entry, stops = describe_code(frame.f_code)
+        trace.append(entry)
+        if test_suite and module_name == test_suite or stops:
+            break
+        if stop_at_test and is_test_frame(frame):
+            trace.append(PATCHED_TEST_ENTRY)
+            break
+        frame = frame.f_back
+    return "".join(trace)
+
+def is_test_frame(frame):
+    """
+    Tests whether a frame is running a test method, called by unittest.
+
+    :param frame frame: Any frame
+
+    :rtype bool:
+    """
+    return frame.f_back is not None and frame.f_back.f_code is RUN_CODE
+
+def find_test_frame():
+    """
+    Returns the frame running the test method unittest is running, or None if it isn't running one.
+
+    :rtype frame:
+    """
+    frame = sys._getframe(1)
+    while frame and not is_test_frame(frame):
+        frame = frame.f_back
+    return frame
@@ -7,6 +7,13 @@ import unittest
 from test.caliendo_test import *
 from test.test_patch import * 
 from test.test_replay import * 
+from test.test_positional_replay import *
+from test.test_backends import *
+from test.test_locking import *
+from test.test_used import *
+from test.test_packets import *
+from test.test_blobs import *
+from test.test_lru import *
 
 from caliendo.db.flatfiles import CACHE
 
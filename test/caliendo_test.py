@@ -8,6 +8,7 @@ import inspect
 import dill as pickle
 import types
 import sys
+import datetime
 import os
 
 os.environ['USE_CALIENDO'] = 'True'
@@ -19,7 +20,7 @@ from caliendo.call_descriptor import CallDescriptor, fetch
 from caliendo.facade import patch, Facade, Wrapper, get_hash, cache
 from caliendo.hooks import CallStack, Hook
 from caliendo import Ignore
-from caliendo.util import recache, serialize_args, serialize_item
+from caliendo.util import recache, serialize_args, serialize_item, hash_item, hash_args
 
 import caliendo
 
@@ -344,6 +345,61 @@ class  CaliendoTestCase(unittest.TestCase):
         assert serialize_args([b]) == str(['b'])
         assert serialize_args([C().c, 1, '2', [3], {'four': 4}]) == str(['c', '1', '2', "['3']", '["[\'4\', \'four\']"]'])
 
+    def test_hash_item(self):
+        def gen():
+            for i in range(10):
+                yield i
+
+        assert hash_item([[1, 2, 3], [4, 5, 6]]) == hash_item([[6, 4, 5], [3, 2, 1]])
+        assert hash_item({'a': {'a': 1, 'b': 2}}) == hash_item({'a': {'b': 2, 'a': 1}})
+        assert hash_item(set(range(10))) == hash_item(gen()) == hash_item(frozenset(range(10)))
+        assert hash_item([TestModel(1, 2), 3]) == hash_item([3, TestModel(4, 5)])
+        assert hash_item([1, 2]) != hash_item([1, 2, 2])
+        assert hash_item([1, [2, 3]]) != hash_item([[1, 2], 3])
+        assert hash_item(range(100000)) == hash_item(range(99999, -1, -1))
+
+    def test_register_key(self):
+        class SubModel(TestModel):
+            pass
+
+        a, b = TestModel(1, 2), TestModel(3, 4)
+        assert serialize_item([a, 1]) == serialize_item([b, 1])
+
+        caliendo.util.register_key(TestModel, lambda model: "TestModel:%s" % model.a)
+        try:
+            @caliendo.util.register_key(datetime.datetime)
+            def datetime_key(d):
+                return d.isoformat()
+
+            assert serialize_item([a, 1]) == str(['1', 'TestModel:1'])
+            assert serialize_item(SubModel(5, 6)) == 'TestModel:5'
+            assert caliendo.util.DISPATCH_[SubModel] is caliendo.util.KEY_FUNCTIONS_[TestModel]
+            assert serialize_item(datetime.datetime(2014, 1, 2)) == '2014-01-02T00:00:00'
+            assert hash_item([a]) != hash_item([b])
+            assert get_hash((a,), 'trace', {}) != get_hash((b,), 'trace', {})
+        finally:
+            caliendo.util.unregister_key(TestModel)
+            caliendo.util.unregister_key(datetime.datetime)
+        assert serialize_item(a) == 'TestModel'
+        assert caliendo.util.KEY_FUNCTIONS_ == {}
+
+    def test_hash_args(self):
+        assert hash_args((1, [2, 3]), 0, {'a': 4}, 'trace') == hash_args((1, [3, 2]), 0, {'a': 4}, 'trace')
+        assert hash_args((1, 2), 0, {}, 'trace') != hash_args((2, 1), 0, {}, 'trace')
+        assert hash_args((1,), 0, {}, 'trace') != hash_args((1,), 1, {}, 'trace')
+        assert hash_args((1,), 0, {}, 'trace') != hash_args((1,), 0, {'a': None}, 'trace')
+
+        hasher = caliendo.config.CALIENDO_HASHER
+        try:
+            caliendo.config.CALIENDO_HASHER = 'compat'
+            compat = get_hash((1, 2), 'trace', {})
+            caliendo.config.CALIENDO_HASHER = 'stream'
+            stream = get_hash((1, 2), 'trace', {})
+        finally:
+            caliendo.config.CALIENDO_HASHER = hasher
+        assert len(stream) == len(compat) == 40
+        assert stream != compat
+
     def test_fetch_call_descriptor(self):
         hash      = hashlib.sha1( "test1" ).hexdigest()
         method    = "test1"
@@ -553,6 +609,88 @@ class  CaliendoTestCase(unittest.TestCase):
         # Classes
         self.assertEquals( c.test_a_class( ).wrapper__unwrap( ).__class__, TestA )
 
+    def test_attributes_are_wrapped_when_used(self):
+        class Expensive(TestC):
+            accessed = []
+
+            @property
+            def connection(self):
+                self.accessed.append('connection')
+                return TestModel(1, 2)
+
+            def Find(self):
+                return 'found'
+
+        c = Facade(Expensive())
+        assert Expensive.accessed == []
+        assert c.wrapper__get_store().keys() == ['callables']
+
+        assert c.methoda() == 'a'
+        assert c.find() == 'found'
+        assert c.connection is c.connection
+        assert c.connection.a == 1
+        assert Expensive.accessed == ['connection']
+        assert sorted(c.wrapper__get_store().keys()) == ['Find', 'callables', 'connection', 'find', 'methoda']
+        assert c.find is c.Find # Wrapped under its real name, so calls get the same keys either way
+
+    def test_wrapping_plan_is_shared_by_type(self):
+        class Client(TestC):
+            pass
+
+        shadowed = Client()
+        shadowed.methodb = lambda: 'shadowed'
+
+        a, b = Facade(Client()), Facade(shadowed)
+        assert a.methoda() == b.methoda() == 'a'
+        assert a.methodb() == 'b'
+        assert b.methodb() == 'shadowed'
+        assert a.primitive_a == 'a'
+        assert a.test_a_class().wrapper__unwrap().__class__ == TestA
+
+        plan = caliendo.facade.PLANS_[(Client, ())]
+        assert sorted(plan.keys()) == ['methoda', 'methodb', 'test_a_class']
+
+        not_callable = Client()
+        not_callable.methodb = 'not callable' # Wrapped after the plan for methodb was made
+        assert Facade(not_callable).methodb == 'not callable'
+        assert Facade(Client(), exclusion_list=[TestA]).methoda() == 'a'
+        excluded = Client()
+        excluded.methoda = TestA()
+        assert Facade(excluded, exclusion_list=[]).methoda.__class__ != TestA
+        assert Facade(excluded, exclusion_list=[TestA]).methoda is excluded.methoda
+        assert caliendo.facade.get_plan(Client(), []) is plan
+        assert caliendo.facade.get_plan(Client(), [TestA]) is not plan
+
+    def test_lazy_instance_is_constructed_once(self):
+        import threading
+
+        class Client(TestC):
+            constructed = []
+            def __init__(self):
+                time.sleep(0.01)
+                self.constructed.append(self)
+
+        c = Facade(cls=Client)
+        assert Client.constructed == []
+        assert c.methoda() == 'a'
+        assert c.methodb() == 'b'
+        assert c.primitive_a == 'a'
+        assert len(Client.constructed) == 1
+
+        c.wrapper__reset()
+        assert c.methoda() == 'a'
+        assert len(Client.constructed) == 2
+
+        lazy = caliendo.facade.LazyBones(Client, (), {})
+        instances = []
+        threads = [threading.Thread(target=lambda: instances.append(lazy.init())) for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(Client.constructed) == 3
+        assert set(instances) == set([Client.constructed[-1]])
+
     def test_model_interface(self):
         a = Facade(TestA())
 
@@ -754,6 +892,34 @@ class  CaliendoTestCase(unittest.TestCase):
         b = pickle.loads(pickling.pickle_with_weak_refs(a))
         self.assertEquals( b, {'a': {'b': {'c': [{}, {}]}}, 'b': {'a': 1, 'b': 2}} )
 
+    def test_pickling_leaves_the_object_alone(self):
+        from caliendo import pickling
+        depth = pickling.MAX_DEPTH
+        pickling.MAX_DEPTH = 2
+        try:
+            model = TestModel(a=TestModel(a={'deep': {'deeper': 1}}, b=2), b=[1, 2])
+            referenced = TestModel(a=1, b=[1, 2])
+            ref = weakref.ref(referenced)
+            a = {'model': model, 'ref': ref, 'refs': [ref, (ref,)], 'f': lambda: 1, 'fs': [lambda: 2], 's': set([1, 2])}
+
+            data = pickling.pickle_with_weak_refs(a)
+            assert data.startswith('\x80\x02') # Protocol 2
+            b = pickle.loads(data)
+
+            assert a['ref'] is ref and a['refs'][1][0] is ref
+            assert model.a.a == {'deep': {'deeper': 1}}
+            assert 'f' in a
+
+            assert b['model'].b == [1, 2]
+            assert b['model'].a.__dict__ == {'a': {}}
+            assert b['ref'].b == [1, 2]
+            assert b['refs'][0].b == [1, 2] and b['refs'][1][0].b == [1, 2]
+            assert 'f' not in b
+            assert b['fs'] == [None]
+            assert b['s'] == set([1, 2])
+        finally:
+            pickling.MAX_DEPTH = depth
+
     def test_cache_positional(self):
 
         def positional(x, y, z):
@@ -1249,6 +1415,57 @@ class  CaliendoTestCase(unittest.TestCase):
         with open(myfile.name) as f:
             self.assertEquals(f.read(), '2')
 
+    def test_flatfiles_reload_only_when_changed(self):
+        hash = hashlib.sha1( "reload only when changed" ).hexdigest()
+        flatfiles.load_cache()
+        loaded = flatfiles.CACHE_
+
+        flatfiles.select_io( hash )
+        flatfiles.select_test( hash )
+        self.assertTrue( flatfiles.CACHE_ is loaded )
+
+        pid = os.fork()
+        if pid:
+            os.waitpid(pid, 0)
+        else:
+            flatfiles.insert_test( hash, 0, 7 )
+            os._exit(0)
+
+        self.assertEquals( flatfiles.select_test( hash ), [ ( 0, 7 ) ] )
+        self.assertTrue( flatfiles.CACHE_ is not loaded )
+
+        flatfiles.insert_test( hash, 0, 8 )
+        written = flatfiles.CACHE_
+        self.assertEquals( flatfiles.select_test( hash ), [ ( 0, 8 ) ] )
+        self.assertTrue( flatfiles.CACHE_ is written )
+
+    def test_flatfiles_write_behind(self):
+        from caliendo import config
+        hashes = [ hashlib.sha1( "write behind %s" % i ).hexdigest() for i in range(5) ]
+        flatfiles.flush()
+        before = flatfiles.get_stat()
+        config.CALIENDO_WRITE_BEHIND = True
+        try:
+            for h in hashes:
+                flatfiles.insert_test( h, 0, 1 )
+                flatfiles.insert_io({ 'hash': h, 'stack': '', 'methodname': 'a', 'returnval': 'b', 'args': 'c', 'packet_num': 0 })
+
+            self.assertEquals( flatfiles.get_stat(), before )
+            self.assertEquals( len( flatfiles.JOURNAL_ ), 10 )
+            for h in hashes:
+                self.assertEquals( flatfiles.select_test( h ), [ ( 0, 1 ) ] )
+                self.assertEquals( len( flatfiles.select_io( h ) ), 1 )
+
+            flatfiles.flush()
+            self.assertEquals( flatfiles.JOURNAL_, [] )
+            self.assertNotEquals( flatfiles.get_stat(), before )
+            flatfiles.load_cache(True)
+            for h in hashes:
+                self.assertEquals( flatfiles.select_test( h ), [ ( 0, 1 ) ] )
+        finally:
+            config.CALIENDO_WRITE_BEHIND = False
+            flatfiles.flush()
+
     def test_load_and_save_stack(self):
         cs = CallStack(self.test_load_and_save_stack)
 
@@ -1273,6 +1490,63 @@ class  CaliendoTestCase(unittest.TestCase):
         assert loaded.hooks['fake-hash2'].hash == 'fake-hash2'
         assert loaded.hooks['fake-hash3'].hash == 'fake-hash3'
 
+    def test_counter_seeds(self):
+        from caliendo import counter
+        from caliendo.db.memory import MemoryBackend
+
+        backend = MemoryBackend()
+        backend.insert_test(hashlib.sha1('seeded trace').hexdigest(), 0, 5)
+        previous = caliendo.db.set_backend(backend)
+        counters, seeds, pending = dict(getattr(counter, '__counters')), counter.SEEDS_, set(counter.PENDING_)
+        getattr(counter, '__counters').clear()
+        counter.SEEDS_ = None
+        counter.PENDING_.clear()
+        try:
+            assert [counter.get_from_trace('new trace') for i in range(3)] == [0, 1, 2]
+            assert [counter.get_from_trace('seeded trace') for i in range(2)] == [5, 6]
+            assert len(backend.select_tests()) == 1
+
+            counter.flush()
+            assert backend.select_tests() == {hashlib.sha1('new trace').hexdigest(): (0, 0),
+                                              hashlib.sha1('seeded trace').hexdigest(): (0, 5)}
+            assert counter.PENDING_ == set()
+
+            getattr(counter, '__counters').clear()
+            counter.SEEDS_ = None
+            assert counter.get_from_trace('new trace') == 0
+            assert counter.PENDING_ == set()
+        finally:
+            caliendo.db.set_backend(previous)
+            getattr(counter, '__counters').clear()
+            getattr(counter, '__counters').update(counters)
+            counter.SEEDS_ = seeds
+            counter.PENDING_.update(pending)
+
+    def test_get_stack_matches_inspect(self):
+        def inspected(method_name):
+            trace_string = method_name + " util.py get_stack "
+            for f in inspect.stack()[1:]:
+                trace_string = trace_string + "%s %s " % (os.path.basename(f[1]), f[3])
+            return trace_string
+
+        def nested():
+            return caliendo.util.get_stack('find'), inspected('find')
+
+        stack, expected = nested()
+        assert stack == expected
+        assert stack.startswith('find util.py get_stack caliendo_test.py nested caliendo_test.py test_get_stack_matches_inspect ')
+        assert caliendo.util.describe_code(nested.func_code) is caliendo.util.describe_code(nested.func_code)
+
+    def test_get_stack_stops_at_patched_test(self):
+        stacks = []
+
+        @patch('test.api.services.foo.find', rvalue=[])
+        def test():
+            stacks.append(caliendo.util.get_stack('find'))
+
+        test()
+        assert stacks[0] == 'find util.py get_stack caliendo_test.py test patch.py patched_test '
+
 
 if __name__ == '__main__':
     unittest.main()
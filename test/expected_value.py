@@ -5,7 +5,7 @@ os.environ['USE_CALIENDO'] = 'True'
 
 import caliendo
 
-from caliendo.db.flatfiles import LOG_FILEPATH
+from caliendo.db.flatfiles import reset_used
 from caliendo.db.flatfiles import delete_from_directory_by_hashes
 from caliendo.db.flatfiles import read_all
 from caliendo.db.flatfiles import purge
@@ -50,8 +50,7 @@ class TestsWithShell(unittest.TestCase):
       assert len(all_hashes['cache']) == 0
       assert len(all_hashes['seeds']) == 0
 
-      with open(LOG_FILEPATH, 'w+') as fp:
-          pass
+      reset_used()
 
       expected_value.is_equal_to(find_foo(1))
       expected_value.is_equal_to(find_biz(1))
@@ -63,8 +62,7 @@ class TestsWithShell(unittest.TestCase):
       assert len(spam['cache']) != 0
       assert len(spam['seeds']) != 0
       
-      with open(LOG_FILEPATH, 'w+') as fp:
-          pass
+      reset_used()
 
       expected_value.is_equal_to(find_foo(1))
       expected_value.is_equal_to(find_biz(1))
@@ -0,0 +1,509 @@
+import os
+import sys
+import time
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+os.environ['USE_CALIENDO'] = 'True'
+
+from caliendo import db
+from caliendo.db import flatfiles
+from caliendo.db import sharded
+from caliendo.db import sqlite
+from caliendo.db import compiled
+from caliendo.db import logstore
+from caliendo.db import used
+from caliendo import config
+from caliendo.db.backend import Backend
+from caliendo.db.memory import MemoryBackend
+from caliendo.hooks import CallStack, Hook
+
+BENCHMARK_SIZE = int(os.environ.get('CALIENDO_BENCHMARK_SIZE', 200))
+
+def stack_callback(cd):
+    pass
+
+def packet(hash, packet_num, returnval='returnval'):
+    return {'hash': hash, 'stack': 'stack', 'methodname': 'method', 'returnval': returnval, 'args': 'args', 'packet_num': packet_num}
+
+class BackendConformance(object):
+    """
+    The behavior every storage backend must have. Subclasses implement get_backend, returning a backend with empty storage.
+
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.backend = self.get_backend()
+
+    def tearDown(self):
+        self.backend.flush()
+        shutil.rmtree(self.root)
+
+    def get_backend(self):
+        raise NotImplementedError
+
+    def hash(self, s):
+        return hashlib.sha1(s).hexdigest()
+
+    def test_is_a_backend(self):
+        self.assertTrue(isinstance(self.backend, Backend))
+
+    def test_get_put_delete_iterate(self):
+        h = self.hash('primitives')
+        self.assertEquals(self.backend.get('seeds', h), None)
+        self.backend.put('seeds', h, {'hash': h, 'random': 0, 'seq': 3})
+        self.assertEquals(self.backend.get('seeds', h), {'hash': h, 'random': 0, 'seq': 3})
+        self.assertEquals(list(self.backend.iterate('seeds')), [h])
+        self.backend.delete('seeds', h)
+        self.assertEquals(self.backend.get('seeds', h), None)
+        self.assertEquals(list(self.backend.iterate('seeds')), [])
+        self.backend.delete('seeds', h) # Deleting what isn't there is fine.
+
+        self.backend.put('cache', h, {0: packet(h, 0), 1: packet(h, 1)})
+        self.assertEquals(self.backend.get('cache', h), {0: packet(h, 0), 1: packet(h, 1)})
+        self.backend.put('evs', h, [{'call_hash': h, 'packet_num': 0, 'expected_value': 'ev'}])
+        self.assertEquals(self.backend.get('evs', h), [{'call_hash': h, 'packet_num': 0, 'expected_value': 'ev'}])
+
+    def test_get_doesnt_record_use(self):
+        h = self.hash('raw read')
+        self.backend.put('cache', h, {0: packet(h, 0)})
+        self.backend.put('evs', h, [{'call_hash': h, 'packet_num': 0, 'expected_value': 'ev'}])
+        used.flush()
+        self.assertTrue(self.backend.get('cache', h))
+        self.assertTrue(self.backend.get('evs', h))
+        self.assertFalse(h in used.USED_['cache'] or h in used.USED_['evs'])
+
+    def test_insert_select_delete_io(self):
+        h = self.hash('io')
+        other = self.hash('other io')
+        self.assertEquals(self.backend.select_io(h), [])
+        self.backend.insert_io(packet(h, 0, 'a'))
+        self.backend.insert_io(packet(h, 1, 'b'))
+        self.backend.insert_io(packet(other, 0, 'c'))
+        self.assertEquals(self.backend.select_io(h), [(h, 'stack', 'method', 'a', 'args', 0),
+                                                      (h, 'stack', 'method', 'b', 'args', 1)])
+        self.assertEquals(sorted(self.backend.get_unique_hashes()), sorted([h, other]))
+        self.assertEquals(self.backend.get_packets('cache'), {h: 2, other: 1})
+
+        self.backend.insert_io(packet(h, 1, 'replaced'))
+        self.assertEquals(self.backend.select_io(h)[1][3], 'replaced')
+
+        self.assertEquals(self.backend.delete_io(h), 2)
+        self.assertEquals(self.backend.select_io(h), [])
+        self.assertEquals(self.backend.get_unique_hashes(), [other])
+
+    def test_binary_packets(self):
+        h = self.hash('binary')
+        garbage = os.urandom(1024 * 64)
+        self.backend.insert_io(packet(h, 0, garbage))
+        self.assertEquals(self.backend.select_io(h)[0][3], garbage)
+
+    def test_expected_values(self):
+        h = self.hash('evs')
+        self.assertEquals(self.backend.select_expected_value(h), [])
+        self.assertEquals(self.backend.select_expected_value(None), [])
+        self.backend.insert_expected_value({'call_hash': h, 'packet_num': 0, 'expected_value': 'a'})
+        self.backend.insert_expected_value({'call_hash': h, 'packet_num': 1, 'expected_value': 'b'})
+        self.assertEquals(self.backend.select_expected_value(h), [(h, 'a', 0), (h, 'b', 1)])
+
+    def test_seeds(self):
+        h = self.hash('seeds')
+        self.assertEquals(self.backend.select_test(h), None)
+        self.backend.insert_test(h, 0, 5)
+        self.assertEquals(self.backend.select_test(h), [(0, 5)])
+        self.backend.insert_test(h, 0, 6)
+        self.assertEquals(self.backend.select_test(h), [(0, 6)])
+
+    def test_bulk_seeds(self):
+        h1, h2 = self.hash('seed 1'), self.hash('seed 2')
+        self.assertEquals(self.backend.select_tests(), {})
+        self.backend.insert_tests([(h1, 0, 0), (h2, 1, 5)])
+        self.backend.insert_tests([])
+        self.backend.flush()
+        self.assertEquals(self.backend.select_tests(), {h1: (0, 0), h2: (1, 5)})
+        self.assertEquals(self.backend.select_test(h2), [(1, 5)])
+
+    def test_stacks(self):
+        cs = CallStack()
+        cs.module = 'test.test_backends'
+        cs.caller = 'test_stacks'
+        cs.calls = ['a', 'b']
+        cs.add_hook(Hook('a', stack_callback))
+
+        self.assertEquals(self.backend.load_stack(cs), None)
+        self.backend.save_stack(cs)
+        loaded = self.backend.load_stack(cs)
+        self.assertEquals(loaded.calls, ['a', 'b'])
+        self.assertEquals(loaded.hooks['a'].hash, 'a')
+        self.assertEquals(list(self.backend.iterate('stacks')), ['test.test_backends.test_stacks'])
+
+        self.backend.delete_stack(cs)
+        self.assertEquals(self.backend.load_stack(cs), None)
+
+    def test_purge(self):
+        used = [self.hash('used %s' % i) for i in range(3)]
+        unused = [self.hash('unused %s' % i) for i in range(3)]
+        for h in used + unused:
+            self.backend.insert_io(packet(h, 0))
+            self.backend.insert_test(h, 0, 0)
+            self.backend.insert_expected_value({'call_hash': h, 'packet_num': 0, 'expected_value': 'ev'})
+
+        self.backend.reset_used()
+        for h in used:
+            self.backend.select_io(h)
+            self.backend.select_test(h)
+            self.backend.select_expected_value(h)
+        self.backend.purge()
+
+        all_hashes = self.backend.read_all()
+        for kind in ('cache', 'seeds', 'evs'):
+            self.assertEquals(sorted(all_hashes[kind]), sorted(used))
+
+    def test_flush(self):
+        h = self.hash('flush')
+        self.backend.insert_test(h, 0, 1)
+        self.backend.flush()
+        self.assertEquals(self.backend.select_test(h), [(0, 1)])
+
+    def test_benchmark(self):
+        hashes = [self.hash('benchmark %s' % i) for i in range(BENCHMARK_SIZE)]
+        returnval = 'x' * 1024
+
+        start = time.time()
+        for h in hashes:
+            self.backend.delete_io(h)
+            self.backend.insert_io(packet(h, 0, returnval))
+        self.backend.flush()
+        written = time.time() - start
+
+        start = time.time()
+        for h in hashes:
+            self.assertEquals(self.backend.select_io(h)[0][3], returnval)
+        read = time.time() - start
+
+        if os.environ.get('CALIENDO_BENCHMARK') == 'True':
+            sys.stderr.write("\n%s: %d writes/s, %d reads/s\n" % (self.backend.name,
+                                                                 BENCHMARK_SIZE / max(written, 1e-6),
+                                                                 BENCHMARK_SIZE / max(read, 1e-6)))
+
+
+class MemoryBackendTestCase(BackendConformance, unittest.TestCase):
+    def get_backend(self):
+        return MemoryBackend()
+
+
+class FlatfilesBackendTestCase(BackendConformance, unittest.TestCase):
+    def setUp(self):
+        self.cache = flatfiles.CACHE
+        BackendConformance.setUp(self)
+
+    def tearDown(self):
+        BackendConformance.tearDown(self)
+        flatfiles.CACHE = self.cache
+        flatfiles.load_cache(True)
+
+    def get_backend(self):
+        flatfiles.CACHE = os.path.join(self.root, 'cache')
+        flatfiles.load_cache(True)
+        return flatfiles.FlatfilesBackend()
+
+
+class ShardedBackendTestCase(BackendConformance, unittest.TestCase):
+    def setUp(self):
+        self.shards = sharded.SHARDS
+        BackendConformance.setUp(self)
+
+    def tearDown(self):
+        BackendConformance.tearDown(self)
+        sharded.SHARDS = self.shards
+
+    def get_backend(self):
+        sharded.SHARDS = os.path.join(self.root, 'shards')
+        return sharded.ShardedBackend()
+
+    def test_entries_are_sharded_by_hash_prefix(self):
+        h = self.hash('sharded')
+        self.backend.insert_io(packet(h, 0))
+        self.assertEquals(sharded.get_path('cache', h), os.path.join(self.root, 'shards', 'cache', h[:2], h))
+        self.assertTrue(os.path.exists(sharded.get_path('cache', h)))
+
+
+class SqliteBackendTestCase(BackendConformance, unittest.TestCase):
+    def setUp(self):
+        self.database = sqlite.DATABASE
+        BackendConformance.setUp(self)
+
+    def tearDown(self):
+        BackendConformance.tearDown(self)
+        sqlite.DATABASE = self.database
+        sqlite.CONNECTION_ = None
+
+    def get_backend(self):
+        sqlite.DATABASE = os.path.join(self.root, 'cache.sqlite')
+        sqlite.CONNECTION_ = None
+        return sqlite.SqliteBackend()
+
+    def test_wal_mode(self):
+        self.assertEquals(sqlite.get_connection().execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+
+    def test_writes_from_forked_processes(self):
+        h = self.hash('forked')
+        self.backend.insert_io(packet(h, 0))
+        pid = os.fork()
+        if pid:
+            os.waitpid(pid, 0)
+        else:
+            self.backend.insert_io(packet(h, 1))
+            os._exit(0)
+        self.assertEquals(len(self.backend.select_io(h)), 2)
+
+
+class CompilingBackend(compiled.CompiledBackend):
+    """
+    Recompiles the cache on every write so the conformance tests read through the compiled file.
+
+    """
+    def __init__(self):
+        compiled.CompiledBackend.__init__(self)
+        self.source = MemoryBackend()
+        compiled.compile_cache(self.source)
+
+    def put(self, namespace, key, value):
+        self.source.put(namespace, key, value)
+        compiled.compile_cache(self.source)
+
+    def delete(self, namespace, key):
+        self.source.delete(namespace, key)
+        compiled.compile_cache(self.source)
+
+    def purge(self):
+        Backend.purge(self)
+
+
+class CompiledBackendTestCase(BackendConformance, unittest.TestCase):
+    def setUp(self):
+        self.compiled = compiled.COMPILED
+        BackendConformance.setUp(self)
+
+    def tearDown(self):
+        BackendConformance.tearDown(self)
+        compiled.COMPILED = self.compiled
+        compiled.MAP_ = None
+
+    def get_backend(self):
+        compiled.COMPILED = os.path.join(self.root, 'cache.compiled')
+        return CompilingBackend()
+
+    def test_read_only(self):
+        h = self.hash('read only')
+        self.backend.source.put('seeds', h, {'hash': h, 'random': 0, 'seq': 1})
+        compiled.compile_cache(self.backend.source)
+        with open(compiled.COMPILED, 'rb') as f:
+            before = f.read()
+
+        backend = compiled.CompiledBackend()
+        self.assertEquals(backend.select_test(h), [(0, 1)])
+        backend.insert_test(h, 0, 2)
+        self.assertEquals(backend.select_test(h), [(0, 2)])
+        backend.delete('seeds', h)
+        self.assertEquals(backend.select_test(h), None)
+        self.assertEquals(backend.iterate('seeds'), [])
+        self.assertRaises(Exception, backend.purge)
+
+        with open(compiled.COMPILED, 'rb') as f:
+            self.assertEquals(f.read(), before)
+        self.assertEquals(compiled.CompiledBackend().select_test(h), [(0, 1)])
+
+    def test_index_is_sorted(self):
+        hashes = [self.hash('sorted %s' % i) for i in range(50)]
+        for h in hashes:
+            self.backend.source.put('cache', h, {0: packet(h, 0)})
+            self.backend.source.put('seeds', h, {'hash': h, 'random': 0, 'seq': 0})
+        self.assertEquals(compiled.compile_cache(self.backend.source), 100)
+
+        m = compiled.get_map()
+        keys = [m[compiled.HEADER.size + i * compiled.RECORD.size:][:compiled.KEY_LENGTH] for i in range(100)]
+        self.assertEquals(keys, sorted(keys))
+        for h in hashes:
+            self.assertEquals(compiled.read_entry('cache', h), {0: packet(h, 0)})
+        self.assertEquals(compiled.read_entry('cache', self.hash('missing')), None)
+
+    def test_forked_readers(self):
+        h = self.hash('forked readers')
+        self.backend.put('seeds', h, {'hash': h, 'random': 0, 'seq': 3})
+        compiled.get_map()
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid:
+            os.close(w)
+            os.waitpid(pid, 0)
+            self.assertEquals(os.read(r, 100), '3')
+            os.close(r)
+        else:
+            os.write(w, str(self.backend.select_test(h)[0][1]))
+            os._exit(0)
+
+    def test_missing_cache(self):
+        os.unlink(compiled.COMPILED)
+        compiled.MAP_ = None
+        with self.assertRaisesRegexp(Exception, r"No compiled cache at"):
+            compiled.CompiledBackend().select_io(self.hash('missing'))
+
+
+class LogBackendTestCase(BackendConformance, unittest.TestCase):
+    def setUp(self):
+        self.logdir = logstore.LOGDIR
+        self.segment_size = config.CALIENDO_LOG_SEGMENT_SIZE
+        self.compact_ratio = logstore.COMPACT_RATIO
+        BackendConformance.setUp(self)
+
+    def tearDown(self):
+        if logstore.COMPACTION_:
+            logstore.COMPACTION_.join()
+        BackendConformance.tearDown(self)
+        logstore.LOGDIR = self.logdir
+        config.CALIENDO_LOG_SEGMENT_SIZE = self.segment_size
+        logstore.COMPACT_RATIO = self.compact_ratio
+        self.forget()
+
+    def get_backend(self):
+        logstore.LOGDIR = os.path.join(self.root, 'log')
+        self.forget()
+        return logstore.LogBackend()
+
+    def forget(self):
+        """
+        Drops this process's index, as if it had just started.
+
+        """
+        logstore.INDEX_ = None
+        logstore.SEGMENTS_ = []
+        logstore.POSITION_ = 0
+        logstore.DIR_STAT_ = None
+        logstore.FILES_ = {}
+        logstore.APPEND_ = None
+
+    def segments(self):
+        return logstore.list_segments()
+
+    def test_writes_only_append(self):
+        h = self.hash('append only')
+        self.backend.insert_test(h, 0, 1)
+        path = logstore.get_path(self.segments()[-1])
+        with open(path, 'rb') as f:
+            before = f.read()
+        self.backend.insert_test(h, 0, 2)
+        self.backend.delete('seeds', h)
+        with open(path, 'rb') as f:
+            after = f.read()
+        self.assertTrue(after.startswith(before))
+        self.assertTrue(len(after) > len(before))
+        self.assertEquals(self.backend.select_test(h), None)
+
+    def test_index_is_rebuilt_from_the_log(self):
+        hashes = [self.hash('rebuilt %s' % i) for i in range(10)]
+        for i, h in enumerate(hashes):
+            self.backend.insert_test(h, 0, i)
+        self.backend.delete('seeds', hashes[0])
+        self.forget()
+        self.assertEquals(self.backend.select_test(hashes[0]), None)
+        for i, h in enumerate(hashes[1:]):
+            self.assertEquals(self.backend.select_test(h), [(0, i + 1)])
+
+    def test_torn_record_is_skipped(self):
+        h = self.hash('torn')
+        self.backend.insert_test(h, 0, 1)
+        with open(logstore.get_path(self.segments()[-1]), 'ab') as f:
+            f.write(logstore.HEADER.pack(logstore.MARKER, logstore.PUT, 2, 40, 100, 0) + h[:20]) # A crash mid-write
+        self.backend.insert_test(h, 0, 2)
+        self.forget()
+        self.assertEquals(self.backend.select_test(h), [(0, 2)])
+
+    def test_roll_over_and_compact(self):
+        config.CALIENDO_LOG_SEGMENT_SIZE = 1024
+        logstore.COMPACT_RATIO = 2 # Never in the background
+        h = self.hash('compact')
+        others = [self.hash('compact %s' % i) for i in range(5)]
+        for i in range(50):
+            self.backend.insert_io(packet(h, 0, 'x' * 100 + str(i)))
+        for o in others:
+            self.backend.insert_test(o, 0, 1)
+        self.assertTrue(len(self.segments()) > 1)
+
+        self.assertTrue(logstore.compact())
+        segments = self.segments()
+        self.assertEquals(len(segments), 2)
+        self.assertTrue(os.path.exists(logstore.get_path(segments[0]) + '.idx'))
+        self.assertTrue(os.path.getsize(logstore.get_path(segments[0])) < 1024)
+        self.assertEquals(self.backend.select_io(h)[0][3], 'x' * 100 + '49')
+
+        self.forget()
+        self.assertEquals(self.backend.select_io(h)[0][3], 'x' * 100 + '49')
+        for o in others:
+            self.assertEquals(self.backend.select_test(o), [(0, 1)])
+
+    def test_background_compaction(self):
+        config.CALIENDO_LOG_SEGMENT_SIZE = 1024
+        h = self.hash('background')
+        for i in range(100):
+            self.backend.insert_test(h, 0, i)
+        self.assertTrue(logstore.COMPACTION_ is not None)
+        logstore.COMPACTION_.join()
+        self.assertTrue(len(self.segments()) < 100 * 80 / 1024)
+        self.assertEquals(self.backend.select_test(h), [(0, 99)])
+
+    def test_writes_from_forked_processes(self):
+        hashes = [self.hash('forked log %s' % i) for i in range(4)]
+        self.backend.insert_test(hashes[0], 0, 0)
+        pids = []
+        for h in hashes:
+            pid = os.fork()
+            if not pid:
+                self.backend.insert_test(h, 0, 1)
+                os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        for h in hashes:
+            self.assertEquals(self.backend.select_test(h), [(0, 1)])
+
+    def test_purge_compacts(self):
+        used, unused = self.hash('purge used'), self.hash('purge unused')
+        self.backend.insert_io(packet(used, 0))
+        self.backend.insert_io(packet(unused, 0))
+        self.backend.reset_used()
+        self.backend.select_io(used)
+        self.backend.purge()
+        self.assertEquals(self.backend.get_unique_hashes(), [used])
+        with open(logstore.get_path(self.segments()[0]), 'rb') as f:
+            self.assertTrue(unused not in f.read())
+
+
+class RegistryTestCase(unittest.TestCase):
+    def test_set_backend(self):
+        backend = MemoryBackend()
+        previous = db.set_backend(backend)
+        try:
+            self.assertTrue(db.get_backend() is backend)
+            h = hashlib.sha1('registry').hexdigest()
+            db.insert_io(packet(h, 0))
+            self.assertEquals(len(backend.select_io(h)), 1)
+        finally:
+            db.set_backend(previous)
+
+    def test_register_backend(self):
+        db.register_backend('test-memory', MemoryBackend)
+        try:
+            self.assertTrue(isinstance(db.load_backend('test-memory'), MemoryBackend))
+            self.assertTrue(isinstance(db.load_backend('sharded'), sharded.ShardedBackend))
+        finally:
+            del db.BACKENDS['test-memory']
+
+    def test_unknown_backend(self):
+        with self.assertRaisesRegexp(Exception, r"Unknown caliendo backend: nope"):
+            db.load_backend('nope')
+
+if __name__ == '__main__':
+    unittest.main()
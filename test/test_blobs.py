@@ -0,0 +1,105 @@
+import os
+import array
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+os.environ['USE_CALIENDO'] = 'True'
+
+from caliendo import db
+from caliendo import lru
+from caliendo import config
+from caliendo import call_descriptor
+from caliendo import expected_value
+from caliendo.db import blobs
+from caliendo.call_descriptor import CallDescriptor
+from caliendo.expected_value import ExpectedValue
+from caliendo.db.memory import MemoryBackend
+
+class BlobTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.blobdir = blobs.BLOBDIR
+        blobs.BLOBDIR = os.path.join(self.root, 'blobs')
+        self.threshold = config.CALIENDO_BLOB_THRESHOLD
+        config.CALIENDO_BLOB_THRESHOLD = 1024
+        self.backend = MemoryBackend()
+        self.previous = db.set_backend(self.backend)
+
+    def tearDown(self):
+        db.set_backend(self.previous)
+        config.CALIENDO_BLOB_THRESHOLD = self.threshold
+        config.CALIENDO_BLOB_VIEWS = False
+        blobs.BLOBDIR = self.blobdir
+        shutil.rmtree(self.root)
+
+    def hash(self, s):
+        return hashlib.sha1(s).hexdigest()
+
+    def save_call(self, name, returnval):
+        h = self.hash(name)
+        CallDescriptor(hash=h, stack='stack', method='method', returnval=returnval, args=('small',)).save()
+        return h
+
+    def test_large_values_are_stored_out_of_band(self):
+        data = os.urandom(4096)
+        h = self.save_call('large', {'data': data, 'copy': data, 'small': 'x' * 10})
+
+        self.assertEquals(os.listdir(blobs.BLOBDIR), [hashlib.sha1(data).hexdigest()])
+        self.assertTrue(len(self.backend.select_io(h)[0][3]) < 1024)
+        self.assertEquals(call_descriptor.fetch(h).returnval, {'data': data, 'copy': data, 'small': 'x' * 10})
+
+    def test_l1_counts_blobs(self):
+        lru.clear_all()
+        values = [os.urandom(4096), array.array('d', range(1024))]
+        h = self.save_call('l1 size', values)
+        call_descriptor.fetch(h)
+        self.assertTrue(call_descriptor.L1_.stats()['bytes'] > 4096 + 8192)
+
+        ev = self.hash('l1 size expected value')
+        ExpectedValue(call_hash=ev, expected_value=values).save()
+        expected_value.fetch(ev)
+        self.assertTrue(expected_value.L1_.stats()['bytes'] > 4096 + 8192)
+
+    def test_views(self):
+        data = os.urandom(4096)
+        h = self.save_call('view', data)
+        config.CALIENDO_BLOB_VIEWS = True
+        returnval = call_descriptor.fetch(h).returnval
+        self.assertTrue(isinstance(returnval, buffer))
+        self.assertEquals(returnval[:], data)
+
+    def test_bytearrays_and_arrays(self):
+        values = [bytearray(os.urandom(2048)), array.array('d', range(1024))]
+        h = self.save_call('arrays', values)
+        self.assertEquals(len(os.listdir(blobs.BLOBDIR)), 2)
+        self.assertEquals(call_descriptor.fetch(h).returnval, values)
+
+        ev = self.hash('expected value')
+        ExpectedValue(call_hash=ev, expected_value=values).save()
+        self.assertEquals(expected_value.fetch(ev).expected_value, values)
+
+    def test_threshold_below_reference_length(self):
+        config.CALIENDO_BLOB_THRESHOLD = 16
+        h = self.save_call('tiny threshold', ['x' * 100, 'y' * 20, 'z'])
+        self.assertEquals(len(os.listdir(blobs.BLOBDIR)), 2)
+        self.assertEquals(call_descriptor.fetch(h).returnval, ['x' * 100, 'y' * 20, 'z'])
+
+    def test_missing_blob(self):
+        h = self.save_call('missing', os.urandom(4096))
+        shutil.rmtree(blobs.BLOBDIR)
+        self.assertRaisesRegexp(Exception, "Missing caliendo blob", call_descriptor.fetch, h)
+
+    def test_purge(self):
+        kept = self.save_call('kept', 'k' * 2048)
+        deleted = self.save_call('deleted', 'd' * 2048)
+        self.backend.delete_io(deleted)
+        self.assertEquals(len(os.listdir(blobs.BLOBDIR)), 2)
+
+        self.assertEquals(blobs.purge(self.backend), 1)
+        self.assertEquals(os.listdir(blobs.BLOBDIR), [hashlib.sha1('k' * 2048).hexdigest()])
+        self.assertEquals(call_descriptor.fetch(kept).returnval, 'k' * 2048)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+os.environ['USE_CALIENDO'] = 'True'
+
+from caliendo.db import flatfiles
+from caliendo.db.locking import FileLock
+
+class LockingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def hold_in_child(self, shared=False, seconds=0.3):
+        """
+        Forks a child that takes the lock, holds it for a while, and exits. Returns once the child has the lock.
+
+        """
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid:
+            os.close(w)
+            os.read(r, 1)
+            os.close(r)
+            return pid
+        with FileLock(self.path, shared=shared):
+            os.write(w, '.')
+            time.sleep(seconds)
+        os._exit(0)
+
+    def test_exclusive_lock_times_out(self):
+        pid = self.hold_in_child()
+        try:
+            with self.assertRaisesRegexp(Exception, r"Timed out after 0.05 seconds waiting for the lock on .*, last held exclusively by pid {0}".format(pid)):
+                FileLock(self.path, timeout=0.05).acquire()
+        finally:
+            os.waitpid(pid, 0)
+
+    def test_exclusive_lock_waits_for_holder(self):
+        pid = self.hold_in_child(seconds=0.2)
+        start = time.time()
+        with FileLock(self.path, timeout=5):
+            self.assertTrue(time.time() - start >= 0.1)
+        os.waitpid(pid, 0)
+
+    def test_shared_locks(self):
+        pid = self.hold_in_child(shared=True)
+        try:
+            with FileLock(self.path, shared=True, timeout=0.05):
+                pass
+            self.assertRaises(Exception, FileLock(self.path, timeout=0.05).acquire)
+        finally:
+            os.waitpid(pid, 0)
+        with FileLock(self.path, timeout=0.05):
+            pass
+
+    def test_crashed_holder_leaves_no_stale_lock(self):
+        pid = os.fork()
+        if not pid:
+            FileLock(self.path).acquire()
+            os._exit(1)
+        os.waitpid(pid, 0)
+        self.assertTrue(os.path.exists(self.path))
+        with FileLock(self.path, timeout=0.05):
+            pass
+
+    def test_concurrent_flatfiles_writers(self):
+        cache, lockfile = flatfiles.CACHE, flatfiles.LOCKFILE
+        flatfiles.CACHE = os.path.join(self.root, 'cache')
+        flatfiles.LOCKFILE = self.path
+        flatfiles.load_cache(True)
+        try:
+            hashes = [hashlib.sha1('concurrent %s' % i).hexdigest() for i in range(8)]
+            pids = []
+            for h in hashes:
+                pid = os.fork()
+                if not pid:
+                    for seq in range(5):
+                        flatfiles.insert_test(h, 0, seq)
+                    os._exit(0)
+                pids.append(pid)
+            for pid in pids:
+                os.waitpid(pid, 0)
+
+            flatfiles.load_cache(True)
+            for h in hashes:
+                self.assertEquals(flatfiles.select_test(h), [(0, 4)])
+            self.assertEquals([f for f in os.listdir(self.root) if f.startswith('.tmp-')], [])
+        finally:
+            flatfiles.CACHE, flatfiles.LOCKFILE = cache, lockfile
+            flatfiles.load_cache(True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import os
+import hashlib
+import unittest
+
+os.environ['USE_CALIENDO'] = 'True'
+
+from caliendo import db
+from caliendo import lru
+from caliendo import pickling
+from caliendo import config
+from caliendo import call_descriptor
+from caliendo import expected_value
+from caliendo.call_descriptor import CallDescriptor
+from caliendo.expected_value import ExpectedValue
+from caliendo.db.memory import MemoryBackend
+
+class CountingBackend(MemoryBackend):
+    """
+    A memory backend counting how many times calls are read from it.
+
+    """
+    def __init__(self):
+        MemoryBackend.__init__(self)
+        self.selects = 0
+
+    def select_io(self, hash):
+        self.selects += 1
+        return MemoryBackend.select_io(self, hash)
+
+
+class LRUTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = CountingBackend()
+        self.previous = db.set_backend(self.backend)
+        self.policy = config.CALIENDO_L1_COPY
+
+    def tearDown(self):
+        db.set_backend(self.previous)
+        config.CALIENDO_L1_COPY = self.policy
+
+    def hash(self, s):
+        return hashlib.sha1(s).hexdigest()
+
+    def save_call(self, returnval):
+        h = self.hash('call')
+        CallDescriptor(hash=h, stack='stack', method='method', returnval=returnval, args=(1, 'two')).save()
+        return h
+
+    def test_eviction(self):
+        cache = lru.LRU(2, 10)
+        cache.put('a', 'A', 3)
+        cache.put('b', 'B', 3)
+        self.assertEquals(cache.get('a'), 'A')
+        cache.put('c', 'C', 3) # Evicts b, the least recently used
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('c'), 'C')
+        cache.put('d', 'D', 6) # Evicts a to stay within 10 bytes
+        self.assertEquals(cache.get('a'), None)
+        cache.put('e', 'E', 11) # Too big to keep
+        self.assertEquals(cache.get('e'), None)
+        self.assertEquals(cache.stats(), {'hits': 2, 'misses': 3, 'evictions': 2, 'entries': 2, 'bytes': 9})
+
+        disabled = lru.LRU(0, 10)
+        disabled.put('a', 'A', 1)
+        self.assertEquals(disabled.get('a'), None)
+
+    def test_fetch_decodes_once(self):
+        h = self.save_call({'a': [1, 2, 3]})
+        hits = call_descriptor.L1_.hits
+        for i in range(5):
+            cd = call_descriptor.fetch(h)
+            self.assertEquals(cd.returnval, {'a': [1, 2, 3]})
+            self.assertEquals(cd.args, (1, 'two'))
+            self.assertEquals(cd.stack, 'stack')
+            self.assertEquals(cd.methodname, 'method')
+        self.assertEquals(self.backend.selects, 1)
+        self.assertEquals(call_descriptor.L1_.hits, hits + 4)
+
+        self.save_call('changed')
+        self.assertEquals(call_descriptor.fetch(h).returnval, 'changed')
+        db.delete_io(h)
+        self.assertEquals(call_descriptor.fetch(h), None)
+
+    def test_copy_policies(self):
+        h = self.save_call({'a': [1, 2, 3]})
+        for policy in ('unpickle', 'deepcopy'):
+            config.CALIENDO_L1_COPY = policy
+            call_descriptor.fetch(h).returnval['a'].append(4)
+            self.assertEquals(call_descriptor.fetch(h).returnval, {'a': [1, 2, 3]})
+
+        config.CALIENDO_L1_COPY = 'share'
+        self.assertTrue(call_descriptor.fetch(h).returnval is call_descriptor.fetch(h).returnval)
+
+        config.CALIENDO_L1_COPY = 'unpickle'
+        h = self.save_call(('immutable', 1, None))
+        self.assertTrue(call_descriptor.fetch(h).returnval is call_descriptor.fetch(h).returnval)
+
+    def test_unpickles_once_per_fetch(self):
+        h = self.save_call({'a': [1, 2, 3]})
+        loads = pickling.loads
+        unpickled = []
+        def counting_loads(data, sizes=None):
+            unpickled.append(data)
+            return loads(data, sizes)
+        pickling.loads = counting_loads
+        try:
+            first = call_descriptor.fetch(h)
+            self.assertEquals(len(unpickled), 2) # The return value and the arguments, handed to the first caller as decoded
+            first.returnval['a'].append(4)
+            self.assertEquals(call_descriptor.fetch(h).returnval, {'a': [1, 2, 3]})
+            self.assertEquals(len(unpickled), 3) # Only the mutable return value again
+
+            config.CALIENDO_L1_COPY = 'deepcopy'
+            self.assertEquals(call_descriptor.fetch(h).returnval, {'a': [1, 2, 3]})
+        finally:
+            pickling.loads = loads
+
+    def test_expected_values(self):
+        h = self.hash('expected value')
+        ExpectedValue(call_hash=h, expected_value=['expected']).save()
+        hits = expected_value.L1_.hits
+        self.assertEquals(expected_value.fetch(h).expected_value, ['expected'])
+        self.assertEquals(expected_value.fetch(h).expected_value, ['expected'])
+        self.assertEquals(expected_value.L1_.hits, hits + 1)
+
+        ExpectedValue(call_hash=h, expected_value=['changed']).save()
+        self.assertEquals(expected_value.fetch(h).expected_value, ['changed'])
+
+    def test_switching_backends_clears_the_cache(self):
+        h = self.save_call('first')
+        self.assertEquals(call_descriptor.fetch(h).returnval, 'first')
+        db.set_backend(MemoryBackend())
+        self.assertEquals(call_descriptor.fetch(h), None)
+
+if __name__ == '__main__':
+    unittest.main()
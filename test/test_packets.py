@@ -0,0 +1,102 @@
+import os
+import sys
+import time
+import hashlib
+import unittest
+
+os.environ['USE_CALIENDO'] = 'True'
+
+from caliendo import db
+from caliendo import config
+from caliendo import call_descriptor
+from caliendo import expected_value
+from caliendo.call_descriptor import CallDescriptor
+from caliendo.expected_value import ExpectedValue
+from caliendo.db.memory import MemoryBackend
+
+class SmallPacketBackend(MemoryBackend):
+    """
+    A memory backend that only takes packets of 7 characters or less.
+
+    """
+    max_packet_size = 7
+
+    def put(self, namespace, key, value):
+        if namespace == 'cache':
+            for packet in value.values():
+                assert len(packet['methodname'] + packet['args'] + packet['returnval'] + packet['stack']) <= self.max_packet_size
+        MemoryBackend.put(self, namespace, key, value)
+
+
+class PacketTestCase(unittest.TestCase):
+    def setUp(self):
+        self.previous = db.set_backend(SmallPacketBackend())
+        self.threshold = config.CALIENDO_BLOB_THRESHOLD
+        config.CALIENDO_BLOB_THRESHOLD = 0 # Keep large values in the packets
+
+    def tearDown(self):
+        db.set_backend(self.previous)
+        config.CALIENDO_BLOB_THRESHOLD = self.threshold
+
+    def hash(self, s):
+        return hashlib.sha1(s).hexdigest()
+
+    def save_call(self, returnval):
+        h = self.hash('call')
+        CallDescriptor(hash=h, stack='the stack', method='the_method', returnval=returnval, args=(1, 'two')).save()
+        return h
+
+    def test_packets_span_fields(self):
+        h = self.save_call({'a': 'returnval' * 10})
+        packets = db.select_io(h)
+        self.assertTrue(len(packets) > 1)
+        self.assertEquals([p[5] for p in packets], range(len(packets)))
+        for p in packets[:-1]:
+            self.assertEquals(len(p[1] + p[2] + p[3] + p[4]), SmallPacketBackend.max_packet_size)
+
+        cd = call_descriptor.fetch(h)
+        self.assertEquals(cd.hash, h)
+        self.assertEquals(cd.stack, 'the stack')
+        self.assertEquals(cd.methodname, 'the_method')
+        self.assertEquals(cd.returnval, {'a': 'returnval' * 10})
+        self.assertEquals(cd.args, (1, 'two'))
+
+    def test_expected_value_packets(self):
+        h = self.hash('expected value')
+        ExpectedValue(call_hash=h, expected_value=['expected'] * 10).save()
+        packets = db.select_expected_value(h)
+        self.assertTrue(len(packets) > 1)
+        for p in packets[:-1]:
+            self.assertEquals(len(p[1]), SmallPacketBackend.max_packet_size)
+        self.assertEquals(expected_value.fetch(h).expected_value, ['expected'] * 10)
+
+    def test_unlimited_backend_saves_one_packet(self):
+        db.set_backend(MemoryBackend())
+        h = self.save_call('x' * 100000)
+        self.assertEquals(len(db.select_io(h)), 1)
+        self.assertEquals(call_descriptor.fetch(h).returnval, 'x' * 100000)
+
+    def test_benchmark(self):
+        """
+        Save throughput should stay flat as the return value grows, with and without packetization.
+
+        """
+        rates = []
+        for max_packet_size in (1024 * 1024, None):
+            backend = MemoryBackend()
+            backend.max_packet_size = max_packet_size
+            db.set_backend(backend)
+            for megabytes in (1, 2, 4, 8):
+                returnval = 'x' * (megabytes * 1024 * 1024)
+                start = time.time()
+                h = self.save_call(returnval)
+                rates.append((max_packet_size, megabytes, megabytes / max(time.time() - start, 1e-6)))
+                self.assertEquals(len(db.select_io(h)), megabytes + 1 if max_packet_size else 1)
+
+        if os.environ.get('CALIENDO_BENCHMARK') == 'True':
+            for max_packet_size, megabytes, rate in rates:
+                sys.stderr.write("\npacket size %s, %dMB: %d MB/s" % (max_packet_size, megabytes, rate))
+            sys.stderr.write("\n")
+
+if __name__ == '__main__':
+    unittest.main()
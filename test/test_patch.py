@@ -1,8 +1,18 @@
 import os
+import sys
+import types
 import unittest
 
+os.environ['USE_CALIENDO'] = 'True'
+
 from caliendo.patch import patch
 from caliendo.patch import patch_lazy
+from caliendo.patch import find_dependencies
+from caliendo.patch import find_modules_importing
+from caliendo import bindings
+
+from test.nested import bazbiz
+from test.api import myclass
 
 from test.api.myclass import InheritsFooAndBaz, LazyLoadsBar
 
@@ -16,6 +26,25 @@ def run_t_est_n_times(test, n):
             os._exit(0)
 
 
+def calls_baz(self):
+    self.assertEquals(bazbiz.baz(), 'baz')
+
+def run_in_child(f):
+    pid = os.fork()
+    if pid:
+        return os.waitpid(pid, 0)[1] >> 8
+    try:
+        code = f()
+    except BaseException:
+        code = 2
+    os._exit(code)
+
+def run_test_case(test_case):
+    result = unittest.TestResult()
+    unittest.TestLoader().loadTestsFromTestCase(test_case).run(result)
+    return result
+
+
 class PatchTestCase(unittest.TestCase):
 
     def test_patch_inherited(self):
@@ -60,3 +89,216 @@ class PatchTestCase(unittest.TestCase):
 
         run_t_est_n_times(test, 3)
 
+
+    def test_patch_lazy_reuses_replacements(self):
+
+        @patch_lazy('test.api.myclass.LazyLoadsBar.bar', rvalue='foo')
+        def test():
+            c, d = LazyLoadsBar(), LazyLoadsBar()
+            assert c.bar is c.bar
+            assert c.bar is not d.bar
+            assert c.bar() == d.bar() == 'foo'
+            assert len(getattr(test, '__context').replacements) == 2
+
+        def run():
+            test()
+            return len(getattr(test, '__context').replacements) # Dropped when the context exits
+
+        self.assertEquals(run_in_child(run), 0)
+
+    def test_targets_are_resolved_once(self):
+        target = bindings.resolve_target('test.nested.bazbiz.baz')
+        self.assertEquals(target, (bazbiz, 'baz'))
+        self.assertTrue(bindings.resolve_target('test.nested.bazbiz.baz') is target)
+        self.assertEquals(bindings.resolve_target('test.api.myclass.LazyLoadsBar.bar'), (LazyLoadsBar, 'bar'))
+
+        replaced = types.ModuleType('test.nested.bazbiz')
+        replaced.baz = lambda: 'replaced'
+        sys.modules['test.nested.bazbiz'] = sys.modules['test.nested'].bazbiz = replaced # As if it were imported again
+        try:
+            self.assertEquals(bindings.resolve_target('test.nested.bazbiz.baz'), (replaced, 'baz'))
+        finally:
+            sys.modules['test.nested.bazbiz'] = sys.modules['test.nested'].bazbiz = bazbiz
+        self.assertEquals(bindings.resolve_target('test.nested.bazbiz.baz'), (bazbiz, 'baz'))
+
+        reloaded = type('LazyLoadsBar', (LazyLoadsBar,), {}) # As if test.api.myclass were reloaded
+        myclass.LazyLoadsBar = reloaded
+        try:
+            self.assertEquals(bindings.resolve_target('test.api.myclass.LazyLoadsBar.bar'), (reloaded, 'bar'))
+        finally:
+            myclass.LazyLoadsBar = LazyLoadsBar
+        self.assertEquals(bindings.resolve_target('test.api.myclass.LazyLoadsBar.bar'), (LazyLoadsBar, 'bar'))
+
+    def test_find_modules_importing_matches_find_dependencies(self):
+        starting_with = sys.modules[__name__]
+        deps = find_dependencies(starting_with)
+        for dot_path, target in [('test.nested.bazbiz.baz', bazbiz.baz),
+                                 ('test.api.myclass.InheritsFooAndBaz.foo', InheritsFooAndBaz),
+                                 ('os.urandom', os.urandom)]:
+            expected = set([(module, name) for dependencies in deps.values() for module, name, object in dependencies if object == target])
+            found = find_modules_importing(dot_path, starting_with)
+            self.assertTrue(expected)
+            self.assertEquals(set([(module, name) for module, name, object in found]), expected)
+
+    def test_find_modules_importing_sees_new_bindings(self):
+        starting_with = types.ModuleType('starting_with')
+        self.assertEquals(find_modules_importing('test.nested.bazbiz.baz', starting_with), [])
+
+        starting_with.baz = bazbiz.baz
+        self.assertEquals(set(find_modules_importing('test.nested.bazbiz.baz', starting_with)),
+                          set([(starting_with, 'baz', bazbiz.baz), (bazbiz, 'baz', bazbiz.baz)]))
+
+        imports_biz = types.ModuleType('imports_biz')
+
+        @patch('test.nested.bazbiz.biz', rvalue='patched')
+        def test():
+            # Indexed for the first time while biz is patched
+            imports_biz.biz = bazbiz.biz
+            starting_with.imports_biz = imports_biz
+            self.assertEquals(find_modules_importing('test.nested.bazbiz.biz', starting_with), [])
+
+        test()
+        imports_biz.biz = bazbiz.biz
+        self.assertTrue((imports_biz, 'biz', bazbiz.biz) in find_modules_importing('test.nested.bazbiz.biz', starting_with))
+
+    def test_find_modules_importing_sees_rebound_names(self):
+        starting_with = types.ModuleType('starting_with')
+        starting_with.baz = None
+        self.assertEquals(find_modules_importing('test.nested.bazbiz.baz', starting_with), [])
+
+        starting_with.baz = bazbiz.baz # The same names, so the same size
+        found = find_modules_importing('test.nested.bazbiz.baz', starting_with)
+        self.assertTrue((starting_with, 'baz', bazbiz.baz) in found)
+        expected = set([(m, n) for dependencies in find_dependencies(starting_with).values() for m, n, o in dependencies if o is bazbiz.baz])
+        self.assertEquals(set([(m, n) for m, n, o in found]), expected)
+
+    def test_lookups_only_check_what_can_have_changed(self):
+        starting_with = sys.modules[__name__]
+        registered = types.ModuleType('test.rebinds_in_place')
+        registered.baz = None
+        sys.modules[registered.__name__] = starting_with.rebinds_in_place = registered
+        is_current = bindings.is_current
+        checked = []
+        def counting_is_current(module):
+            checked.append(module)
+            return is_current(module)
+        bindings.is_current = counting_is_current
+        try:
+            self.assertFalse((registered, 'baz', bazbiz.baz) in find_modules_importing('test.nested.bazbiz.baz', starting_with))
+            del checked[:]
+            self.assertFalse((registered, 'baz', bazbiz.baz) in find_modules_importing('test.nested.bazbiz.baz', starting_with))
+            self.assertEquals(checked, [starting_with])
+
+            registered.baz = bazbiz.baz # Rebound in place, without sys.modules changing
+            self.assertTrue((registered, 'baz', bazbiz.baz) in find_modules_importing('test.nested.bazbiz.baz', starting_with))
+        finally:
+            bindings.is_current = is_current
+            del sys.modules[registered.__name__]
+            del starting_with.rebinds_in_place
+
+    def test_stacked_patches_share_one_plan(self):
+        original_baz, original_biz = bazbiz.baz, bazbiz.biz
+
+        @patch('test.nested.bazbiz.baz', rvalue='patched baz')
+        @patch('test.nested.bazbiz.biz', rvalue='patched biz')
+        @patch('test.api.myclass.InheritsFooAndBaz.foo', rvalue='patched foo')
+        def test():
+            assert bazbiz.baz() == 'patched baz'
+            assert bazbiz.biz() == 'patched biz'
+            assert InheritsFooAndBaz().foo() == 'patched foo'
+
+        plans = []
+        for i in range(2):
+            test()
+            plans.append(getattr(test, '__plan'))
+            self.assertTrue(plans[-1] is plans[0])
+            patched = [(owner, attribute) for owner, attribute, replacement in plans[-1][1]]
+            for site in [(bazbiz, 'baz'), (bazbiz, 'biz'), (InheritsFooAndBaz, 'foo')]:
+                self.assertEquals(patched.count(site), 1)
+            self.assertTrue(bazbiz.baz is original_baz)
+            self.assertTrue(bazbiz.biz is original_biz)
+            self.assertFalse('foo' in InheritsFooAndBaz.__dict__)
+            self.assertEquals(InheritsFooAndBaz().foo(), 'foo')
+
+    def test_reused_plans_dont_look_up_bindings(self):
+        @patch('test.nested.bazbiz.baz', rvalue='patched baz')
+        def test():
+            assert bazbiz.baz() == 'patched baz'
+
+        test()
+        find_reachable_modules = bindings.find_reachable_modules
+        lookups = []
+        def counting_find_reachable_modules(*args, **kwargs):
+            lookups.append(args)
+            return find_reachable_modules(*args, **kwargs)
+        bindings.find_reachable_modules = counting_find_reachable_modules
+        try:
+            plan = getattr(test, '__plan')
+            test()
+            self.assertTrue(getattr(test, '__plan') is plan)
+            self.assertEquals(lookups, [])
+        finally:
+            bindings.find_reachable_modules = find_reachable_modules
+
+    def test_plans_see_names_rebound_between_runs(self):
+        rebinds = types.ModuleType('rebinds')
+        rebinds.baz = None
+        sys.modules[__name__].rebinds = rebinds
+        try:
+            @patch('test.nested.bazbiz.baz', rvalue='patched baz')
+            def test():
+                return rebinds.baz and rebinds.baz()
+
+            self.assertEquals(test(), None)
+            rebinds.baz = bazbiz.baz
+            self.assertEquals(test(), 'patched baz')
+            self.assertTrue(rebinds.baz is bazbiz.baz)
+        finally:
+            del sys.modules[__name__].rebinds
+
+    def test_patch_test_case(self):
+        original_baz, original_biz = bazbiz.baz, bazbiz.biz
+
+        class Patched(unittest.TestCase):
+            def test_a(self):
+                self.assertEquals(bazbiz.baz(), 'patched baz')
+                self.assertEquals(bazbiz.biz(), 'patched biz')
+
+            def test_b(self):
+                self.assertEquals(bazbiz.baz(), 'patched baz')
+
+        Patched = patch('test.nested.bazbiz.baz', rvalue='patched baz')(Patched)
+        Patched = patch('test.nested.bazbiz.biz', rvalue='patched biz')(Patched)
+
+        result = run_test_case(Patched)
+        self.assertTrue(result.wasSuccessful(), result.failures + result.errors)
+        self.assertEquals(result.testsRun, 2)
+        self.assertTrue(bazbiz.baz is original_baz)
+        self.assertTrue(bazbiz.biz is original_biz)
+        sites = [(owner, attribute) for owner, attribute, replacement in Patched._caliendo_patches.plan[1]]
+        self.assertEquals(sites.count((bazbiz, 'baz')), 1)
+        self.assertEquals(sites.count((bazbiz, 'biz')), 1)
+
+    def test_patch_as_context_manager(self):
+        original_baz = bazbiz.baz
+        with patch('test.nested.bazbiz.baz', rvalue='patched baz'):
+            self.assertEquals(bazbiz.baz(), 'patched baz')
+        self.assertTrue(bazbiz.baz is original_baz)
+
+    def test_every_form_caches_calls_under_the_same_keys(self):
+        def run(test_case):
+            side_effect = bazbiz.side_effect
+            if not run_test_case(test_case).wasSuccessful():
+                return 2
+            return 0 if bazbiz.side_effect == side_effect else 1 # 1 if baz really ran
+
+        per_test = type('PerTest', (unittest.TestCase,), {'test_baz': patch('test.nested.bazbiz.baz')(calls_baz)})
+        self.assertTrue(run_in_child(lambda: run(per_test)) in (0, 1)) # Records it unless it's cached already
+
+        test_case = patch('test.nested.bazbiz.baz')(type('TestCase', (unittest.TestCase,), {'test_baz': calls_baz}))
+        self.assertEquals(run_in_child(lambda: run(test_case)), 0)
+
+        def run_with():
+            with patch('test.nested.bazbiz.baz'):
+                return run(type('Unpatched', (unittest.TestCase,), {'test_baz': calls_baz}))
+        self.assertEquals(run_in_child(run_with), 0)
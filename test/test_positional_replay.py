@@ -0,0 +1,126 @@
+import os
+import uuid
+import pickle
+import traceback
+import unittest
+
+os.environ['USE_CALIENDO'] = 'True'
+
+from caliendo import config
+from caliendo import facade
+from caliendo.facade import Facade
+from caliendo.patch import patch
+
+CALLS = [] # The arguments service and other were really called with
+
+def service(n, nonce):
+    CALLS.append(n)
+    return n * 2
+
+def other(n, nonce):
+    CALLS.append(n)
+    return n * 3
+
+def outer(n, nonce):
+    return service(n, nonce) + 1
+
+class Client(object):
+    def method(self, n, nonce):
+        return service(n, nonce) + 1
+
+CLIENT = Facade(Client())
+
+def client_method(n, nonce):
+    return CLIENT.method(n, nonce)
+
+def in_child(f):
+    """
+    Runs f in a child process, as each run of a test suite would be.
+
+    :rtype mixed: What f returned, or its traceback if it raised
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid:
+        os.close(w)
+        with os.fdopen(r) as pipe:
+            data = pipe.read()
+        os.waitpid(pid, 0)
+        return pickle.loads(data)
+    os.close(r)
+    try:
+        result = f()
+    except BaseException:
+        result = traceback.format_exc()
+    with os.fdopen(w, 'w') as pipe:
+        pipe.write(pickle.dumps(result))
+    os._exit(0)
+
+def run_calls(name, calls, nonce, replay=False, verify=0):
+    """
+    Makes calls from a test patched to cache service, other, and outer.
+
+    :param str name: The name of the test, which its CallStack is saved under
+    :param list calls: (method name, argument) for each call to make
+    :param str nonce: Passed to every call, so each run of the suite gets new keys
+    :param bool replay: CALIENDO_REPLAY
+    :param int verify: CALIENDO_REPLAY_VERIFY
+
+    :rtype tuple: (what the calls returned, the arguments methods were really called with, how many keys were worked out)
+    """
+    def run():
+        config.CALIENDO_REPLAY = replay
+        config.CALIENDO_REPLAY_VERIFY = verify
+        hashed = []
+        get_hash = facade.get_hash
+        facade.get_hash = lambda *args, **kwargs: hashed.append(1) or get_hash(*args, **kwargs)
+
+        def test():
+            return [globals()[method](n, nonce) for method, n in calls]
+        test.__name__ = name
+        for import_path in ('test.test_positional_replay.service', 'test.test_positional_replay.other', 'test.test_positional_replay.outer'):
+            test = patch(import_path)(test)
+
+        return test(), CALLS, len(hashed)
+    return in_child(run)
+
+class PositionalReplayTestCase(unittest.TestCase):
+    def setUp(self):
+        self.nonce = uuid.uuid4().hex
+        self.name = "test_positional_replay_%s" % self.nonce
+
+    def record(self, calls, expected):
+        self.assertEquals(run_calls(self.name, calls, self.nonce), (expected, [n for method, n in calls], len(calls)))
+
+    def test_replays_by_position(self):
+        calls = [('service', n) for n in range(10)]
+        self.record(calls, range(0, 20, 2))
+        self.assertEquals(run_calls(self.name, calls, self.nonce, replay=True), (range(0, 20, 2), [], 0))
+
+    def test_verifies_sampled_calls(self):
+        calls = [('service', n) for n in range(10)]
+        self.record(calls, range(0, 20, 2))
+        self.assertEquals(run_calls(self.name, calls, self.nonce, replay=True, verify=4), (range(0, 20, 2), [], 3))
+
+    def test_falls_back_when_verification_fails(self):
+        self.record([('service', 1), ('service', 2), ('service', 3)], [2, 4, 6])
+        changed = [('service', 1), ('service', 5), ('service', 3)]
+        self.assertEquals(run_calls(self.name, changed, self.nonce, replay=True, verify=1), ([2, 10, 6], [5], 3))
+
+    def test_falls_back_when_method_differs(self):
+        self.record([('service', 1), ('other', 1)], [2, 3])
+        swapped = [('other', 1), ('service', 1)]
+        self.assertEquals(run_calls(self.name, swapped, self.nonce, replay=True), ([3, 2], [], 2))
+
+    def test_passes_over_nested_calls(self):
+        calls = [('outer', 1), ('service', 2)]
+        self.assertEquals(run_calls(self.name, calls, self.nonce), ([3, 4], [1, 2], 3))
+        self.assertEquals(run_calls(self.name, calls, self.nonce, replay=True), ([3, 4], [], 0))
+
+    def test_passes_over_calls_nested_in_facades(self):
+        calls = [('client_method', 1), ('service', 2)]
+        self.assertEquals(run_calls(self.name, calls, self.nonce), ([3, 4], [1, 2], 3))
+        self.assertEquals(run_calls(self.name, calls, self.nonce, replay=True), ([3, 4], [], 1)) # Only the Facade's own call works out its key
+
+if __name__ == '__main__':
+    unittest.main()
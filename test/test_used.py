@@ -0,0 +1,110 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+os.environ['USE_CALIENDO'] = 'True'
+
+from caliendo.db import used
+
+class UsedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.paths = used.USED_FILEPATH, used.LOG_FILEPATH
+        used.USED_FILEPATH = os.path.join(self.root, 'used.bin')
+        used.LOG_FILEPATH = os.path.join(self.root, 'used')
+        used.reset_used()
+
+    def tearDown(self):
+        used.reset_used()
+        used.USED_FILEPATH, used.LOG_FILEPATH = self.paths
+        shutil.rmtree(self.root)
+
+    def hash(self, s):
+        return hashlib.sha1(s).hexdigest()
+
+    def test_buffered_and_deduplicated(self):
+        a, b = self.hash('a'), self.hash('b')
+        for i in range(10):
+            used.record_used('cache', a)
+            used.record_used('seeds', a)
+            used.record_used('evs', b)
+        self.assertFalse(os.path.exists(used.USED_FILEPATH))
+
+        used.flush()
+        self.assertEquals(os.path.getsize(used.USED_FILEPATH), used.GENERATION_LENGTH + 3 * used.RECORD_LENGTH)
+        used.record_used('cache', a)
+        used.flush()
+        self.assertEquals(os.path.getsize(used.USED_FILEPATH), used.GENERATION_LENGTH + 3 * used.RECORD_LENGTH)
+
+        self.assertEquals(used.read_used(), {'cache': set([a]), 'seeds': set([a]), 'evs': set([b])})
+
+    def test_flushes_past_threshold(self):
+        threshold = used.FLUSH_THRESHOLD
+        used.FLUSH_THRESHOLD = 5
+        try:
+            for i in range(5):
+                used.record_used('cache', self.hash(str(i)))
+            self.assertEquals(os.path.getsize(used.USED_FILEPATH), used.GENERATION_LENGTH + 5 * used.RECORD_LENGTH)
+        finally:
+            used.FLUSH_THRESHOLD = threshold
+
+    def test_merged_across_processes(self):
+        hashes = [self.hash('process %s' % i) for i in range(5)]
+        pids = []
+        for h in hashes:
+            pid = os.fork()
+            if not pid:
+                used.record_used('cache', h)
+                used.flush()
+                os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        used.record_used('cache', self.hash('parent'))
+        self.assertEquals(used.read_used()['cache'], set(hashes + [self.hash('parent')]))
+
+    def test_reset_by_another_process(self):
+        a, b = self.hash('before reset'), self.hash('after reset')
+        used.record_used('cache', a)
+        used.flush()
+        pid = os.fork()
+        if not pid:
+            used.reset_used()
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        used.record_used('cache', b)
+        used.flush()
+        used.record_used('cache', a)
+        self.assertEquals(used.read_used()['cache'], set([a, b]))
+
+    def test_reused_between_reset_and_flush(self):
+        a, b = self.hash('before reset'), self.hash('after reset')
+        used.record_used('cache', a)
+        used.flush()
+        pid = os.fork()
+        if not pid:
+            used.reset_used()
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        used.record_used('cache', a) # Already written, but to the file that was reset
+        used.record_used('cache', b)
+        used.flush()
+        self.assertEquals(used.read_used()['cache'], set([a, b]))
+
+    def test_reads_the_legacy_log(self):
+        a, b = self.hash('legacy'), self.hash('new')
+        with open(used.LOG_FILEPATH, 'w') as log:
+            log.write("evs...%s\n" % a)
+        used.record_used('evs', b)
+        self.assertEquals(used.read_used()['evs'], set([a, b]))
+
+        used.reset_used()
+        self.assertFalse(os.path.exists(used.LOG_FILEPATH))
+        self.assertEquals(used.read_used()['evs'], set())
+
+if __name__ == '__main__':
+    unittest.main()